@@ -0,0 +1,321 @@
+"""The juju, docker and filesystem operations that build_cloud performs."""
+
+from collections import defaultdict
+import copy
+import json
+import os
+import random
+import shutil
+import subprocess
+import threading
+import time
+
+from buildcloud.constraints import DEFAULT_CONSTRAINTS
+from buildcloud.container_stats import parse_docker_stats
+from buildcloud.image_cache import (
+    image_reference,
+    ImageCache,
+)
+from buildcloud.model_pool import reset_model
+from buildcloud.results_archive import ResultsArchive
+from buildcloud.utility import (
+    COMMAND_LOG_DIR,
+    copytree_force,
+    get_output,
+    run_command,
+    snapshot_tree,
+)
+
+
+class Backend(object):
+    """Operations of a job, implemented by subclasses.
+
+    The filesystem operations act on the local temporary directories of
+    the job and are shared by every backend.  The juju operations use
+    juju_home, or $JUJU_HOME if it is None.
+    """
+
+    juju_home = None
+
+    def using_juju_home(self, juju_home):
+        """Return a copy of the backend whose juju operations use
+        juju_home, without changing the environment of the process.
+        """
+        backend = copy.copy(self)
+        backend.juju_home = juju_home
+        return backend
+
+    def copy_juju_home(self, src, dst, ignore=None, snapshot_copy=None):
+        """Copy the juju home src to dst.
+
+        With snapshot_copy, dst is made of hard links to src except for
+        the files named in snapshot_copy, which are copied.
+        """
+        if snapshot_copy is not None:
+            snapshot_tree(src, dst, copy=snapshot_copy, ignore=ignore)
+        else:
+            shutil.copytree(src, dst, ignore=ignore)
+
+    def copy_results(self, src, dst, ignore=None):
+        """Replace dst with the results in src, keeping the logs the
+        job's commands are writing there.
+        """
+        copytree_force(src, dst, ignore=ignore, keep=(COMMAND_LOG_DIR,))
+
+    def archive_results(self, src, path, ignore=None):
+        """Write the results in src to the indexed archive path."""
+        return ResultsArchive(path).write(src, ignore)
+
+    def juju_version(self):
+        raise NotImplementedError
+
+    def bootstrap(self, model, constraints=DEFAULT_CONSTRAINTS):
+        """Bootstrap model with the Constraints of its machines."""
+        raise NotImplementedError
+
+    def set_constraints(self, model, constraints):
+        raise NotImplementedError
+
+    def destroy(self, model):
+        raise NotImplementedError
+
+    def reset(self, model):
+        """Remove everything but the bootstrap node from model."""
+        raise NotImplementedError
+
+    def is_alive(self, model):
+        """Return whether model is bootstrapped and answering."""
+        raise NotImplementedError
+
+    def pull_image(self, image, args):
+        """Make image available as configured by args; return its reference.
+        """
+        raise NotImplementedError
+
+    def image_digest(self, reference, args):
+        """Return the digest of the local image reference, or None."""
+        raise NotImplementedError
+
+    def run_container(self, command, results_dir):
+        """Run the docker command that writes its results to results_dir.
+        """
+        raise NotImplementedError
+
+    def container_stats(self, name):
+        """Return the current resource use of the container name, as
+        parsed by parse_docker_stats, or None if it is not running.
+        """
+        raise NotImplementedError
+
+    def fix_ownership(self, root):
+        raise NotImplementedError
+
+
+class ShellBackend(Backend):
+    """Run the juju and docker command line tools.
+
+    The juju commands are given juju_home in their environment.  A
+    command is killed after timeout seconds, or timeouts[operation] for
+    the operations (method names, e.g. "bootstrap") it maps, and after
+    idle_timeout seconds without output.
+    """
+
+    def __init__(self, timeout=None, idle_timeout=None, timeouts=None):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.timeouts = timeouts or {}
+
+    def run(self, operation, command, env=None):
+        timeout = self.timeouts.get(operation, self.timeout)
+        run_command(command, timeout=timeout, idle_timeout=self.idle_timeout,
+                    env=env)
+
+    def juju_env(self):
+        if self.juju_home is None:
+            return None
+        return dict(os.environ, JUJU_HOME=self.juju_home)
+
+    def juju_version(self):
+        self.run('juju_version', 'juju --version', env=self.juju_env())
+
+    def bootstrap(self, model, constraints=DEFAULT_CONSTRAINTS):
+        self.run('bootstrap', ['juju', 'bootstrap', '--show-log', '-e', model,
+                               '--constraints', constraints.bootstrap],
+                 env=self.juju_env())
+        self.set_constraints(model, constraints.model)
+
+    def set_constraints(self, model, constraints):
+        self.run('set_constraints', 'juju set-constraints -e {} {}'.format(
+            model, constraints), env=self.juju_env())
+
+    def destroy(self, model):
+        self.run('destroy', 'juju destroy-environment --force --yes {}'.format(
+            model), env=self.juju_env())
+
+    def reset(self, model):
+        reset_model(model, env=self.juju_env())
+
+    def is_alive(self, model):
+        try:
+            get_output(['juju', 'status', '-e', model], env=self.juju_env())
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def pull_image(self, image, args):
+        cache = ImageCache(
+            args.image_cache, ttl=args.image_pull_ttl,
+            timeout=self.timeouts.get('pull_image', self.timeout),
+            idle_timeout=self.idle_timeout)
+        return cache.ensure(image, digest=args.image_digest,
+                            background=args.background_pull)
+
+    def image_digest(self, reference, args):
+        return ImageCache(args.image_cache).local_digest(reference)
+
+    def run_container(self, command, results_dir):
+        self.run('run_container', command)
+
+    def container_stats(self, name):
+        try:
+            output = get_output(['sudo', 'docker', 'stats', '--no-stream',
+                                 '--format', '{{json .}}', name])
+        except subprocess.CalledProcessError:
+            return None
+        return parse_docker_stats(output)
+
+    def fix_ownership(self, root):
+        """Give the files under root that we do not own back to us."""
+        uid, gid = os.getuid(), os.getgid()
+        self.run('fix_ownership', [
+            'sudo', 'find', root, '(', '!', '-uid', str(uid), '-o',
+            '!', '-gid', str(gid), ')', '-exec', 'chown', '-h',
+            '{}:{}'.format(uid, gid), '{}', '+'])
+
+
+class FakeBackend(Backend):
+    """Simulate juju and docker in process.
+
+    latencies maps an operation name (a method name, e.g. "bootstrap") to
+    the seconds it takes, varied by +/- jitter as a fraction.  failures
+    maps an operation name to the probability that it fails with
+    CalledProcessError.  Filesystem operations are performed for real,
+    after their simulated latency.
+
+    Every operation is recorded in calls as (operation, argument), and
+    the highest number of concurrent calls of each operation is kept in
+    max_concurrent.  The juju home each model was bootstrapped with is
+    kept in juju_homes.  run_container writes a cwr-like result of
+    result_size bytes to the results directory, and container_stats
+    returns random usage while a container runs.
+    """
+
+    def __init__(self, latencies=None, failures=None, jitter=0.0,
+                 result_size=1024, seed=None):
+        self.latencies = latencies or {}
+        self.failures = failures or {}
+        self.jitter = jitter
+        self.result_size = result_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.running = defaultdict(int)
+        self.max_concurrent = defaultdict(int)
+        self.models = set()
+        self.constraints = {}
+        self.juju_homes = {}
+        self.images = set()
+
+    def simulate(self, operation, argument=None):
+        with self.lock:
+            self.calls.append((operation, argument))
+            self.running[operation] += 1
+            self.max_concurrent[operation] = max(
+                self.max_concurrent[operation], self.running[operation])
+            latency = self.latencies.get(operation, 0)
+            latency *= 1 + self.random.uniform(-self.jitter, self.jitter)
+            fail = self.random.random() < self.failures.get(operation, 0)
+        try:
+            time.sleep(max(latency, 0))
+            if fail:
+                raise subprocess.CalledProcessError(
+                    1, 'fake {} {}'.format(operation, argument or ''))
+        finally:
+            with self.lock:
+                self.running[operation] -= 1
+
+    def copy_juju_home(self, src, dst, ignore=None, snapshot_copy=None):
+        self.simulate('copy_juju_home', src)
+        super(FakeBackend, self).copy_juju_home(
+            src, dst, ignore, snapshot_copy)
+
+    def copy_results(self, src, dst, ignore=None):
+        self.simulate('copy_results', dst)
+        super(FakeBackend, self).copy_results(src, dst, ignore)
+
+    def archive_results(self, src, path, ignore=None):
+        self.simulate('archive_results', path)
+        return super(FakeBackend, self).archive_results(src, path, ignore)
+
+    def juju_version(self):
+        self.simulate('juju_version')
+
+    def bootstrap(self, model, constraints=DEFAULT_CONSTRAINTS):
+        self.simulate('bootstrap', model)
+        with self.lock:
+            self.models.add(model)
+            self.constraints[model] = constraints
+            self.juju_homes[model] = self.juju_home
+
+    def set_constraints(self, model, constraints):
+        self.simulate('set_constraints', model)
+        with self.lock:
+            self.constraints[model] = self.constraints.get(
+                model, DEFAULT_CONSTRAINTS)._replace(model=constraints)
+
+    def destroy(self, model):
+        self.simulate('destroy', model)
+        with self.lock:
+            self.models.discard(model)
+
+    def reset(self, model):
+        self.simulate('reset', model)
+
+    def is_alive(self, model):
+        self.simulate('is_alive', model)
+        with self.lock:
+            return model in self.models
+
+    def pull_image(self, image, args):
+        self.simulate('pull_image', image)
+        reference = image_reference(image, args.image_digest)
+        with self.lock:
+            self.images.add(reference)
+        return reference
+
+    def image_digest(self, reference, args):
+        self.simulate('image_digest', reference)
+        with self.lock:
+            if reference in self.images:
+                return 'sha256:{}'.format(abs(hash(reference)))
+        return None
+
+    def run_container(self, command, results_dir):
+        self.simulate('run_container', command[-1])
+        result = {'benchmarks': [], 'padding': 'x' * self.result_size}
+        with open(os.path.join(results_dir, 'result.json'), 'w') as f:
+            json.dump(result, f)
+
+    def container_stats(self, name):
+        self.simulate('container_stats', name)
+        with self.lock:
+            if not self.running['run_container']:
+                return None
+            return {'cpu': self.random.uniform(0, 200),
+                    'memory': int(self.random.uniform(1, 2) * 1024 ** 3),
+                    'block_read': self.result_size,
+                    'block_write': self.result_size,
+                    'net_rx': 0, 'net_tx': 0, 'pids': 10}
+
+    def fix_ownership(self, root):
+        self.simulate('fix_ownership', root)
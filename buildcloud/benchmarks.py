@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""Store benchmark results from cwr runs and detect regressions."""
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from collections import namedtuple
+import json
+import logging
+import math
+import os
+import sqlite3
+import sys
+import time
+
+from buildcloud.plans import load_test_plan
+from buildcloud.scheduling import plan_key
+from buildcloud.utility import (
+    configure_logging,
+    mkdir_p,
+)
+
+
+DEFAULT_DB_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'benchmarks.sqlite')
+
+# cwr marks a benchmark whose larger values are better "asc", and one
+# whose smaller values are better (e.g. a runtime) "desc".
+HIGHER_IS_BETTER = 'asc'
+LOWER_IS_BETTER = 'desc'
+
+Metric = namedtuple(
+    'Metric', ['controller', 'benchmark', 'value', 'units', 'direction'])
+
+Comparison = namedtuple(
+    'Comparison',
+    ['test_plan', 'bundle', 'controller', 'benchmark', 'value', 'units',
+     'mean', 'stdev', 'samples', 'score', 'regressed'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    run TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    test_plan TEXT NOT NULL,
+    bundle TEXT NOT NULL,
+    controller TEXT NOT NULL,
+    benchmark TEXT NOT NULL,
+    value REAL NOT NULL,
+    units TEXT,
+    direction TEXT,
+    PRIMARY KEY (run, test_plan, controller, benchmark)
+);
+CREATE INDEX IF NOT EXISTS metrics_series ON metrics (
+    test_plan, bundle, controller, benchmark, timestamp);
+"""
+
+
+def default_run_id():
+    """Return the Jenkins build tag, or an id made from the time and pid."""
+    return os.environ.get('BUILD_TAG') or '{}-{}'.format(
+        time.strftime('%Y%m%d%H%M%S'), os.getpid())
+
+
+def _to_float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(value) or math.isinf(value) else value
+
+
+def _metrics_from_benchmark(benchmark, controller):
+    """Yield the Metrics of a cwr benchmark entry.
+
+    An entry either carries its value directly or has a list of results
+    per controller.
+    """
+    name = benchmark.get('name')
+    if not name:
+        return
+    results = benchmark.get('results')
+    if not isinstance(results, list):
+        results = [benchmark]
+    for result in results:
+        if not isinstance(result, dict):
+            continue
+        value = _to_float(result.get('value'))
+        if value is None:
+            continue
+        yield Metric(
+            result.get('controller') or result.get('provider_name') or
+            controller, name, value, result.get('units'),
+            result.get('direction') or benchmark.get('direction'))
+
+
+def _find_metrics(data, controller):
+    """Yield the Metrics in every "benchmarks" list of a cwr result."""
+    if isinstance(data, dict):
+        controller = (data.get('controller') or data.get('provider_name') or
+                      controller)
+        for key, value in data.items():
+            if key == 'benchmarks' and isinstance(value, list):
+                for benchmark in value:
+                    if isinstance(benchmark, dict):
+                        for metric in _metrics_from_benchmark(
+                                benchmark, controller):
+                            yield metric
+            else:
+                for metric in _find_metrics(value, controller):
+                    yield metric
+    elif isinstance(data, list):
+        for item in data:
+            for metric in _find_metrics(item, controller):
+                yield metric
+
+
+def extract_metrics(results_dir, controller):
+    """Return the benchmark Metrics in the cwr JSON results in results_dir.
+
+    Results that do not name their controller are attributed to
+    controller.  Files that are not JSON, and benchmark values that are
+    not numbers, are skipped.
+    """
+    metrics = {}
+    for dirpath, dirnames, filenames in os.walk(results_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (IOError, OSError, ValueError) as e:
+                logging.warning('Skipping {}: {}'.format(path, e))
+                continue
+            for metric in _find_metrics(data, controller):
+                # A later file (e.g. a rerun) replaces an earlier result.
+                metrics[metric.controller, metric.benchmark] = metric
+    return [metrics[key] for key in sorted(metrics)]
+
+
+def mean_stdev(values):
+    mean = float(sum(values)) / len(values)
+    if len(values) < 2:
+        return mean, 0.0
+    variance = sum((v - mean) ** 2 for v in values) / (len(values) - 1)
+    return mean, math.sqrt(variance)
+
+
+def regression_score(value, mean, stdev, direction):
+    """Return how many standard deviations value is worse than mean.
+
+    The score is negative when value is better than the mean, and
+    infinite when the baseline never varied and value is worse.
+    """
+    delta = value - mean
+    if direction == HIGHER_IS_BETTER:
+        delta = -delta
+    if stdev > 0:
+        return delta / stdev
+    if delta > 0:
+        return float('inf')
+    return 0.0 if delta == 0 else float('-inf')
+
+
+class BenchmarkStore(object):
+    """A SQLite time series of benchmark values.
+
+    Each value is keyed by run, test plan, controller and benchmark, and
+    also records the bundle and the time of the run.
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+
+    def connect(self):
+        mkdir_p(os.path.dirname(os.path.abspath(self.path)))
+        connection = sqlite3.connect(self.path, timeout=60)
+        connection.executescript(SCHEMA)
+        return connection
+
+    def record(self, run, test_plan, bundle, metrics, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO metrics VALUES '
+                    '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(run, timestamp, plan_key(test_plan), bundle,
+                      m.controller, m.benchmark, m.value, m.units,
+                      m.direction) for m in metrics])
+        finally:
+            connection.close()
+
+    def latest_run(self):
+        connection = self.connect()
+        try:
+            row = connection.execute(
+                'SELECT run FROM metrics ORDER BY timestamp DESC LIMIT 1'
+            ).fetchone()
+        finally:
+            connection.close()
+        return row[0] if row else None
+
+    def compare(self, run, window=10, threshold=3.0, min_samples=3,
+                min_change=0.05):
+        """Compare every value of run with the preceding values.
+
+        The baseline of a value is the last window values of the same
+        test plan, bundle, controller and benchmark from earlier runs.  A
+        value regressed if it is more than threshold standard deviations
+        and more than min_change (a fraction of the mean) worse than the
+        baseline.  Values with fewer than min_samples baseline values
+        are never flagged.
+
+        Return a list of Comparison.
+        """
+        connection = self.connect()
+        try:
+            rows = connection.execute(
+                'SELECT test_plan, bundle, controller, benchmark, value, '
+                'units, direction, timestamp FROM metrics WHERE run = ? '
+                'ORDER BY test_plan, controller, benchmark', (run,)
+            ).fetchall()
+            comparisons = []
+            for (test_plan, bundle, controller, benchmark, value, units,
+                    direction, timestamp) in rows:
+                baseline = [r[0] for r in connection.execute(
+                    'SELECT value FROM metrics WHERE test_plan = ? AND '
+                    'bundle = ? AND controller = ? AND benchmark = ? AND '
+                    'run != ? AND timestamp < ? '
+                    'ORDER BY timestamp DESC LIMIT ?',
+                    (test_plan, bundle, controller, benchmark, run,
+                     timestamp, window))]
+                mean, stdev, score, regressed = None, None, None, False
+                if baseline:
+                    mean, stdev = mean_stdev(baseline)
+                    score = regression_score(value, mean, stdev, direction)
+                    change = abs(value - mean) / abs(mean) if mean else 1.0
+                    regressed = (len(baseline) >= min_samples and
+                                 score > threshold and change > min_change)
+                comparisons.append(Comparison(
+                    test_plan, bundle, controller, benchmark, value, units,
+                    mean, stdev, len(baseline), score, regressed))
+        finally:
+            connection.close()
+        return comparisons
+
+
+def ingest_results(db_path, results_dir, test_plan, controllers, run=None,
+                   timestamp=None):
+    """Record the benchmarks of a run of test_plan on controllers.
+
+    Return the recorded Metrics.
+    """
+    plan = load_test_plan(test_plan)
+    metrics = extract_metrics(results_dir, ' '.join(controllers))
+    if metrics:
+        BenchmarkStore(db_path).record(
+            run or default_run_id(), test_plan, plan['bundle'], metrics,
+            timestamp)
+    logging.info('Recorded {} benchmark results of {}.'.format(
+        len(metrics), test_plan))
+    return metrics
+
+
+def format_comparisons(comparisons):
+    lines = ['{:<28} {:<12} {:<16} {:>12} {:>12} {:>7}  {}'.format(
+        'test plan', 'controller', 'benchmark', 'value', 'baseline',
+        'score', 'status')]
+    for c in comparisons:
+        if c.mean is None:
+            baseline, score, status = '-', '-', 'no baseline'
+        else:
+            baseline = '{:.4g}'.format(c.mean)
+            score = '{:.1f}'.format(c.score)
+            status = 'REGRESSED' if c.regressed else 'ok'
+        lines.append('{:<28} {:<12} {:<16} {:>12} {:>12} {:>7}  {}'.format(
+            c.test_plan, c.controller, c.benchmark,
+            '{:.4g}'.format(c.value), baseline, score, status))
+    regressed = len([c for c in comparisons if c.regressed])
+    lines.append('{} of {} benchmarks regressed.'.format(
+        regressed, len(comparisons)))
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--db', default=DEFAULT_DB_PATH,
+        help='The benchmark database.')
+    parser.add_argument('--verbose', action='count', default=0)
+    subparsers = parser.add_subparsers(dest='command')
+    ingest = subparsers.add_parser(
+        'ingest', help='Record the benchmarks in a cwr results directory.')
+    ingest.add_argument('results_dir', help='The cwr results directory.')
+    ingest.add_argument('test_plan', help='The test plan that was run.')
+    ingest.add_argument(
+        'controllers', nargs='+', help='The controllers it ran on.')
+    ingest.add_argument(
+        '--run', help='Id of the run (default: $BUILD_TAG or the time).')
+    compare = subparsers.add_parser(
+        'compare', help='Compare a run with the preceding runs.')
+    compare.add_argument(
+        '--run', help='Id of the run to compare (default: the latest).')
+    compare.add_argument(
+        '--window', type=int, default=10,
+        help='Number of preceding runs in the baseline.')
+    compare.add_argument(
+        '--threshold', type=float, default=3.0,
+        help='Standard deviations from the baseline mean that count as '
+             'a regression.')
+    compare.add_argument(
+        '--min-samples', type=int, default=3,
+        help='Fewest baseline values needed to flag a regression.')
+    compare.add_argument(
+        '--min-change', type=float, default=0.05,
+        help='Smallest change, as a fraction of the baseline mean, that '
+             'counts as a regression.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(max(logging.WARN - args.verbose * 10, logging.DEBUG))
+    if args.command == 'ingest':
+        ingest_results(args.db, args.results_dir, args.test_plan,
+                       args.controllers, args.run)
+        return 0
+    store = BenchmarkStore(args.db)
+    run = args.run or store.latest_run()
+    if run is None:
+        print('No benchmark results recorded.')
+        return 0
+    comparisons = store.compare(
+        run, window=args.window, threshold=args.threshold,
+        min_samples=args.min_samples, min_change=args.min_change)
+    print(format_comparisons(comparisons))
+    return 1 if any(c.regressed for c in comparisons) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,29 +2,107 @@
 
 from argparse import ArgumentParser
 from contextlib import contextmanager
-from collections import namedtuple
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+from functools import partial
+import json
 import logging
 import os
-import subprocess
 import shutil
+import sqlite3
+import subprocess
+from tempfile import mkdtemp
+import time
+import uuid
 
+import yaml
+
+from buildcloud.backends import ShellBackend
+from buildcloud.benchmarks import (
+    default_run_id,
+    ingest_results,
+)
+from buildcloud.charm_cache import (
+    CharmCache,
+    DEFAULT_MAX_SIZE as DEFAULT_CHARM_CACHE_SIZE,
+)
+from buildcloud.checkpoint import Checkpoint
+from buildcloud.constraints import (
+    plan_constraints,
+)
+from buildcloud.container_stats import (
+    BudgetExceeded,
+    parse_size,
+    STATS_FILE,
+    StatsSampler,
+)
+from buildcloud.host_locks import (
+    DEFAULT_LOCK_DIR,
+    HostLocks,
+)
+from buildcloud.image_cache import DEFAULT_CACHE_PATH
+from buildcloud.manifest import (
+    job_fingerprint,
+    ResultsManifest,
+)
+from buildcloud.model_pool import ModelPool
+from buildcloud.plans import TestPlanIndex
+from buildcloud.results_archive import archive_path
+from buildcloud.results_sync import ResultsMirror
+from buildcloud.scheduling import DurationHistory
+from buildcloud.taskgraph import (
+    format_critical_path,
+    TaskGraph,
+)
+from buildcloud.timing import (
+    phase,
+    timer,
+)
 from buildcloud.utility import (
+    configure_command_output,
     configure_logging,
-    copytree_force,
     ensure_dir,
     get_juju_home,
-    rename_env,
-    run_command,
-    temp_dir,
+    LOG_LEVELS,
+    mkdir_p,
+    OUTPUT_TAIL_LINES,
+    print_now,
+    rename_envs,
+    run_concurrently,
 )
 
 
+# Files in the juju home that are modified during a job.  They are copied
+# rather than hard linked when the juju home is snapshotted.
+MUTABLE_JUJU_HOME_FILES = ('environments.yaml', 'current-environment')
+
+CONTAINER_IMAGE = 'seman/cwrbox'
+
+# Seconds a command may run before it is killed, by default.
+COMMAND_TIMEOUT = 30 * 60
+BOOTSTRAP_TIMEOUT = 45 * 60
+CWR_TIMEOUT = 6 * 60 * 60
+
+
 def parse_args(argv=None):
     parser = ArgumentParser()
     parser.add_argument(
         'model', nargs='+', help='Name of models to use')
     parser.add_argument(
-        'test_plan', help='File path to test plan.')
+        'test_plan',
+        help='File path to test plan, or to a directory of test plans.')
+    parser.add_argument(
+        '--test-plans', nargs='+', default=[],
+        help='More test plan files or directories to run against the same '
+             'models.')
+    parser.add_argument(
+        '--plan-workers', type=int, default=1,
+        help='Number of test plans to run concurrently.  Concurrent plans '
+             'share the models without a reset in between, so plans only '
+             'run concurrently when each declares its services and no two '
+             'deploy the same service.')
     parser.add_argument(
         '--bundle-file',
         help='Name of bundle file to deploy, if url points to a bundle '
@@ -34,51 +112,274 @@ def parse_args(argv=None):
     parser.add_argument(
         '--juju-home', help='Juju home directory.', default=get_juju_home())
     parser.add_argument('--log-dir', help='The directory to dump logs to.')
+    parser.add_argument(
+        '--live-sync', action='store_true',
+        help='Mirror new and changed results into the log dir while cwr '
+             'runs, instead of replacing the log dir when it finishes.')
+    parser.add_argument(
+        '--sync-interval', type=float, default=10,
+        help='Seconds between live syncs of the results.')
+    parser.add_argument(
+        '--trace', action='store_true',
+        help='Also write the phase timings to trace.json in the log dir, '
+             'in the Chrome trace event format.')
+    parser.add_argument(
+        '--bootstrap-workers', type=int, default=1,
+        help='Number of models to bootstrap and destroy concurrently.')
+    parser.add_argument(
+        '--image-digest',
+        help='Pin the container image to this digest (e.g. sha256:...).')
+    parser.add_argument(
+        '--image-pull-ttl', type=int, default=0,
+        help='Skip pulling the container image if it was pulled less than '
+             'this many seconds ago and is unchanged locally.')
+    parser.add_argument(
+        '--image-cache', default=DEFAULT_CACHE_PATH,
+        help='File that records when container images were pulled.')
+    parser.add_argument(
+        '--background-pull', action='store_true',
+        help='Refresh a stale container image in the background and run '
+             'the locally present image.')
+    parser.add_argument(
+        '--snapshot-juju-home', action='store_true',
+        help='Build the temporary juju home from hard links to the juju '
+             'home, copying only the files that juju modifies.')
+    parser.add_argument(
+        '--results-manifest',
+        help='Record a successful run of the test plan in this file.')
+    parser.add_argument(
+        '--duration-history',
+        help='Record the duration of a successful run in this file.')
+    parser.add_argument(
+        '--benchmark-db',
+        help='Record the benchmark results of each test plan in this '
+             'SQLite database.')
+    parser.add_argument(
+        '--container-sudo', action='store_true',
+        help='Run cwr with sudo as the container\'s ubuntu user, as older '
+             'images require, and give the files it leaves behind back to '
+             'the invoking user afterwards.  By default cwr runs as the '
+             'invoking user, so its files need no fixing up.')
+    parser.add_argument(
+        '--per-model-containers', action='store_true',
+        help='Run a cwr container per model concurrently, instead of one '
+             'container for all the models.')
+    parser.add_argument(
+        '--container-memory',
+        help='Memory limit of each container (e.g. 4g).')
+    parser.add_argument(
+        '--container-cpus', type=float,
+        help='Number of CPUs each container may use (e.g. 1.5).')
+    parser.add_argument(
+        '--model-pool',
+        help='Lease pre-bootstrapped models from the pool in this '
+             'directory instead of bootstrapping new ones.')
+    parser.add_argument(
+        '--max-lease-age', type=int, default=6 * 60 * 60,
+        help='Seconds after which a pool lease that its job stopped '
+             'renewing is assumed to be stale.')
+    parser.add_argument(
+        '--max-model-age', type=int, default=24 * 60 * 60,
+        help='Seconds after which a pooled model is destroyed.')
+    parser.add_argument(
+        '--checkpoint',
+        help='Record the progress of the job in this file.  A job that '
+             'fails keeps its temporary directory and models for --resume.')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume the job recorded in --checkpoint, reusing what is '
+             'still valid.')
+    parser.add_argument(
+        '--teardown', action='store_true',
+        help='Only destroy the models and directory kept by the job '
+             'recorded in --checkpoint.')
+    parser.add_argument(
+        '--archive-results', action='store_true',
+        help='Write the results to --log-dir as one compressed tarball '
+             '(zstd if available, otherwise gzip) with an index, instead '
+             'of copying the files.')
+    parser.add_argument(
+        '--charm-cache',
+        help='Directory of the charm store cache shared by jobs.  By '
+             'default each job downloads the charms again.')
+    parser.add_argument(
+        '--charm-cache-size', type=int, default=DEFAULT_CHARM_CACHE_SIZE,
+        help='Megabytes the charm cache is trimmed to after a job.')
+    parser.add_argument(
+        '--stats-interval', type=float,
+        help='Sample the resource use of the containers every this many '
+             'seconds, writing it to {} with the results.'.format(
+                 STATS_FILE))
+    parser.add_argument(
+        '--memory-budget', type=parse_size,
+        help='Memory a container should stay under, e.g. 2g.')
+    parser.add_argument(
+        '--cpu-budget', type=float,
+        help='CPU a container should stay under, in percent of a core.')
+    parser.add_argument(
+        '--fail-over-budget', action='store_true',
+        help='Fail a container that exceeded its budget, instead of '
+             'warning.')
+    parser.add_argument(
+        '--console-level', default='INFO',
+        choices=['TRACE', 'DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='With --log-dir, the lowest level of command output lines '
+             'to print; the full output is in --log-dir/commands.')
+    parser.add_argument(
+        '--console-rate', type=float, default=20,
+        help='With --log-dir, the most command output lines to print a '
+             'second (0 for no limit).')
+    parser.add_argument(
+        '--tail-lines', type=int, default=OUTPUT_TAIL_LINES,
+        help='Lines of output to print when a command fails.')
+    parser.add_argument(
+        '--command-timeout', type=float, default=COMMAND_TIMEOUT,
+        help='Seconds a juju or docker command may run before it is '
+             'killed (0 for no limit).  Bootstraps and cwr have their own '
+             'limits.')
+    parser.add_argument(
+        '--bootstrap-timeout', type=float, default=BOOTSTRAP_TIMEOUT,
+        help='Seconds a bootstrap may run (0 for no limit).')
+    parser.add_argument(
+        '--cwr-timeout', type=float, default=CWR_TIMEOUT,
+        help='Seconds a cwr container may run (0 for no limit).')
+    parser.add_argument(
+        '--idle-timeout', type=float,
+        help='Seconds a command may go without output before it is '
+             'killed.')
+    parser.add_argument(
+        '--job-id',
+        help='Suffix of the job\'s model names, which must differ from '
+             'that of every other job using the controllers.  A random id '
+             'by default.')
+    parser.add_argument(
+        '--host-locks', default=DEFAULT_LOCK_DIR,
+        help='Directory of the locks shared by the jobs on this host.')
+    parser.add_argument(
+        '--max-bootstraps', type=int,
+        help='Number of jobs on this host that may bootstrap at once.')
+    parser.add_argument(
+        '--max-controller-bootstraps', type=int,
+        help='Number of jobs on this host that may bootstrap on a '
+             'controller at once.')
+    parser.add_argument(
+        '--max-containers', type=int,
+        help='Number of cwr containers that may run on this host at once.')
+    parser.add_argument(
+        '--max-controller-containers', type=int,
+        help='Number of cwr containers on this host that may use a '
+             'controller at once.')
     args = parser.parse_args(argv)
+    if ((args.memory_budget or args.cpu_budget) and
+            not args.stats_interval):
+        parser.error('Budgets require --stats-interval.')
+    if args.archive_results and args.live_sync:
+        parser.error('--archive-results cannot be used with --live-sync.')
+    if (args.resume or args.teardown) and not args.checkpoint:
+        parser.error('--resume and --teardown require --checkpoint.')
+    if args.plan_workers > 1 and args.benchmark_db:
+        parser.error('--benchmark-db cannot be used with --plan-workers, '
+                     'because concurrent benchmarks share machines.')
     return args
 
 
-@contextmanager
-def temp_juju_home(juju_home):
-    org_juju_home = os.environ.get('JUJU_HOME')
-    os.environ["JUJU_HOME"] = juju_home
+def host_locks(args):
+    """Return the HostLocks limiting the job as configured by args."""
+    return HostLocks(
+        args.host_locks,
+        {'bootstrap': args.max_bootstraps, 'container': args.max_containers},
+        {'bootstrap': args.max_controller_bootstraps,
+         'container': args.max_controller_containers})
+
+
+def model_controllers(host, args):
+    """Map each of host.models to the controller (args.model) it uses."""
+    return dict(zip(host.models, args.model))
+
+
+def resumable_env(args, checkpoint):
+    """Return whether the checkpoint's temporary directory can be reused."""
+    root = checkpoint.get('root')
+    models = checkpoint.get('models')
+    if checkpoint.get('controllers') != args.model or not root or not models:
+        return False
+    env_path = os.path.join(root, 'tmp_juju_home', 'environments.yaml')
     try:
-        yield
-    finally:
-        os.environ['JUJU_HOME'] = org_juju_home if org_juju_home else ''
+        with open(env_path) as f:
+            environments = yaml.safe_load(f)['environments']
+    except (IOError, OSError, KeyError, TypeError, yaml.YAMLError):
+        return False
+    return (all(model in environments for model in models) and
+            os.path.isfile(os.path.join(root, 'tmp', 'ssh', 'id_rsa')))
 
 
 @contextmanager
-def env(args):
-    with temp_dir() as root:
-        tmp_juju_home = os.path.join(root, 'tmp_juju_home')
-        shutil.copytree(args.juju_home, tmp_juju_home,
-                        ignore=shutil.ignore_patterns('environments'))
+def env(args, backend=None, checkpoint=None):
+    """Prepare the job's temporary directory, yielding (host, container).
 
-        juju_repository = ensure_dir('juju_repository', parent=root)
-        test_results = ensure_dir('results', parent=root)
+    The models are named after their controller and args.job_id (by
+    default a random id), so that concurrent jobs never share a model.
 
-        tmp = ensure_dir('tmp', parent=root)
-        ssh_dir = os.path.join(tmp, 'ssh')
-        os.mkdir(ssh_dir)
-        shutil.copyfile(os.path.join(tmp_juju_home, 'staging-juju-rsa'),
-                        os.path.join(ssh_dir, 'id_rsa'))
+    With a checkpoint, the directory it records is reused, and the
+    directory is only removed once the checkpoint is done.
+    """
+    backend = backend or ShellBackend()
+    resume = checkpoint is not None and checkpoint.get('root') is not None
+    if resume:
+        root = checkpoint.get('root')
+        logging.info('Resuming in {}.'.format(root))
+    else:
+        root = mkdtemp(prefix='cwr_tst_')
+        if checkpoint is not None:
+            checkpoint.update(root=root)
+    try:
+        tmp_juju_home = os.path.join(root, 'tmp_juju_home')
+        juju_repository = os.path.join(root, 'juju_repository')
+        test_results = os.path.join(root, 'results')
+        tmp = os.path.join(root, 'tmp')
         ssh_path = os.path.join(tmp, 'ssh')
+        if args.charm_cache:
+            deployer_cache = CharmCache(args.charm_cache).workspace(
+                os.path.basename(root))
+        else:
+            deployer_cache = os.path.join(tmp, '.deployer-store-cache')
+        if resume:
+            new_names = checkpoint.get('models')
+        else:
+            with phase('copy juju home', snapshot=args.snapshot_juju_home):
+                backend.copy_juju_home(
+                    args.juju_home, tmp_juju_home,
+                    ignore=shutil.ignore_patterns('environments'),
+                    snapshot_copy=(MUTABLE_JUJU_HOME_FILES
+                                   if args.snapshot_juju_home else None))
 
-        new_names = []
-        for model in args.model:
-            name = rename_env(model, 'cwr-', os.path.join(
-                tmp_juju_home, 'environments.yaml'))
-            new_names.append(name)
+            ensure_dir('juju_repository', parent=root)
+            ensure_dir('results', parent=root)
+
+            ensure_dir('tmp', parent=root)
+            os.mkdir(ssh_path)
+            shutil.copyfile(os.path.join(tmp_juju_home, 'staging-juju-rsa'),
+                            os.path.join(ssh_path, 'id_rsa'))
+
+            job_id = args.job_id or uuid.uuid4().hex[:8]
+            with phase('rename models'):
+                new_names = rename_envs(args.model, 'cwr-', os.path.join(
+                    tmp_juju_home, 'environments.yaml'), '-' + job_id)
+            if checkpoint is not None:
+                checkpoint.update(models=new_names)
+        # Created here so that it belongs to the job's user: docker would
+        # create a missing mount source owned by root, which cwr, running
+        # as the job's user, could not write to.
+        mkdir_p(deployer_cache)
 
         Host = namedtuple(
             'Host',
             ['tmp_juju_home', 'juju_repository', 'test_results',
-             'tmp', 'ssh_path', 'root', 'models'])
+             'tmp', 'ssh_path', 'root', 'models', 'deployer_cache'])
         host = Host(
             tmp_juju_home=tmp_juju_home, juju_repository=juju_repository,
             test_results=test_results, tmp=tmp, ssh_path=ssh_path, root=root,
-            models=new_names)
+            models=new_names, deployer_cache=deployer_cache)
         Container = namedtuple(
             'Container',
             ['user', 'name', 'home', 'ssh_home', 'juju_home', 'test_results',
@@ -91,7 +392,7 @@ def env(args):
         container_repository = os.path.join(container_home, 'charm-repo')
         container_test_plans = os.path.join(container_home, 'test_plans')
         container = Container(user=container_user,
-                              name='seman/cwrbox',
+                              name=CONTAINER_IMAGE,
                               home=container_home,
                               ssh_home=container_ssh_home,
                               juju_home=container_juju_home,
@@ -99,90 +400,658 @@ def env(args):
                               juju_repository=container_repository,
                               test_plans=container_test_plans)
         yield host, container
+    finally:
+        if checkpoint is None or checkpoint.done:
+            shutil.rmtree(root)
+        else:
+            logging.warning('Keeping {} to resume the job.'.format(root))
+
+
+def bootstrap_model(model, backend, constraints=None):
+    with phase('bootstrap', model=model):
+        if constraints is None:
+            backend.bootstrap(model)
+        else:
+            backend.bootstrap(model, constraints)
+
+
+def destroy_model(model, backend):
+    with phase('destroy', model=model):
+        backend.destroy(model)
+
+
+def destroy_models(models, args, backend):
+    """Destroy models, raising the last error after trying them all."""
+    error = None
+    results = run_concurrently(
+        partial(destroy_model, backend=backend), models,
+        args.bootstrap_workers)
+    for model, e in results.items():
+        if e:
+            error = e
+            logging.error("Error destory env failed: {}".format(model))
+    if error:
+        raise error
 
 
 @contextmanager
-def juju(host, args):
-    run_command('juju --version')
-    logging.info("Juju home is set to {}".format(host.tmp_juju_home))
+def bootstrapped_models(host, args, backend, checkpoint=None,
+                        constraints=None, locks=None):
+    """Bootstrap host.models for the job and destroy them afterwards.
+
+    constraints are the Constraints of the models' machines.  Each
+    bootstrap holds a "bootstrap" slot of locks on the host and on the
+    model's controller.
+
+    With a checkpoint, models it records as bootstrapped that are still
+    alive are reused, and the models are only destroyed once the
+    checkpoint is done.
+    """
+    locks = locks or HostLocks()
+    controllers = model_controllers(host, args)
+    started = []
+    models = list(host.models)
+    if checkpoint is not None:
+        bootstrapped = checkpoint.get('bootstrapped', [])
+        for model in checkpoint.get('started', []):
+            if model in bootstrapped and backend.is_alive(model):
+                logging.info('Reusing {}.'.format(model))
+                models.remove(model)
+                started.append(model)
+                continue
+            # A failed bootstrap, or a dead model, must be torn down
+            # before bootstrapping again.
+            try:
+                destroy_model(model, backend)
+            except subprocess.CalledProcessError as e:
+                logging.warning('Unable to destroy {}: {}'.format(model, e))
+        checkpoint.update(started=list(started), bootstrapped=list(started))
+
+    def bootstrap(model):
+        with locks.holding('bootstrap', [controllers[model]]):
+            if checkpoint is not None:
+                checkpoint.add('started', model)
+            bootstrap_model(model, backend, constraints)
+        if checkpoint is not None:
+            checkpoint.add('bootstrapped', model)
+
     try:
-        for model in host.models:
-            run_command(
-                'juju bootstrap --show-log -e {} --constraints mem=4G'.format(
-                    model))
-            run_command('juju set-constraints -e {} mem=2G'.format(model))
-        yield
+        results = run_concurrently(
+            bootstrap, models, args.bootstrap_workers, stop_on_error=True)
+        # Models whose bootstrap started may have come up (or partially
+        # come up) and must be torn down; skipped models never existed.
+        started.extend(results)
+        errors = [e for e in results.values() if e]
+        if errors:
+            logging.error("Bootstrap failed: {}".format(
+                ', '.join(m for m, e in results.items() if e)))
+            raise errors[0]
+        yield host
     finally:
-        if os.getegid() == 111:
-            run_command('sudo chown -R jenkins:jenkins {}'.format(host.root))
+        if checkpoint is None or checkpoint.done:
+            destroy_models(started, args, backend)
         else:
-            run_command('sudo chown -R {}:{} {}'.format(
-                os.getegid(), os.getpgrp(), host.root))
-        error = None
-        for model in host.models:
-            try:
-                run_command(
-                    'juju destroy-environment --force --yes {}'.format(model))
-            except subprocess.CalledProcessError as e:
-                error = e
-                logging.error("Error destory env failed: {}".format(model))
-        if error:
-            raise error
+            logging.warning('Keeping {} to resume the job.'.format(
+                ', '.join(started)))
 
 
-def run_container(host, container, args):
-    logging.debug("Host data: ", host)
-    logging.debug("Container data: ", container)
-    run_command('sudo docker pull {}'.format(container.name))
+@contextmanager
+def leased_models(host, args, backend, checkpoint=None, constraints=None):
+    """Lease a model per controller from the pool instead of bootstrapping.
+
+    The models are reset and returned to the pool afterwards, even when
+    the job has a checkpoint.  Leased models already have a bootstrap
+    node, so only the model constraints are set.
+    """
+    pool = ModelPool(args.model_pool, args.juju_home,
+                     max_lease_age=args.max_lease_age,
+                     max_model_age=args.max_model_age,
+                     timeout=args.command_timeout,
+                     idle_timeout=args.idle_timeout,
+                     timeouts={'bootstrap': args.bootstrap_timeout})
+    with phase('expire pool'):
+        pool.expire()
+    leased = []
+    # However long the job runs, its leases stay fresh until it dies.
+    with pool.renewing():
+        try:
+            for model in args.model:
+                with phase('lease', controller=model):
+                    leased.append(pool.lease(model))
+            if constraints is not None:
+                pool_backend = backend.using_juju_home(pool.juju_home)
+                for name in leased:
+                    pool_backend.set_constraints(name, constraints.model)
+            yield host._replace(models=leased, tmp_juju_home=pool.juju_home)
+        finally:
+            for name in leased:
+                with phase('release', model=name):
+                    pool.release(name)
+
+
+@contextmanager
+def juju(host, args, backend=None, checkpoint=None, constraints=None,
+         locks=None):
+    """Provide bootstrapped models, yielding the host that uses them.
+
+    The juju commands use host.tmp_juju_home.  The juju home of the
+    yielded host is the one its models belong to.
+    """
+    backend = (backend or ShellBackend()).using_juju_home(host.tmp_juju_home)
+    with phase('juju version'):
+        backend.juju_version()
+    logging.info("Juju home is set to {}".format(host.tmp_juju_home))
+    if args.model_pool:
+        models = leased_models(host, args, backend, checkpoint, constraints)
+    else:
+        models = bootstrapped_models(
+            host, args, backend, checkpoint, constraints, locks)
+    try:
+        with models as model_host:
+            yield model_host
+    finally:
+        if args.container_sudo:
+            with phase('fix ownership'):
+                backend.fix_ownership(host.root)
+
+
+def pull_image(image, args, backend=None):
+    backend = backend or ShellBackend()
+    with phase('pull image', image=image):
+        return backend.pull_image(image, args)
+
+
+def container_command(host, container, args, test_plan, image, models,
+                      test_results, name=None):
+    """Return the docker command that runs cwr for test_plan on models.
+
+    The results are written to the host's test_results directory.
+    """
+    if args.container_sudo:
+        user, cwr = container.user, 'sudo cwr'
+    else:
+        # Files written to the volumes are then owned by the invoking user.
+        user, cwr = '{}:{}'.format(os.getuid(), os.getgid()), 'cwr'
+    limits = ''
+    if name:
+        limits += '--name {} '.format(name)
+    if args.container_memory:
+        limits += '--memory {} '.format(args.container_memory)
+    if args.container_cpus:
+        limits += '--cpus {} '.format(args.container_cpus)
     container_options = (
         '--rm '
+        '{}'
         '-u {} '
         '-e Home={} '
         '-e JUJU_HOME={} '
         '-w {} '
         '-v {}:{} '   # Test result location
         '-v {}:{} '   # Temp Juju home
-        '-v {}/.deployer-store-cache:{}.deployer-store-cache '
+        '-v {}:{} '   # Charm store cache
         '-v {}:{} '   # Repository location
         '-v {}:{} '   # Temp location.
         '-v {}:{} '   # Test plan
-        '-t {} '.format(container.user,
+        '-t {} '.format(limits,
+                        user,
                         container.home,
                         container.juju_home,
                         container.home,
-                        host.test_results, container.test_results,
+                        test_results, container.test_results,
                         host.tmp_juju_home, container.juju_home,
-                        host.tmp, container.juju_home,
+                        host.deployer_cache, os.path.join(
+                            container.juju_home, '.deployer-store-cache'),
                         host.juju_repository, container.juju_repository,
                         host.tmp, host.tmp,
-                        os.path.dirname(args.test_plan), container.test_plans,
-                        container.name))
+                        os.path.dirname(test_plan), container.test_plans,
+                        image))
     test_plan = os.path.join(
-        container.test_plans, os.path.basename(args.test_plan))
+        container.test_plans, os.path.basename(test_plan))
     bundle_file = ''
     if args.bundle_file:
         bundle_file = '--bundle {}'.format(args.bundle_file)
     shell_options = (
-        'sudo cwr -F -l DEBUG -v {} {} {}'.format(
-            bundle_file, ' '.join(host.models), test_plan))
-    command = ('sudo docker run {} sh -c'.format(
+        '{} -F -l DEBUG -v {} {} {}'.format(
+            cwr, bundle_file, ' '.join(models), test_plan))
+    return ('sudo docker run {} sh -c'.format(
         container_options).split() + [shell_options])
-    run_command(command)
-    print("User id: {} Group id: {}".format(os.getegid(), os.getpgrp()))
-    # Copy logs
+
+
+def merge_results(test_results, statuses):
+    """Merge the per-model results in test_results into one set.
+
+    statuses maps each model, whose results are in the subdirectory of
+    the same name, to its error or None.  The statuses are written to
+    status.json.  JSON objects with the same path under several models
+    are merged into that path under test_results, by concatenating their
+    lists (e.g. the results and benchmarks of cwr) and otherwise keeping
+    the first model's values.
+    """
+    merged = OrderedDict()
+    for model in statuses:
+        model_results = os.path.join(test_results, model)
+        for dirpath, _, filenames in os.walk(model_results):
+            for filename in sorted(filenames):
+                if not filename.endswith('.json') or filename == STATS_FILE:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    with open(path) as f:
+                        data = json.load(f)
+                except (IOError, OSError, ValueError):
+                    continue
+                if not isinstance(data, dict):
+                    continue
+                rel_path = os.path.relpath(path, model_results)
+                target = merged.setdefault(rel_path, {})
+                for key, value in data.items():
+                    if isinstance(value, list):
+                        target.setdefault(key, [])
+                        if isinstance(target[key], list):
+                            target[key].extend(value)
+                    else:
+                        target.setdefault(key, value)
+    for rel_path, data in merged.items():
+        path = os.path.join(test_results, rel_path)
+        mkdir_p(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    with open(os.path.join(test_results, 'status.json'), 'w') as f:
+        json.dump(dict(
+            (model, {'passed': error is None,
+                     'error': None if error is None else str(error)})
+            for model, error in statuses.items()), f, indent=2,
+            sort_keys=True)
+
+
+def run_sampled(backend, command, test_results, name, args):
+    """Run the container command, sampling the resource use of the
+    container name every args.stats_interval seconds if set.
+
+    The samples are written to test_results.  A container that exceeded
+    args.memory_budget or args.cpu_budget raises BudgetExceeded with
+    args.fail_over_budget, and is otherwise logged.
+    """
+    if not args.stats_interval:
+        backend.run_container(command, test_results)
+        return
+    sampler = StatsSampler(
+        partial(backend.container_stats, name), args.stats_interval)
+    try:
+        with sampler.running():
+            backend.run_container(command, test_results)
+    finally:
+        sampler.write(os.path.join(test_results, STATS_FILE))
+        print_now(sampler.format_summary(name))
+    exceeded = sampler.over_budget(args.memory_budget, args.cpu_budget)
+    if exceeded:
+        message = '{} exceeded its budget: {}'.format(
+            name, ', '.join(exceeded))
+        if args.fail_over_budget:
+            raise BudgetExceeded(message)
+        logging.warning(message)
+
+
+def run_container(host, container, args, test_plan=None, log_dir=None,
+                  image=None, backend=None, locks=None):
+    """Run cwr for test_plan (by default args.test_plan) in a container.
+
+    With args.per_model_containers, a container per model runs
+    concurrently, writing its results to a subdirectory named after the
+    model, and the results are then merged.  The first error is raised
+    after every container has finished.
+
+    Each container holds a "container" slot of locks on the host and on
+    the controllers it uses.
+
+    The results are copied to log_dir (by default args.log_dir), or
+    archived there with args.archive_results.
+    """
+    logging.debug("Host data: ", host)
+    logging.debug("Container data: ", container)
+    backend = backend or ShellBackend()
+    test_plan = test_plan or args.test_plan
+    log_dir = log_dir or args.log_dir
+    image = image or pull_image(container.name, args, backend)
+    locks = locks or HostLocks()
+    controllers = model_controllers(host, args)
+    # Containers of the same job (concurrent plans, or a resumed run) must
+    # not share a name.
+    base_name = '{}-{}'.format(
+        os.path.basename(host.root),
+        os.path.splitext(os.path.basename(test_plan))[0])
+
+    def run_cwr():
+        if not args.per_model_containers or len(host.models) < 2:
+            name = None
+            if args.stats_interval:
+                # docker stats needs to know the container.
+                name = base_name
+            with locks.holding('container', args.model):
+                run_sampled(backend, container_command(
+                    host, container, args, test_plan, image, host.models,
+                    host.test_results, name), host.test_results, name, args)
+            return
+
+        def run_model(model):
+            test_results = mkdir_p(os.path.join(host.test_results, model))
+            name = '{}-{}'.format(base_name, model)
+            with locks.holding('container', [controllers[model]]):
+                with phase('cwr model', test_plan=test_plan, model=model):
+                    run_sampled(backend, container_command(
+                        host, container, args, test_plan, image, [model],
+                        test_results, name), test_results, name, args)
+
+        statuses = run_concurrently(run_model, host.models, len(host.models))
+        merge_results(host.test_results, statuses)
+        errors = [e for e in statuses.values() if e]
+        if errors:
+            raise errors[0]
+
+    ignore = shutil.ignore_patterns('static', '*.html')
+    if log_dir and args.live_sync:
+        mirror = ResultsMirror(host.test_results, log_dir, ignore=ignore)
+        with phase('cwr', test_plan=test_plan):
+            with mirror.running(args.sync_interval):
+                run_cwr()
+    else:
+        try:
+            with phase('cwr', test_plan=test_plan):
+                run_cwr()
+        finally:
+            # Copy logs
+            if log_dir and args.archive_results:
+                with phase('archive logs', test_plan=test_plan):
+                    backend.archive_results(
+                        host.test_results, archive_path(log_dir), ignore)
+            elif log_dir:
+                with phase('copy logs', test_plan=test_plan):
+                    backend.copy_results(host.test_results, log_dir, ignore)
+
+
+def get_test_plans(args):
+    """Return the test plan files named by args, expanding directories."""
+    test_plans = []
+    for path in [args.test_plan] + args.test_plans:
+        if os.path.isdir(path):
+            test_plans.extend(
+                os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith('.yaml'))
+        else:
+            test_plans.append(path)
+    return test_plans
+
+
+def reset_models(host, args, backend):
+    with phase('reset models'):
+        errors = run_concurrently(
+            backend.reset, host.models, args.bootstrap_workers)
+    for error in errors.values():
+        if error:
+            raise error
+
+
+def plan_workers(args, test_plans):
+    """Return how many of test_plans may run at once.
+
+    Concurrent plans deploy into the same models, so they only run
+    concurrently when each declares the services its bundle deploys and
+    no two declare the same service.
+    """
+    if args.plan_workers <= 1 or len(test_plans) < 2:
+        return args.plan_workers
+    deployed_by = {}
+    for path, plan in TestPlanIndex(None).load(test_plans).items():
+        services = plan.data.get('services')
+        if not services:
+            logging.warning('{} does not declare its services; running the '
+                            'test plans sequentially.'.format(path))
+            return 1
+        for service in services:
+            if service in deployed_by:
+                logging.warning(
+                    '{} and {} both deploy {}; running the test plans '
+                    'sequentially.'.format(deployed_by[service], path,
+                                           service))
+                return 1
+            deployed_by[service] = path
+    return args.plan_workers
+
+
+def run_test_plans(host, container, args, test_plans, backend=None,
+                   image=None, checkpoint=None, locks=None):
+    """Run every test plan against the bootstrapped models.
+
+    With more than one plan, each plan's results go to a subdirectory of
+    host.test_results (and of args.log_dir) named after the plan.  Plans
+    run sequentially, resetting the models in between, unless
+    args.plan_workers allows them to run concurrently and their services
+    do not overlap (see plan_workers).
+
+    image is the container image to run, by default pulled first.
+
+    With a checkpoint, plans that already passed are skipped, and the
+    models are reset first if an earlier attempt ran plans on them.
+
+    Return an OrderedDict mapping each test plan that ran to
+    (error, duration), where error is None if the plan succeeded.
+    """
+    backend = backend or ShellBackend()
+    image = image or pull_image(container.name, args, backend)
+    run = default_run_id()
+    durations = {}
+    pending = list(test_plans)
+    if checkpoint is not None:
+        passed = checkpoint.get('passed', [])
+        pending = [p for p in test_plans if p not in passed]
+        if checkpoint.get('ran'):
+            reset_models(host, args, backend)
+    workers = plan_workers(args, pending)
+
+    def run_plan(test_plan):
+        start = time.time()
+        try:
+            plan_host, log_dir = host, args.log_dir
+            if len(test_plans) > 1:
+                name = os.path.splitext(os.path.basename(test_plan))[0]
+                plan_host = host._replace(test_results=mkdir_p(
+                    os.path.join(host.test_results, name)))
+                if log_dir:
+                    log_dir = os.path.join(log_dir, name)
+            if workers <= 1 and test_plan != pending[0]:
+                reset_models(host, args, backend)
+            if checkpoint is not None:
+                checkpoint.add('ran', test_plan)
+            run_container(plan_host, container, args, test_plan, log_dir,
+                          image, backend, locks)
+            if args.benchmark_db:
+                with phase('ingest benchmarks', test_plan=test_plan):
+                    try:
+                        ingest_results(args.benchmark_db,
+                                       plan_host.test_results, test_plan,
+                                       args.model, run)
+                    except sqlite3.Error as e:
+                        logging.error('Unable to record the benchmarks of '
+                                      '{}: {}'.format(test_plan, e))
+            if checkpoint is not None:
+                checkpoint.add('passed', test_plan)
+        finally:
+            durations[test_plan] = time.time() - start
+
+    errors = run_concurrently(run_plan, pending, workers)
+    if checkpoint is not None and not any(errors.values()):
+        checkpoint.update(done=True)
+    return OrderedDict((test_plan, (errors[test_plan], durations[test_plan]))
+                       for test_plan in pending)
+
+
+def record_success(args, test_plan):
+    loaded = TestPlanIndex(None).load([test_plan])[test_plan]
+    fingerprint = job_fingerprint(loaded.sha256, loaded.data, args.model)
+    ResultsManifest(args.results_manifest).record_success(
+        fingerprint, test_plan)
+
+
+def write_timing(args):
+    """Write the job's phase timings to args.log_dir and print a summary."""
     if args.log_dir:
-        copytree_force(host.test_results, args.log_dir,
-                       ignore=shutil.ignore_patterns('static', '*.html'))
+        mkdir_p(args.log_dir)
+        timer.write_jsonl(os.path.join(args.log_dir, 'timing.jsonl'))
+        if args.trace:
+            timer.write_chrome_trace(os.path.join(args.log_dir, 'trace.json'))
+    print_now(timer.format_summary())
+
+
+@contextmanager
+def charm_cache(args, job_env, backend=None):
+    """Hold the shared charm cache while the job's containers use it."""
+    backend = backend or ShellBackend()
+    host, _ = job_env
+    cache = CharmCache(args.charm_cache, args.charm_cache_size * 1024 * 1024)
+    try:
+        with cache.using(host.deployer_cache):
+            try:
+                yield cache
+            finally:
+                if args.container_sudo:
+                    # Let the job publish, and later jobs evict, what the
+                    # container downloaded.
+                    backend.fix_ownership(host.deployer_cache)
+    finally:
+        print_now(cache.format_stats())
+
+
+def job_constraints(test_plans):
+    """Return the Constraints of the machines that run test_plans.
+
+    The bootstrap node and the model machines suit every plan.
+    """
+    plans = TestPlanIndex(None).load(test_plans)
+    return plan_constraints([p.data for p in plans.values()])
+
+
+def job_graph(args, test_plans, backend=None, checkpoint=None):
+    """Return the TaskGraph of a job; its "run" task returns the results.
+
+    The container image is pulled while the juju home is prepared and the
+    models are bootstrapped.  Bootstraps and containers hold the slots of
+    host_locks(args).  With a checkpoint, an image pulled by an
+    earlier attempt is reused if its digest has not changed.  With
+    args.charm_cache, the shared charm cache is held while the test plans
+    run.
+    """
+    backend = backend or ShellBackend()
+    locks = host_locks(args)
+    constraints = job_constraints(test_plans)
+    logging.info('Constraints: {}'.format(constraints))
+
+    def image():
+        if checkpoint is not None and checkpoint.get('image'):
+            reference = checkpoint.get('image')
+            digest = backend.image_digest(reference, args)
+            if digest and digest == checkpoint.get('image_digest'):
+                logging.info('Reusing {}.'.format(reference))
+                return reference
+        reference = pull_image(CONTAINER_IMAGE, args, backend)
+        if checkpoint is not None:
+            checkpoint.update(image=reference, image_digest=(
+                backend.image_digest(reference, args)))
+        return reference
+
+    def models(job_env):
+        host, _ = job_env
+        return juju(host, args, backend, checkpoint, constraints, locks)
+
+    def run(job_env, host, image, *_):
+        _, container = job_env
+        return run_test_plans(
+            host, container, args, test_plans,
+            backend.using_juju_home(host.tmp_juju_home), image, checkpoint,
+            locks)
+
+    graph = TaskGraph()
+    graph.add('env', partial(env, args, backend, checkpoint), context=True)
+    graph.add('pull image', image)
+    graph.add('models', models, ['env'], context=True)
+    run_requires = ['env', 'models', 'pull image']
+    if args.charm_cache:
+        graph.add('charm cache', partial(charm_cache, args, backend=backend),
+                  ['env'], context=True)
+        run_requires.append('charm cache')
+    graph.add('run', run, run_requires)
+    return graph
+
+
+def teardown(args, checkpoint, backend=None):
+    """Destroy the models and the directory kept for the checkpoint's job.
+    """
+    backend = backend or ShellBackend()
+    root = checkpoint.get('root')
+    if root and os.path.isdir(root):
+        tmp_juju_home = os.path.join(root, 'tmp_juju_home')
+        models = checkpoint.get('started', [])
+        if models and os.path.isdir(tmp_juju_home):
+            # The errors are logged; the models may be long gone.
+            run_concurrently(
+                partial(destroy_model,
+                        backend=backend.using_juju_home(tmp_juju_home)),
+                models, args.bootstrap_workers)
+        if args.container_sudo:
+            backend.fix_ownership(root)
+        shutil.rmtree(root)
+    checkpoint.clear()
 
 
 def main():
     args = parse_args()
     log_level = max(logging.WARN - args.verbose * 10, logging.DEBUG)
     configure_logging(log_level)
-    with env(args) as (host, container):
-        with temp_juju_home(host.tmp_juju_home):
-            with juju(host, args):
-                run_container(host, container, args)
+    configure_command_output(args.log_dir, LOG_LEVELS[args.console_level],
+                             args.console_rate, args.tail_lines)
+    backend = ShellBackend(
+        args.command_timeout, args.idle_timeout,
+        {'bootstrap': args.bootstrap_timeout,
+         'run_container': args.cwr_timeout})
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint)
+        checkpoint.load()
+        if args.teardown:
+            teardown(args, checkpoint, backend)
+            return
+        if not (args.resume and not checkpoint.done and
+                resumable_env(args, checkpoint)):
+            if checkpoint.get('root'):
+                logging.warning('Tearing down the previous job in {}.'.format(
+                    checkpoint.get('root')))
+                teardown(args, checkpoint, backend)
+            checkpoint.reset(controllers=args.model)
+    test_plans = get_test_plans(args)
+    graph = job_graph(args, test_plans, backend, checkpoint)
+    try:
+        results = graph.run()['run']
+    finally:
+        write_timing(args)
+        print_now(format_critical_path(graph.critical_path()))
+    if checkpoint is not None and checkpoint.done:
+        checkpoint.clear()
+    # The setup is everything before the test plans could run.
+    setup = graph.times['run'].start - graph.times['env'].start
+    for test_plan, (error, duration) in results.items():
+        if error:
+            logging.error('{} failed: {}'.format(test_plan, error))
+            continue
+        if args.results_manifest:
+            record_success(args, test_plan)
+        if args.duration_history:
+            history = DurationHistory(args.duration_history)
+            # Charge each plan with the shared setup, so that the duration
+            # estimates what the plan takes as a job of its own.
+            for model in args.model:
+                history.record(test_plan, model, setup + duration)
+    errors = [error for error, _ in results.values() if error]
+    if errors:
+        raise errors[0]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+"""Follow queued Jenkins builds until they finish."""
+
+from collections import OrderedDict
+import logging
+import socket
+import time
+
+try:
+    from httplib import HTTPException
+except ImportError:
+    from http.client import HTTPException
+
+from buildcloud.jenkins_client import (
+    JenkinsError,
+    queue_item_id,
+)
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+CANCELLED = 'cancelled'
+# The queue item expired before the build could be found.
+LOST = 'lost'
+PENDING = (QUEUED, RUNNING)
+SUCCESS = 'SUCCESS'
+
+
+class TrackedBuild(object):
+    """The build of one queue item, as last seen.
+
+    Times are in seconds since the epoch and durations in seconds.
+    """
+
+    def __init__(self, queue_id, job, in_queue_since=None):
+        self.queue_id = queue_id
+        self.job = job
+        self.state = QUEUED
+        self.in_queue_since = (
+            time.time() if in_queue_since is None else in_queue_since)
+        self.number = None
+        self.url = None
+        self.started = None
+        self.result = None
+        self.duration = None
+
+    @property
+    def passed(self):
+        return self.state == DONE and self.result == SUCCESS
+
+    @property
+    def queue_wait(self):
+        if self.started is None:
+            return None
+        return max(0.0, self.started - self.in_queue_since)
+
+    @property
+    def status(self):
+        """The build's result once done, or else its state."""
+        if self.state == DONE:
+            return self.result or 'UNKNOWN'
+        return self.state.upper()
+
+    def update(self, info):
+        """Update from the Jenkins description of the build."""
+        self.number = info['number']
+        self.url = info.get('url')
+        self.started = info['timestamp'] / 1000.0
+        if info.get('building'):
+            self.state = RUNNING
+        else:
+            self.state = DONE
+            self.result = info.get('result')
+            self.duration = info['duration'] / 1000.0
+
+
+class BuildTracker(object):
+    """Follow the builds queued for one Jenkins job.
+
+    Each poll asks for the whole queue and the latest builds of the job:
+    two requests, however many builds are followed.  Only an item found
+    in neither is looked up on its own, to learn whether it was cancelled
+    or which build it became.
+
+    The poll interval starts at min_interval and grows by backoff while
+    nothing changes, up to max_interval; it drops back to min_interval
+    whenever a build changes state.
+    """
+
+    def __init__(self, client, job_name, min_interval=5.0,
+                 max_interval=60.0, backoff=1.5):
+        self.client = client
+        self.job_name = job_name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.builds = OrderedDict()
+        self.polls = 0
+
+    def add(self, queue_url, job):
+        queue_id = queue_item_id(queue_url)
+        self.builds[queue_id] = TrackedBuild(queue_id, job)
+
+    def pending(self):
+        return [b for b in self.builds.values() if b.state in PENDING]
+
+    def lookup(self, build):
+        """Find a build that is neither queued nor listed with the job's
+        latest builds.
+        """
+        try:
+            item = self.client.queue_item(build.queue_id)
+        except JenkinsError as e:
+            if e.status != 404:
+                raise
+            logging.warning('Queue item {} expired before its build was '
+                            'found.'.format(build.queue_id))
+            build.state = LOST
+            return
+        build.in_queue_since = item['inQueueSince'] / 1000.0
+        if item.get('cancelled'):
+            build.state = CANCELLED
+        elif item.get('executable'):
+            build.update(self.client.build(
+                self.job_name, item['executable']['number']))
+        # Otherwise the item has just left the queue.
+
+    def poll(self):
+        """Update the pending builds; return whether any changed state."""
+        pending = self.pending()
+        if not pending:
+            return False
+        self.polls += 1
+        queued = self.client.queue_items()
+        latest = self.client.builds(
+            self.job_name, max(100, 2 * len(self.builds)))
+        by_queue_id = dict((b.get('queueId'), b) for b in latest)
+        changed = False
+        for build in pending:
+            state = build.state
+            if build.queue_id in queued:
+                build.in_queue_since = (
+                    queued[build.queue_id]['inQueueSince'] / 1000.0)
+            elif build.queue_id in by_queue_id:
+                build.update(by_queue_id[build.queue_id])
+            else:
+                self.lookup(build)
+            changed = changed or build.state != state
+        return changed
+
+    def wait(self, timeout=None, until=None):
+        """Poll until no build is pending or timeout seconds have passed,
+        and return the builds.
+
+        With until, polling stops as soon as until() is true instead.  A
+        poll that fails, e.g. while Jenkins restarts, is retried at the
+        next interval.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                changed = self.poll()
+            except (JenkinsError, HTTPException, socket.error) as e:
+                logging.warning('Unable to poll Jenkins: {}'.format(e))
+                changed = False
+            if not self.pending() or (until is not None and until()):
+                break
+            if changed:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(
+                    self.interval * self.backoff, self.max_interval)
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, deadline - time.time())
+                if delay <= 0:
+                    break
+            time.sleep(delay)
+        return list(self.builds.values())
@@ -0,0 +1,281 @@
+"""A charm store cache on the host, shared by the containers of all jobs."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import time
+
+from buildcloud.utility import (
+    file_lock,
+    load_json,
+    mkdir_p,
+    write_json_atomic,
+)
+
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'charms')
+# Megabytes.
+DEFAULT_MAX_SIZE = 10 * 1024
+
+
+def link_tree(src, dst):
+    """Recreate the file or directory src at dst, hard linking its files.
+    """
+    if not os.path.isdir(src) or os.path.islink(src):
+        os.link(src, dst)
+        return
+    os.mkdir(dst)
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), os.path.join(dst, name))
+        else:
+            link_tree(path, os.path.join(dst, name))
+
+
+def remove_entry(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def tree_stats(path):
+    """Return the total size and latest access and modification times of
+    the files under path.
+    """
+    size, atime, mtime = 0, 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            size += st.st_size
+            atime = max(atime, st.st_atime)
+            mtime = max(mtime, st.st_mtime)
+    return size, atime, mtime
+
+
+class CharmCache(object):
+    """A juju-deployer charm store cache shared by concurrent jobs.
+
+    Each entry of the store cache is a downloaded charm or bundle.  A
+    job's containers never write to the store: they use a workspace
+    holding hard links to the store's entries, and the entries they
+    download are renamed into the store afterwards, one at a time under
+    the index lock, unless another job added the same entry first.
+
+    Jobs hold a shared lock on the cache while their containers use it.
+    Afterwards the least recently used entries are evicted until the
+    cache fits in max_size bytes, but only while no job holds the lock.
+
+    An entry that existed before a job and was read during it is a hit,
+    as far as the filesystem records access times; an entry the job
+    downloaded is a miss.  The time each entry was last used is kept in
+    index.json.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        self.store = os.path.join(path, 'deployer-store-cache')
+        self.index_path = os.path.join(path, 'index.json')
+        self.usage_lock = os.path.join(path, 'usage.lock')
+        self.workspaces = os.path.join(path, 'jobs')
+        self.stats = {}
+
+    def workspace(self, name):
+        """Return the path of the workspace of the job called name."""
+        return os.path.join(self.workspaces, name)
+
+    def scan(self):
+        """Return the (size, atime, mtime) of each entry, by name."""
+        entries = {}
+        for name in os.listdir(self.store):
+            path = os.path.join(self.store, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                entries[name] = tree_stats(path)
+            else:
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                entries[name] = (st.st_size, st.st_atime, st.st_mtime)
+        return entries
+
+    def mark_unread(self):
+        """Set the access time of every file back to its modification
+        time, which makes even relatime filesystems record the next read.
+
+        Only call it while no other job uses the cache, as it would hide
+        that job's hits.
+        """
+        for dirpath, _, filenames in os.walk(self.store):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    if not os.path.islink(path):
+                        mtime = os.stat(path).st_mtime
+                        os.utime(path, (mtime, mtime))
+                except OSError:
+                    # Removed, or owned by the container's user.
+                    continue
+
+    def load_index(self):
+        return load_json(self.index_path)
+
+    def save_index(self, index):
+        write_json_atomic(self.index_path, index)
+
+    def seed(self, workspace):
+        """Link the store's entries into workspace; return their stats."""
+        mkdir_p(workspace)
+        entries = self.scan()
+        for name in list(entries):
+            path = os.path.join(workspace, name)
+            try:
+                link_tree(os.path.join(self.store, name), path)
+            except OSError as e:
+                logging.warning('Unable to link {}: {}'.format(name, e))
+                del entries[name]
+                if os.path.lexists(path):
+                    remove_entry(path)
+        return entries
+
+    def publish(self, workspace, seeded):
+        """Move the entries the job added to workspace into the store.
+
+        Return the names of the entries the job added.
+        """
+        added = [n for n in os.listdir(workspace) if n not in seeded]
+        with file_lock(self.index_path + '.lock'):
+            for name in added:
+                target = os.path.join(self.store, name)
+                if os.path.lexists(target):
+                    # Another job downloaded it too, and was first.
+                    continue
+                try:
+                    os.rename(os.path.join(workspace, name), target)
+                except OSError as e:
+                    logging.warning('Unable to add {} to the charm cache: '
+                                    '{}'.format(name, e))
+        return added
+
+    def record(self, before, misses, start):
+        """Record the entries used since start and return the job's stats.
+        """
+        after = self.scan()
+        hits = [n for n in before if n in after and after[n][1] >= start]
+        now = time.time()
+        with file_lock(self.index_path + '.lock'):
+            index = self.load_index()
+            for name in hits + misses:
+                index[name] = now
+            for name in list(index):
+                if name not in after:
+                    del index[name]
+            self.save_index(index)
+        return OrderedDict([
+            ('hits', len(hits)), ('misses', len(misses)),
+            ('entries', len(after)),
+            ('size', sum(size for size, _, _ in after.values()))])
+
+    @contextmanager
+    def idle(self):
+        """Yield whether no job is using the cache.
+
+        If none is, the cache is held exclusively until the context exits.
+        """
+        with open(self.usage_lock, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    yield False
+                    return
+                raise
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in
+        max_size, unless a job is using it.  Return the names removed.
+
+        The workspaces left by jobs that died are removed as well.
+        """
+        with self.idle() as idle:
+            if not idle:
+                return []
+            if os.path.isdir(self.workspaces):
+                shutil.rmtree(self.workspaces, ignore_errors=True)
+            with file_lock(self.index_path + '.lock'):
+                return self._evict()
+
+    def _evict(self):
+        entries = self.scan()
+        index = self.load_index()
+        total = sum(size for size, _, _ in entries.values())
+        evicted = []
+        for name in sorted(entries, key=lambda n: index.get(
+                n, max(entries[n][1:]))):
+            if total <= self.max_size:
+                break
+            path = os.path.join(self.store, name)
+            try:
+                remove_entry(path)
+            except OSError as e:
+                logging.warning('Unable to evict {}: {}'.format(path, e))
+                continue
+            total -= entries[name][0]
+            index.pop(name, None)
+            evicted.append(name)
+        self.save_index(index)
+        return evicted
+
+    @contextmanager
+    def using(self, workspace):
+        """Hold the cache for a job whose containers use workspace as
+        their store cache.
+
+        Access times are only reset while no other job uses the cache.
+        Afterwards the entries the job downloaded are published, its
+        workspace is removed, its stats are recorded and the cache is
+        trimmed.
+        """
+        mkdir_p(self.store)
+        with self.idle() as idle:
+            if idle:
+                self.mark_unread()
+        start = time.time()
+        before, misses = {}, []
+        try:
+            with file_lock(self.usage_lock, shared=True):
+                before = self.seed(workspace)
+                try:
+                    yield self
+                finally:
+                    misses = self.publish(workspace, before)
+                    shutil.rmtree(workspace, ignore_errors=True)
+        finally:
+            stats = self.record(before, misses, start)
+            evicted = self.evict()
+            stats['evicted'] = len(evicted)
+            if evicted:
+                stats['size'] = sum(
+                    size for size, _, _ in self.scan().values())
+            self.stats = stats
+
+    def format_stats(self):
+        if not self.stats:
+            return 'Charm cache: unused'
+        return ('Charm cache: {hits} hits, {misses} misses, {evicted} '
+                'evicted, {entries} entries, {mb:.1f} MB'.format(
+                    mb=self.stats['size'] / 1024.0 / 1024, **self.stats))
@@ -0,0 +1,79 @@
+"""Record the progress of a build_cloud job so that it can be resumed."""
+
+import os
+import threading
+
+from buildcloud.utility import (
+    load_json,
+    mkdir_p,
+    write_json_atomic,
+)
+
+
+class Checkpoint(object):
+    """A JSON file recording what a job has set up and done.
+
+    The state holds:
+
+        controllers: the models the job was asked to use
+        root: the job's temporary directory
+        models: the renamed models, once the juju home is ready
+        started: models whose bootstrap was started
+        bootstrapped: models that were bootstrapped
+        image: the container image reference that was pulled
+        image_digest: the digest of image when it was pulled
+        ran: test plans that were started
+        passed: test plans that passed
+        done: set once every test plan has passed
+
+    A job with a checkpoint keeps its temporary directory and models
+    when it fails, so that the next attempt can resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state = {}
+
+    def load(self):
+        self.state = load_json(self.path)
+        return self.state
+
+    def save(self):
+        mkdir_p(os.path.dirname(os.path.abspath(self.path)))
+        write_json_atomic(self.path, self.state)
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.state.get(key, default)
+
+    def reset(self, **values):
+        """Start a new checkpoint holding only values."""
+        with self.lock:
+            self.state = dict(values)
+            self.save()
+
+    def update(self, **values):
+        with self.lock:
+            self.state.update(values)
+            self.save()
+
+    def add(self, key, value):
+        """Add value to the list stored under key."""
+        with self.lock:
+            values = self.state.setdefault(key, [])
+            if value not in values:
+                values.append(value)
+            self.save()
+
+    @property
+    def done(self):
+        return self.get('done', False)
+
+    def clear(self):
+        with self.lock:
+            self.state = {}
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
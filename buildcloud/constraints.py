@@ -0,0 +1,85 @@
+"""Choose the juju constraints of the machines a job bootstraps."""
+
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+
+
+DEFAULT_BOOTSTRAP = 'mem=4G'
+DEFAULT_MODEL = 'mem=2G'
+# Megabytes per unit of the mem and root-disk constraints.
+SIZE_UNITS = {'M': 1, 'G': 1024, 'T': 1024 ** 2, 'P': 1024 ** 3}
+SIZE_KEYS = ('mem', 'root-disk')
+NUMBER_KEYS = ('cores', 'cpu-cores', 'cpu-power')
+CONSTRAINT_KEYS = ('bootstrap', 'model')
+
+Constraints = namedtuple('Constraints', CONSTRAINT_KEYS)
+
+DEFAULT_CONSTRAINTS = Constraints(DEFAULT_BOOTSTRAP, DEFAULT_MODEL)
+
+
+def parse_constraints(text):
+    """Parse "mem=4G cores=2" into an OrderedDict."""
+    constraints = OrderedDict()
+    for item in (text or '').split():
+        key, sep, value = item.partition('=')
+        if not sep or not key:
+            raise ValueError('Invalid constraint: {!r}'.format(item))
+        constraints[key] = value
+    return constraints
+
+
+def format_constraints(constraints):
+    return ' '.join('{}={}'.format(k, v) for k, v in constraints.items())
+
+
+def constraint_value(key, value):
+    """Return a numeric constraint as a number, sizes in megabytes."""
+    if key in SIZE_KEYS:
+        unit = value[-1:].upper()
+        if unit in SIZE_UNITS:
+            return float(value[:-1]) * SIZE_UNITS[unit]
+        return float(value)
+    return float(value)
+
+
+def merge_constraints(texts):
+    """Merge constraint strings, keeping the largest numeric values and
+    otherwise the first value of each key.
+    """
+    merged = OrderedDict()
+    for text in texts:
+        for key, value in parse_constraints(text).items():
+            if key not in merged:
+                merged[key] = value
+            elif key in SIZE_KEYS + NUMBER_KEYS and constraint_value(
+                    key, value) > constraint_value(key, merged[key]):
+                merged[key] = value
+    return format_constraints(merged)
+
+
+def validate_constraints(value):
+    """Return the problems with a test plan's constraints."""
+    problems = []
+    for key in sorted(set(value) - set(CONSTRAINT_KEYS)):
+        problems.append('unknown constraints {!r}'.format(key))
+    for key in CONSTRAINT_KEYS:
+        if key not in value:
+            continue
+        try:
+            for name, item in parse_constraints(value[key]).items():
+                if name in SIZE_KEYS + NUMBER_KEYS:
+                    constraint_value(name, item)
+        except (AttributeError, ValueError):
+            problems.append('invalid {} constraints {!r}'.format(
+                key, value[key]))
+    return problems
+
+
+def plan_constraints(plans):
+    """Return the Constraints that suit all of the loaded test plans."""
+    declared = [plan.get('constraints') or {} for plan in plans]
+    return Constraints(*[
+        merge_constraints(c[key] for c in declared if c.get(key)) or
+        DEFAULT_CONSTRAINTS[i] for i, key in enumerate(CONSTRAINT_KEYS)])
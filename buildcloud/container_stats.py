@@ -0,0 +1,146 @@
+"""Sample the resources a container uses while it runs."""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import re
+import threading
+import time
+
+
+STATS_FILE = 'container-stats.json'
+FIELDS = ('cpu', 'memory', 'block_read', 'block_write', 'net_rx', 'net_tx',
+          'pids')
+UNITS = {
+    'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4,
+    'kb': 1000, 'mb': 1000 ** 2, 'gb': 1000 ** 3, 'tb': 1000 ** 4,
+    'kib': 1024, 'mib': 1024 ** 2, 'gib': 1024 ** 3, 'tib': 1024 ** 4,
+}
+
+
+class BudgetExceeded(Exception):
+    """A container used more than its memory or CPU budget."""
+
+
+def parse_size(text):
+    """Return the bytes in a size such as "512m", "1.5GiB" or "20kB".
+
+    Single letter units are binary, as in docker run --memory.
+    """
+    match = re.match(r'^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$', text)
+    unit = match.group(2).lower() or 'b' if match else None
+    if unit not in UNITS:
+        raise ValueError('Invalid size: {!r}'.format(text))
+    return int(round(float(match.group(1)) * UNITS[unit]))
+
+
+def parse_docker_stats(line):
+    """Parse a line of "docker stats --format '{{json .}}'" output."""
+    stats = json.loads(line)
+
+    def pair(key):
+        first, _, second = stats[key].partition('/')
+        return parse_size(first), parse_size(second)
+
+    block_read, block_write = pair('BlockIO')
+    net_rx, net_tx = pair('NetIO')
+    return {
+        'cpu': float(stats['CPUPerc'].rstrip('%')),
+        'memory': pair('MemUsage')[0],
+        'block_read': block_read,
+        'block_write': block_write,
+        'net_rx': net_rx,
+        'net_tx': net_tx,
+        'pids': int(stats.get('PIDs') or 0),
+    }
+
+
+class StatsSampler(object):
+    """Call read every interval seconds and keep the samples.
+
+    read returns a dict of FIELDS, or None while the container is not
+    running.  CPU is in percent of one core and the rest in bytes.
+    """
+
+    def __init__(self, read, interval):
+        self.read = read
+        self.interval = interval
+        self.samples = []
+        self.start = None
+
+    def sample(self):
+        try:
+            stats = self.read()
+        except Exception as e:
+            logging.debug('Unable to sample the container: {}'.format(e))
+            return
+        if stats is not None:
+            self.samples.append(
+                [round(time.time() - self.start, 3)] +
+                [stats[field] for field in FIELDS])
+
+    @contextmanager
+    def running(self):
+        """Sample in the background while the context is active."""
+        self.start = time.time()
+        stopped = threading.Event()
+
+        def poll():
+            while not stopped.wait(self.interval):
+                self.sample()
+
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+
+    def summary(self):
+        """Return the peak and mean of each field."""
+        summary = OrderedDict()
+        for i, field in enumerate(FIELDS, 1):
+            values = [sample[i] for sample in self.samples]
+            if values:
+                summary[field] = {'peak': max(values),
+                                  'mean': sum(values) / float(len(values))}
+        return summary
+
+    def write(self, path):
+        """Write the samples, one row per sample, and their summary."""
+        with open(path, 'w') as f:
+            json.dump(OrderedDict([
+                ('interval', self.interval),
+                ('fields', ('time',) + FIELDS),
+                ('samples', self.samples),
+                ('summary', self.summary())]), f, separators=(',', ':'))
+
+    def over_budget(self, memory=None, cpu=None):
+        """Return a description of each budget the peak usage exceeded."""
+        summary = self.summary()
+        exceeded = []
+        if memory and 'memory' in summary:
+            if summary['memory']['peak'] > memory:
+                exceeded.append('peak memory {:.1f} MiB > {:.1f} MiB'.format(
+                    summary['memory']['peak'] / 1024.0 ** 2,
+                    memory / 1024.0 ** 2))
+        if cpu and 'cpu' in summary:
+            if summary['cpu']['peak'] > cpu:
+                exceeded.append('peak CPU {:.1f}% > {:.1f}%'.format(
+                    summary['cpu']['peak'], cpu))
+        return exceeded
+
+    def format_summary(self, name):
+        summary = self.summary()
+        if not summary:
+            return '{}: no samples'.format(name)
+        return ('{}: CPU peak {:.1f}% mean {:.1f}%, memory peak {:.1f} MiB '
+                'mean {:.1f} MiB, block I/O {:.1f}/{:.1f} MiB'.format(
+                    name, summary['cpu']['peak'], summary['cpu']['mean'],
+                    summary['memory']['peak'] / 1024.0 ** 2,
+                    summary['memory']['mean'] / 1024.0 ** 2,
+                    summary['block_read']['peak'] / 1024.0 ** 2,
+                    summary['block_write']['peak'] / 1024.0 ** 2))
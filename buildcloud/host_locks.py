@@ -0,0 +1,109 @@
+"""Limit how many jobs on a host bootstrap or run containers at once."""
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import logging
+import os
+import time
+
+from buildcloud.utility import mkdir_p
+
+
+DEFAULT_LOCK_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'locks')
+
+
+class HostSemaphore(object):
+    """A counting semaphore shared by the processes and threads of a host.
+
+    Each of the slots is a lock file; holding an flock() on one holds
+    the slot.  The kernel releases the locks of a process that dies, so
+    a killed job never keeps its slots.
+    """
+
+    def __init__(self, directory, name, slots, poll_interval=0.1):
+        self.directory = directory
+        self.name = name
+        self.slots = slots
+        self.poll_interval = poll_interval
+
+    def try_acquire(self):
+        """Return the open file of a free slot, locked, or None."""
+        for slot in range(self.slots):
+            f = open(os.path.join(
+                self.directory, '{}.{}.lock'.format(self.name, slot)), 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                f.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+            return f
+        return None
+
+    @contextmanager
+    def held(self):
+        mkdir_p(self.directory)
+        f = self.try_acquire()
+        if f is None:
+            logging.info('Waiting for one of {} {} slots.'.format(
+                self.slots, self.name))
+            while f is None:
+                time.sleep(self.poll_interval)
+                f = self.try_acquire()
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+
+class HostLocks(object):
+    """The slots that the jobs on a host hold for each kind of operation.
+
+    machine_limits maps a kind (e.g. "bootstrap") to the number of jobs
+    on the host that may perform it at once, and controller_limits to the
+    number that may perform it at once on each controller.  Kinds without
+    a limit are not limited.
+    """
+
+    def __init__(self, directory=DEFAULT_LOCK_DIR, machine_limits=None,
+                 controller_limits=None, poll_interval=0.1):
+        self.directory = directory
+        self.machine_limits = dict(
+            (k, v) for k, v in (machine_limits or {}).items() if v)
+        self.controller_limits = dict(
+            (k, v) for k, v in (controller_limits or {}).items() if v)
+        self.poll_interval = poll_interval
+
+    def semaphores(self, kind, controllers=()):
+        """Return the semaphores of kind on the host and controllers, in
+        the order every job acquires them, so that jobs cannot deadlock.
+        """
+        semaphores = []
+        if kind in self.machine_limits:
+            semaphores.append(HostSemaphore(
+                self.directory, kind, self.machine_limits[kind],
+                self.poll_interval))
+        if kind in self.controller_limits:
+            for controller in sorted(set(controllers)):
+                semaphores.append(HostSemaphore(
+                    self.directory, '{}-{}'.format(kind, controller),
+                    self.controller_limits[kind], self.poll_interval))
+        return semaphores
+
+    @contextmanager
+    def holding(self, kind, controllers=()):
+        """Hold a slot of kind on the host and on each of controllers."""
+        held = []
+        try:
+            for semaphore in self.semaphores(kind, controllers):
+                context = semaphore.held()
+                context.__enter__()
+                held.append(context)
+            yield
+        finally:
+            for context in reversed(held):
+                context.__exit__(None, None, None)
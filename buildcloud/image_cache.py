@@ -0,0 +1,114 @@
+"""Avoid re-pulling container images that are already fresh locally."""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from buildcloud.utility import (
+    file_lock,
+    load_json,
+    mkdir_p,
+    run_command,
+    write_json_atomic,
+)
+
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'images.json')
+
+
+def image_reference(image, digest=None):
+    """Return the reference used to pull and run image."""
+    return '{}@{}'.format(image, digest) if digest else image
+
+
+class ImageCache(object):
+    """Record the digest and pull time of locally present images.
+
+    A pull is skipped when the image was pulled less than ttl seconds ago
+    and the locally present digest is still the one that was recorded.  A
+    pull is killed after timeout seconds, or idle_timeout seconds without
+    output.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=0, docker='sudo docker',
+                 timeout=None, idle_timeout=None):
+        self.path = path
+        self.ttl = ttl
+        self.docker = docker.split()
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+
+    def load(self):
+        return load_json(self.path)
+
+    def record(self, image, digest, pulled_at=None):
+        mkdir_p(os.path.dirname(self.path))
+        with file_lock(self.path + '.lock'):
+            entries = self.load()
+            entries[image] = {
+                'digest': digest,
+                'pulled_at': time.time() if pulled_at is None else pulled_at}
+            write_json_atomic(self.path, entries)
+
+    def local_digest(self, reference):
+        """Return the repo digest of a locally present image, or None."""
+        command = self.docker + [
+            'inspect', '--format', '{{json .RepoDigests}}', reference]
+        with open(os.devnull, 'w') as devnull:
+            try:
+                output = subprocess.check_output(command, stderr=devnull)
+            except subprocess.CalledProcessError:
+                return None
+        digests = json.loads(output.decode('utf-8') or 'null') or []
+        return digests[0].split('@', 1)[-1] if digests else None
+
+    def is_fresh(self, image):
+        entry = self.load().get(image)
+        if not entry or time.time() - entry['pulled_at'] >= self.ttl:
+            return False
+        return entry['digest'] == self.local_digest(image)
+
+    def pull(self, reference):
+        run_command(self.docker + ['pull', reference], timeout=self.timeout,
+                    idle_timeout=self.idle_timeout)
+        self.record(reference, self.local_digest(reference))
+
+    def background_pull(self, reference):
+        """Pull reference, logging a failure instead of raising it; the
+        job keeps running the image it already has.
+        """
+        try:
+            self.pull(reference)
+        except Exception as e:
+            logging.warning('Unable to refresh {}: {}'.format(reference, e))
+
+    def ensure(self, image, digest=None, background=False):
+        """Make image available locally and return the reference to run.
+
+        An image pinned by digest is immutable, so it is only pulled when
+        it is missing.  Otherwise a stale image that is present locally is
+        refreshed in a background thread if background is set.
+        """
+        reference = image_reference(image, digest)
+        if digest:
+            if self.local_digest(reference) is None:
+                self.pull(reference)
+            else:
+                logging.info('{} is present, skipping pull.'.format(
+                    reference))
+        elif self.is_fresh(image):
+            logging.info('{} was pulled less than {}s ago, skipping '
+                         'pull.'.format(image, self.ttl))
+        elif background and self.local_digest(image) is not None:
+            logging.info('Refreshing {} in the background.'.format(image))
+            threading.Thread(
+                target=self.background_pull, args=(image,)).start()
+        else:
+            self.pull(image)
+        return reference
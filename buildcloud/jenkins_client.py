@@ -0,0 +1,231 @@
+"""A Jenkins client with pooled connections, retries and rate limiting."""
+
+from base64 import b64encode
+from contextlib import contextmanager
+import json
+import logging
+import socket
+import threading
+import time
+
+try:
+    from httplib import (
+        BadStatusLine,
+        HTTPConnection,
+        HTTPException,
+        HTTPSConnection,
+    )
+    from Queue import (
+        Empty,
+        Queue,
+    )
+    from urllib import (
+        quote,
+        urlencode,
+    )
+    from urlparse import urlparse
+except ImportError:
+    from http.client import (
+        BadStatusLine,
+        HTTPConnection,
+        HTTPException,
+        HTTPSConnection,
+    )
+    from queue import (
+        Empty,
+        Queue,
+    )
+    from urllib.parse import (
+        quote,
+        urlencode,
+        urlparse,
+    )
+
+
+# The build fields that BuildTracker follows.
+BUILD_FIELDS = 'number,queueId,building,result,timestamp,duration,url'
+
+
+def queue_item_id(queue_url):
+    """Return the id of the queue item at queue_url."""
+    return int(queue_url.rstrip('/').rsplit('/', 1)[1])
+
+
+class JenkinsError(Exception):
+
+    def __init__(self, status, reason, path):
+        super(JenkinsError, self).__init__(
+            '{} {} for {}'.format(status, reason, path))
+        self.status = status
+
+
+class RateLimiter(object):
+    """Space out calls so that at most rate calls start per second."""
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections to one host, shared between threads."""
+
+    def __init__(self, url, size=4, timeout=60):
+        parsed = urlparse(url)
+        self.connection_class = (
+            HTTPSConnection if parsed.scheme == 'https' else HTTPConnection)
+        self.netloc = parsed.netloc
+        self.timeout = timeout
+        self.idle = Queue(size)
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except Empty:
+            conn = self.connection_class(self.netloc, timeout=self.timeout)
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            raise
+        if self.idle.full():
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+
+class JenkinsClient(object):
+    """Talk to the Jenkins remote API over a shared connection pool.
+
+    Requests that fail with a connection error or a 5xx response are
+    retried up to retries times with exponential backoff starting at
+    backoff seconds.  At most rate requests per second are sent.
+
+    A POST queues a build, so it is only retried when Jenkins cannot have
+    seen it: when it could not be sent, or when a pooled connection that
+    Jenkins had already closed dropped it without an answer.  Retrying
+    any other failure could queue the build twice.
+    """
+
+    def __init__(self, url, credentials=None, pool_size=4, retries=3,
+                 backoff=1.0, rate=None, timeout=60):
+        self.path_prefix = urlparse(url).path.rstrip('/')
+        self.pool = ConnectionPool(url, pool_size, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = RateLimiter(rate)
+        self.headers = {}
+        if credentials:
+            token = '{}:{}'.format(*credentials).encode('utf-8')
+            self.headers['Authorization'] = 'Basic {}'.format(
+                b64encode(token).decode('ascii'))
+        self.crumb = None
+        self.crumb_lock = threading.Lock()
+
+    def request(self, method, path, headers=None):
+        """Send a request and return (status, headers, body).
+
+        Raise JenkinsError for a 4xx response, or the last error once the
+        retries are exhausted.
+        """
+        path = self.path_prefix + path
+        all_headers = dict(self.headers, **(headers or {}))
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.backoff * 2 ** (attempt - 1)
+                logging.warning('Retrying {} {} in {}s: {}'.format(
+                    method, path, delay, error))
+                time.sleep(delay)
+            self.limiter.wait()
+            sent = reused = False
+            try:
+                with self.pool.connection() as conn:
+                    reused = conn.sock is not None
+                    conn.request(method, path,
+                                 body=b'' if method == 'POST' else None,
+                                 headers=all_headers)
+                    sent = True
+                    response = conn.getresponse()
+                    body = response.read()
+            except (HTTPException, socket.error) as e:
+                error = e
+                if method == 'POST' and sent and not (
+                        reused and isinstance(e, BadStatusLine)):
+                    break
+                continue
+            if response.status < 400:
+                headers = dict(
+                    (k.lower(), v) for k, v in response.getheaders())
+                return response.status, headers, body
+            error = JenkinsError(response.status, response.reason, path)
+            if response.status < 500 or method == 'POST':
+                break
+        raise error
+
+    def get_crumb_header(self):
+        """Return the CSRF crumb header, if Jenkins issues crumbs."""
+        with self.crumb_lock:
+            if self.crumb is None:
+                try:
+                    crumb = self.get_json('/crumbIssuer/api/json')
+                    self.crumb = {
+                        crumb['crumbRequestField']: crumb['crumb']}
+                except JenkinsError as e:
+                    if e.status != 404:
+                        raise
+                    self.crumb = {}
+            return self.crumb
+
+    def get_json(self, path, tree=None):
+        if tree:
+            path = '{}?{}'.format(path, urlencode({'tree': tree}))
+        body = self.request('GET', path)[2]
+        return json.loads(body.decode('utf-8'))
+
+    def build_job(self, name, parameters, token=None):
+        """Queue a build of job name and return its queue item URL."""
+        query = dict(parameters)
+        if token:
+            query['token'] = token
+        path = '/job/{}/buildWithParameters?{}'.format(
+            quote(name), urlencode(sorted(query.items())))
+        headers = self.request(
+            'POST', path, headers=self.get_crumb_header())[1]
+        return headers.get('location')
+
+    def queue_items(self):
+        """Return the items waiting in the build queue, by id."""
+        queue = self.get_json(
+            '/queue/api/json', tree='items[id,inQueueSince,why]')
+        return dict((item['id'], item) for item in queue.get('items', []))
+
+    def queue_item(self, queue_id):
+        """Return a queue item, which Jenkins keeps for a few minutes after
+        it leaves the queue.
+        """
+        return self.get_json(
+            '/queue/item/{}/api/json'.format(queue_id),
+            tree='id,inQueueSince,cancelled,executable[number,url]')
+
+    def builds(self, name, limit=100):
+        """Return the latest limit builds of job name, newest first."""
+        job = self.get_json(
+            '/job/{}/api/json'.format(quote(name)),
+            tree='builds[{}]{{0,{}}}'.format(BUILD_FIELDS, limit))
+        return job.get('builds', [])
+
+    def build(self, name, number):
+        return self.get_json(
+            '/job/{}/{}/api/json'.format(quote(name), number),
+            tree=BUILD_FIELDS)
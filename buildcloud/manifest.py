@@ -0,0 +1,58 @@
+"""Record successful runs so unchanged test plans are not re-run."""
+
+from hashlib import sha256
+import json
+import os
+import time
+
+from buildcloud.utility import (
+    file_lock,
+    load_json,
+    mkdir_p,
+    write_json_atomic,
+)
+
+
+DEFAULT_MANIFEST_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'results.json')
+
+
+def job_fingerprint(plan_sha256, plan, controllers):
+    """Identify a run of a test plan's content and bundle on controllers.
+
+    The bundle is identified by the plan's bundle and bundle_file; a
+    bundle pinned to a revision (e.g. cs:mongodb-37) changes the
+    fingerprint when the revision changes.
+    """
+    key = json.dumps([plan_sha256, plan.get('bundle'),
+                      plan.get('bundle_file') or '', sorted(controllers)])
+    return sha256(key.encode('utf-8')).hexdigest()
+
+
+class ResultsManifest(object):
+    """A JSON file mapping job fingerprints to their last successful run.
+
+    Updates are serialised with a lock file so that concurrent jobs can
+    share one manifest.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+        self.path = path
+
+    def load(self):
+        return load_json(self.path)
+
+    def record_success(self, fingerprint, test_plan, timestamp=None):
+        mkdir_p(os.path.dirname(self.path))
+        with file_lock(self.path + '.lock'):
+            entries = self.load()
+            entries[fingerprint] = {
+                'test_plan': test_plan,
+                'timestamp': time.time() if timestamp is None else timestamp}
+            write_json_atomic(self.path, entries)
+
+    def recent(self, max_age, now=None):
+        """Return the fingerprints that succeeded less than max_age ago."""
+        now = time.time() if now is None else now
+        return set(fingerprint for fingerprint, entry in self.load().items()
+                   if now - entry['timestamp'] < max_age)
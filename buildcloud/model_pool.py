@@ -0,0 +1,301 @@
+"""A pool of pre-bootstrapped models that jobs lease and return."""
+
+import logging
+import os
+import shutil
+from contextlib import contextmanager
+import subprocess
+import threading
+import time
+import uuid
+
+import yaml
+
+from buildcloud.constraints import DEFAULT_CONSTRAINTS
+from buildcloud.utility import (
+    atomic_write,
+    file_lock,
+    get_output,
+    load_json,
+    mkdir_p,
+    run_command,
+    snapshot_tree,
+    write_json_atomic,
+)
+
+
+IDLE = 'idle'
+LEASED = 'leased'
+EXPIRING = 'expiring'
+
+
+class ResetTimeout(Exception):
+    """A model still had services or machines after being reset."""
+
+
+def reset_model(model, juju='juju', env=None, timeout=600, poll_interval=5):
+    """Remove every service and machine except the bootstrap node.
+
+    juju destroys them asynchronously, so the status is polled until they
+    are gone; ResetTimeout is raised if any remain after timeout seconds.
+    """
+    juju = juju.split()
+
+    def remaining():
+        status = yaml.safe_load(get_output(
+            juju + ['status', '--format', 'yaml', '-e', model], env=env))
+        return (sorted(status.get('services') or {}),
+                sorted(m for m in status.get('machines') or {} if m != '0'))
+
+    services, machines = remaining()
+    if not (services or machines):
+        return
+    for service in services:
+        run_command(juju + ['destroy-service', '-e', model, service], env=env)
+    if machines:
+        run_command(juju + ['destroy-machine', '--force', '-e', model] +
+                    machines, env=env)
+    deadline = time.time() + timeout
+    while True:
+        services, machines = remaining()
+        if not (services or machines):
+            return
+        if time.time() >= deadline:
+            raise ResetTimeout(
+                '{} still has services {} and machines {} after {} '
+                'seconds.'.format(model, services, machines, timeout))
+        time.sleep(poll_interval)
+
+
+class ModelPool(object):
+    """Bootstrapped models kept alive between jobs.
+
+    The pool lives in a directory holding its own juju home, so that the
+    models' environment state survives the jobs that use them, and a
+    state file recording every model:
+
+        {name: {"controller": ..., "status": "idle", "leased" or
+                "expiring", "bootstrapped_at": ..., "leased_at": ...}}
+
+    A leased model is returned to the pool after it has been reset.  A
+    lease not renewed for max_lease_age seconds is assumed to belong to a
+    dead job, and a model older than max_model_age seconds is retired;
+    expire() destroys both.  renewing() keeps the leases of a running job
+    fresh.
+
+    A juju command is killed after timeout seconds, or timeouts[command]
+    for the commands (e.g. "bootstrap") it maps, and after idle_timeout
+    seconds without output.
+    """
+
+    def __init__(self, path, source_juju_home, juju='juju',
+                 max_lease_age=6 * 60 * 60, max_model_age=24 * 60 * 60,
+                 timeout=None, idle_timeout=None, timeouts=None):
+        self.path = path
+        self.source_juju_home = source_juju_home
+        self.juju_home = os.path.join(path, 'juju_home')
+        self.state_path = os.path.join(path, 'state.json')
+        self.juju = juju
+        self.max_lease_age = max_lease_age
+        self.max_model_age = max_model_age
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.timeouts = timeouts or {}
+        # The models this pool object leased and has not returned.
+        self.held = set()
+        self.env = dict(os.environ, JUJU_HOME=self.juju_home)
+
+    def load(self):
+        return load_json(self.state_path)
+
+    def save(self, state):
+        write_json_atomic(self.state_path, state)
+
+    def locked(self):
+        mkdir_p(self.path)
+        return file_lock(os.path.join(self.path, 'state.lock'))
+
+    def run_juju(self, *args):
+        run_command(self.juju.split() + list(args),
+                    timeout=self.timeouts.get(args[0], self.timeout),
+                    idle_timeout=self.idle_timeout, env=self.env)
+
+    def ensure_juju_home(self):
+        """Create the pool's juju home from the source juju home."""
+        if not os.path.isdir(self.juju_home):
+            mkdir_p(self.path)
+            snapshot_tree(self.source_juju_home, self.juju_home,
+                          copy=['environments.yaml'],
+                          ignore=shutil.ignore_patterns('environments'))
+
+    def update_environments(self, add=None, remove=None):
+        """Add a (name, controller) environment and/or remove one."""
+        env_path = os.path.join(self.juju_home, 'environments.yaml')
+        with open(env_path) as f:
+            config = yaml.safe_load(f)
+        environments = config['environments']
+        if add:
+            name, controller = add
+            environments[name] = dict(environments[controller])
+        if remove:
+            environments.pop(remove, None)
+        with atomic_write(env_path) as f:
+            yaml.dump(config, f, indent=4, default_flow_style=False)
+
+    def is_healthy(self, name):
+        try:
+            get_output(self.juju.split() + ['status', '-e', name],
+                       env=self.env)
+        except subprocess.CalledProcessError:
+            return False
+        return True
+
+    def lease(self, controller):
+        """Lease a healthy model of controller, bootstrapping if needed."""
+        while True:
+            now = time.time()
+            with self.locked():
+                self.ensure_juju_home()
+                state = self.load()
+                idle = sorted(
+                    (entry['bootstrapped_at'], name)
+                    for name, entry in state.items()
+                    if entry['controller'] == controller and
+                    entry['status'] == IDLE and
+                    now - entry['bootstrapped_at'] < self.max_model_age)
+                if idle:
+                    name = idle[-1][1]
+                    state[name].update(status=LEASED, leased_at=now)
+                else:
+                    name = 'cwr-{}-{}'.format(controller, uuid.uuid4().hex[:8])
+                    self.update_environments(add=(name, controller))
+                    state[name] = {
+                        'controller': controller, 'status': LEASED,
+                        'bootstrapped_at': None, 'leased_at': now}
+                self.save(state)
+            self.held.add(name)
+            if not idle:
+                break
+            if self.is_healthy(name):
+                logging.info('Leased {} from the pool.'.format(name))
+                return name
+            logging.warning('{} is unhealthy, destroying it.'.format(name))
+            self.destroy(name)
+        try:
+            self.run_juju('bootstrap', '--show-log', '-e', name,
+                          '--constraints', DEFAULT_CONSTRAINTS.bootstrap)
+            self.run_juju('set-constraints', '-e', name,
+                          DEFAULT_CONSTRAINTS.model)
+        except Exception:
+            self.destroy(name)
+            raise
+        with self.locked():
+            state = self.load()
+            state[name]['bootstrapped_at'] = time.time()
+            self.save(state)
+        logging.info('Bootstrapped {} for the pool.'.format(name))
+        return name
+
+    def renew(self):
+        """Refresh the lease time of the models held."""
+        now = time.time()
+        with self.locked():
+            state = self.load()
+            renewed = False
+            for name in self.held:
+                if state.get(name, {}).get('status') == LEASED:
+                    state[name]['leased_at'] = now
+                    renewed = True
+            if renewed:
+                self.save(state)
+
+    @contextmanager
+    def renewing(self, interval=None):
+        """Renew the leases held every interval seconds (by default a
+        tenth of max_lease_age) until the context exits.
+        """
+        interval = interval or self.max_lease_age / 10.0
+        stopped = threading.Event()
+
+        def renew():
+            while not stopped.wait(interval):
+                try:
+                    self.renew()
+                except (IOError, OSError) as e:
+                    logging.warning('Unable to renew leases: {}'.format(e))
+
+        thread = threading.Thread(target=renew)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+
+    def is_leased(self, name):
+        return self.load().get(name, {}).get('status') == LEASED
+
+    def release(self, name):
+        """Reset a leased model and return it to the pool.
+
+        A model that expired while it was leased is left to expire().
+        """
+        self.held.discard(name)
+        if not self.is_leased(name):
+            logging.warning('{} is no longer leased.'.format(name))
+            return
+        try:
+            reset_model(name, self.juju, self.env)
+        except (subprocess.CalledProcessError, ResetTimeout) as e:
+            logging.warning('Unable to reset {}, destroying it: {}'.format(
+                name, e))
+            self.destroy(name)
+            return
+        with self.locked():
+            state = self.load()
+            if state.get(name, {}).get('status') == LEASED:
+                state[name].update(status=IDLE, leased_at=None)
+                self.save(state)
+
+    def destroy(self, name):
+        self.held.discard(name)
+        try:
+            self.run_juju('destroy-environment', '--force', '--yes', name)
+        finally:
+            with self.locked():
+                state = self.load()
+                state.pop(name, None)
+                self.save(state)
+                self.update_environments(remove=name)
+
+    def expire(self, now=None):
+        """Destroy models with stale leases or past their maximum age.
+
+        The models are marked expiring under the lock, so that no job
+        leases or returns them while they are destroyed.  A model still
+        expiring after max_lease_age, because its expirer died, is expired
+        again.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        with self.locked():
+            state = self.load()
+            for name, entry in state.items():
+                if entry['status'] in (LEASED, EXPIRING):
+                    stale = now - entry['leased_at'] >= self.max_lease_age
+                else:
+                    stale = (now - entry['bootstrapped_at'] >=
+                             self.max_model_age)
+                if stale:
+                    entry.update(status=EXPIRING, leased_at=now)
+                    expired.append(name)
+            if expired:
+                self.save(state)
+        for name in sorted(expired):
+            logging.info('Expiring {}.'.format(name))
+            try:
+                self.destroy(name)
+            except subprocess.CalledProcessError as e:
+                logging.error('Unable to destroy {}: {}'.format(name, e))
+        return sorted(expired)
@@ -0,0 +1,169 @@
+"""Load, validate and cache cwr test plans."""
+
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+from hashlib import sha256
+import logging
+from multiprocessing import Pool
+import os
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+from buildcloud.constraints import validate_constraints
+from buildcloud.utility import (
+    load_json,
+    mkdir_p,
+    write_json_atomic,
+)
+
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'test_plans.json')
+
+STRING_TYPES = (str, type(u''))
+
+# Test plan keys mapped to (allowed types, required).
+SCHEMA = {
+    'bundle': (STRING_TYPES, True),
+    'bundle_name': (STRING_TYPES, True),
+    'bundle_file': (STRING_TYPES, False),
+    'benchmark': ((dict,), False),
+    # Juju constraints of the "bootstrap" node and of "model" machines.
+    'constraints': ((dict,), False),
+    # Names of the services the bundle deploys.
+    'services': ((list,), False),
+}
+
+TestPlan = namedtuple('TestPlan', ['path', 'sha256', 'data'])
+
+
+class InvalidTestPlan(ValueError):
+    """One or more test plans could not be parsed or failed validation."""
+
+
+def validate_test_plan(plan, path):
+    """Raise InvalidTestPlan if plan does not match SCHEMA."""
+    if not isinstance(plan, dict):
+        raise InvalidTestPlan('{}: test plan must be a mapping'.format(path))
+    problems = []
+    for key, (types, required) in sorted(SCHEMA.items()):
+        value = plan.get(key)
+        if value is None:
+            if required:
+                problems.append('missing required key {!r}'.format(key))
+        elif not isinstance(value, types):
+            problems.append('{!r} must be a {}'.format(
+                key, ' or '.join(t.__name__ for t in types)))
+        elif key == 'constraints':
+            problems.extend(validate_constraints(value))
+    if problems:
+        raise InvalidTestPlan('{}: {}'.format(path, ', '.join(problems)))
+
+
+def parse_test_plan(path, text):
+    plan = yaml.load(text, Loader=SafeLoader)
+    validate_test_plan(plan, path)
+    return plan
+
+
+def load_test_plan(path):
+    with open(path, 'rb') as f:
+        return parse_test_plan(path, f.read())
+
+
+def _parse(item):
+    """Parse one (path, text) item, returning (plan, error message)."""
+    path, text = item
+    try:
+        return parse_test_plan(path, text), None
+    except yaml.YAMLError as e:
+        return None, '{}: {}'.format(path, e)
+    except InvalidTestPlan as e:
+        return None, str(e)
+
+
+class TestPlanIndex(object):
+    """Parse test plans, reusing cached results for unchanged files.
+
+    Cache entries are keyed by path and are reused while the file's mtime
+    and size are unchanged, or when its content hash still matches.
+    Changed plans are parsed by up to workers processes.
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, workers=1):
+        self.cache_path = cache_path
+        self.workers = workers
+
+    def read_cache(self):
+        if not self.cache_path:
+            return {}
+        return load_json(self.cache_path)
+
+    def write_cache(self, entries):
+        if not self.cache_path:
+            return
+        mkdir_p(os.path.dirname(self.cache_path))
+        write_json_atomic(self.cache_path, entries, indent=None,
+                          sort_keys=False)
+
+    def parse(self, items):
+        if self.workers > 1 and len(items) > 1:
+            pool = Pool(min(self.workers, len(items)))
+            try:
+                return pool.map(_parse, items)
+            finally:
+                pool.close()
+                pool.join()
+        return [_parse(item) for item in items]
+
+    def load(self, paths):
+        """Return an OrderedDict mapping each path to its TestPlan.
+
+        Raise InvalidTestPlan describing every plan that is malformed.
+        """
+        cache = self.read_cache()
+        entries = {}
+        to_parse = []
+        for path in paths:
+            key = os.path.abspath(path)
+            st = os.stat(path)
+            entry = cache.get(key)
+            if (entry and entry['mtime'] == st.st_mtime and
+                    entry['size'] == st.st_size):
+                entries[key] = entry
+                continue
+            with open(path, 'rb') as f:
+                text = f.read()
+            digest = sha256(text).hexdigest()
+            if entry and entry['sha256'] == digest:
+                entry.update(mtime=st.st_mtime, size=st.st_size)
+                entries[key] = entry
+                continue
+            to_parse.append((path, text, st, digest))
+        logging.debug('Parsing {} of {} test plans.'.format(
+            len(to_parse), len(paths)))
+        results = self.parse([(path, text) for path, text, _, _ in to_parse])
+        errors = []
+        for (path, _, st, digest), (plan, error) in zip(to_parse, results):
+            if error:
+                errors.append(error)
+                continue
+            entries[os.path.abspath(path)] = {
+                'mtime': st.st_mtime, 'size': st.st_size, 'sha256': digest,
+                'plan': plan}
+        cache.update(entries)
+        self.write_cache(cache)
+        if errors:
+            raise InvalidTestPlan('\n'.join(errors))
+        plans = OrderedDict()
+        for path in paths:
+            entry = entries[os.path.abspath(path)]
+            plans[path] = TestPlan(path, entry['sha256'], entry['plan'])
+        return plans
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""Archive a results directory as one compressed tarball with an index.
+
+Each tar member is compressed on its own (as a gzip member or a zstd
+frame), so the archive is an ordinary .tar.gz or .tar.zst, and the index
+records where each member starts so a single file can be read back
+without decompressing the rest.
+"""
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import errno
+import hashlib
+import io
+import json
+import os
+import sys
+import tarfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from buildcloud.utility import (
+    atomic_write,
+    mkdir_p,
+    write_json_atomic,
+)
+
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+EXTENSIONS = {GZIP: '.tar.gz', ZSTD: '.tar.zst'}
+CHUNK_SIZE = 64 * 1024
+
+
+def default_compression():
+    return ZSTD if zstandard is not None else GZIP
+
+
+def archive_path(directory, compression=None):
+    """Return the path of the results archive in directory."""
+    return os.path.join(directory, 'results' + EXTENSIONS[
+        compression or default_compression()])
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def walk(src, ignore=None):
+    """Yield the path of every file under src, relative to src, in order.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        ignored = set()
+        if ignore is not None:
+            ignored = ignore(dirpath, dirnames + filenames)
+        dirnames[:] = sorted(d for d in dirnames if d not in ignored)
+        rel_dir = os.path.relpath(dirpath, src)
+        for filename in sorted(filenames):
+            if filename not in ignored:
+                yield os.path.normpath(os.path.join(rel_dir, filename))
+
+
+class ResultsArchive(object):
+    """A compressed tarball of results and its JSON index.
+
+    The index maps each archived path to the offset and length of its
+    compressed member, its size and its sha256.  A file with the same
+    content as one archived before it is stored as a hard link to it,
+    and its index entry names that file as "link".
+    """
+
+    def __init__(self, path, compression=None):
+        if compression is None:
+            compression = ZSTD if path.endswith(EXTENSIONS[ZSTD]) else GZIP
+        if compression == ZSTD and zstandard is None:
+            raise ValueError('zstd compression needs the zstandard module.')
+        self.path = path
+        self.compression = compression
+        self.index_path = path + '.index.json'
+
+    def compressor(self):
+        if self.compression == ZSTD:
+            return zstandard.ZstdCompressor().compressobj()
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decompressor(self):
+        if self.compression == ZSTD:
+            return zstandard.ZstdDecompressor().decompressobj()
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def write_member(self, out, info, f=None):
+        """Write the tar member for info, with the data read from f, as
+        one compressed member; return its (offset, length).
+        """
+        offset = out.tell()
+        compressor = self.compressor()
+        out.write(compressor.compress(info.tobuf(tarfile.PAX_FORMAT)))
+        if f is not None:
+            remaining = info.size
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    # The file shrank; keep the header's size.
+                    chunk = b'\0' * min(CHUNK_SIZE, remaining)
+                out.write(compressor.compress(chunk))
+                remaining -= len(chunk)
+            padding = -info.size % tarfile.BLOCKSIZE
+            out.write(compressor.compress(b'\0' * padding))
+        out.write(compressor.flush())
+        return offset, out.tell() - offset
+
+    def write(self, src, ignore=None):
+        """Archive the files under src and return the index.
+
+        ignore is called like copytree's ignore argument.
+        """
+        mkdir_p(os.path.dirname(os.path.abspath(self.path)))
+        index = OrderedDict()
+        digests = {}
+        with atomic_write(self.path, 'wb') as out:
+            for rel_path in walk(src, ignore):
+                path = os.path.join(src, rel_path)
+                try:
+                    st = os.stat(path)
+                    digest = file_digest(path)
+                except (IOError, OSError) as e:
+                    # Removed, or a broken link.
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                info = tarfile.TarInfo(rel_path)
+                info.mtime = int(st.st_mtime)
+                info.mode = st.st_mode & 0o777
+                entry = OrderedDict(size=st.st_size, sha256=digest)
+                original = digests.get(digest)
+                if original is not None:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = original
+                    entry['link'] = original
+                    entry['offset'], entry['length'] = self.write_member(
+                        out, info)
+                else:
+                    digests[digest] = rel_path
+                    info.size = st.st_size
+                    with open(path, 'rb') as f:
+                        entry['offset'], entry['length'] = self.write_member(
+                            out, info, f)
+                index[rel_path] = entry
+            # The end of the archive: two zero blocks, padded to a record.
+            compressor = self.compressor()
+            out.write(compressor.compress(b'\0' * tarfile.RECORDSIZE))
+            out.write(compressor.flush())
+        write_json_atomic(
+            self.index_path, {'compression': self.compression,
+                              'files': index}, sort_keys=False)
+        return index
+
+    def load_index(self):
+        with open(self.index_path) as f:
+            return json.load(f, object_pairs_hook=OrderedDict)['files']
+
+    def read_member(self, entry):
+        """Return the uncompressed tar member of an index entry."""
+        decompressor = self.decompressor()
+        data = []
+        with open(self.path, 'rb') as f:
+            f.seek(entry['offset'])
+            remaining = entry['length']
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ValueError('{} is truncated.'.format(self.path))
+                data.append(decompressor.decompress(chunk))
+                remaining -= len(chunk)
+        return b''.join(data)
+
+    def read(self, rel_path, index=None):
+        """Return the content of the archived file rel_path."""
+        index = index or self.load_index()
+        entry = index[os.path.normpath(rel_path)]
+        if 'link' in entry:
+            entry = index[entry['link']]
+        member = io.BytesIO(self.read_member(entry))
+        with tarfile.open(fileobj=member, mode='r:') as tar:
+            info = tar.next()
+            return tar.extractfile(info).read()
+
+    def extract(self, rel_path, dst, index=None):
+        """Write the archived file rel_path to the file dst."""
+        data = self.read(rel_path, index)
+        mkdir_p(os.path.dirname(os.path.abspath(dst)))
+        with open(dst, 'wb') as f:
+            f.write(data)
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    list_parser = subparsers.add_parser(
+        'list', help='List the files in an archive.')
+    list_parser.add_argument('archive')
+    extract_parser = subparsers.add_parser(
+        'extract', help='Extract files from an archive.')
+    extract_parser.add_argument('archive')
+    extract_parser.add_argument('paths', nargs='+')
+    extract_parser.add_argument(
+        '--output-dir', default='.',
+        help='Directory to extract to, keeping the archived paths.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    archive = ResultsArchive(args.archive)
+    index = archive.load_index()
+    if args.command == 'list':
+        for rel_path, entry in index.items():
+            print('{:>10} {}'.format(entry['size'], rel_path))
+        return 0
+    for rel_path in args.paths:
+        archive.extract(rel_path, os.path.join(args.output_dir, rel_path),
+                        index)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Mirror a results directory incrementally while it is being written."""
+
+from contextlib import contextmanager
+import errno
+import logging
+import os
+import shutil
+import threading
+
+from buildcloud.utility import mkdir_p
+
+
+class ResultsMirror(object):
+    """Copy new and changed files from src to dst.
+
+    Files are compared by size and modification time, which copies
+    preserve (at least to the second), so an unchanged file is never
+    copied twice, even by a new mirror of a dst written earlier.  Files
+    removed from src since they were mirrored are removed from dst; other
+    files in dst are left alone.  ignore is called like copytree's ignore
+    argument.
+    """
+
+    def __init__(self, src, dst, ignore=None):
+        self.src = src
+        self.dst = dst
+        self.ignore = ignore
+        self.index = {}
+        self.lock = threading.Lock()
+
+    def walk(self):
+        """Yield the path of every file to mirror, relative to src."""
+        for dirpath, dirnames, filenames in os.walk(self.src):
+            ignored = set()
+            if self.ignore is not None:
+                ignored = self.ignore(dirpath, dirnames + filenames)
+            dirnames[:] = sorted(d for d in dirnames if d not in ignored)
+            rel_dir = os.path.relpath(dirpath, self.src)
+            mkdir_p(os.path.normpath(os.path.join(self.dst, rel_dir)))
+            for filename in sorted(filenames):
+                if filename not in ignored:
+                    yield os.path.normpath(os.path.join(rel_dir, filename))
+
+    def copy(self, rel_path):
+        src = os.path.join(self.src, rel_path)
+        dst = os.path.join(self.dst, rel_path)
+        tmp = '{}.{}.sync'.format(dst, os.getpid())
+        shutil.copy2(src, tmp)
+        os.rename(tmp, dst)
+
+    def sync(self):
+        """Mirror the current state of src, returning the files copied."""
+        with self.lock:
+            copied = []
+            seen = set()
+            for rel_path in self.walk():
+                try:
+                    st = os.stat(os.path.join(self.src, rel_path))
+                except OSError as e:
+                    # Removed since it was listed.
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                seen.add(rel_path)
+                key = (st.st_size, st.st_mtime)
+                if self.index.get(rel_path) == key:
+                    continue
+                if rel_path not in self.index:
+                    try:
+                        dst_st = os.stat(os.path.join(self.dst, rel_path))
+                    except OSError:
+                        dst_st = None
+                    # Copies may keep less precise modification times.
+                    if dst_st and dst_st.st_size == st.st_size and int(
+                            dst_st.st_mtime) == int(st.st_mtime):
+                        self.index[rel_path] = key
+                        continue
+                self.copy(rel_path)
+                self.index[rel_path] = key
+                copied.append(rel_path)
+            for rel_path in sorted(set(self.index) - seen):
+                del self.index[rel_path]
+                try:
+                    os.remove(os.path.join(self.dst, rel_path))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            return copied
+
+    def try_sync(self):
+        """Sync, logging a failure instead of raising it."""
+        try:
+            self.sync()
+        except (IOError, OSError) as e:
+            logging.warning('Unable to sync {} to {}: {}'.format(
+                self.src, self.dst, e))
+
+    @contextmanager
+    def running(self, interval):
+        """Sync every interval seconds in the background, and once more
+        when the context exits.
+        """
+        stopped = threading.Event()
+
+        def poll():
+            while not stopped.wait(interval):
+                self.try_sync()
+
+        thread = threading.Thread(target=poll)
+        thread.daemon = True
+        thread.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            thread.join()
+            # Never let a failed sync hide the error that ended the run.
+            self.try_sync()
@@ -1,14 +1,50 @@
 #!/usr/bin/env python
 
+from __future__ import print_function
+
 from argparse import ArgumentParser
-from collections import namedtuple
+from collections import (
+    Counter,
+    namedtuple,
+    OrderedDict,
+)
+import logging
 import os
-import yaml
+import sys
+
+from buildcloud.build_tracker import (
+    BuildTracker,
+    DONE,
+)
+from buildcloud.jenkins_client import JenkinsClient
+from buildcloud.manifest import (
+    DEFAULT_MANIFEST_PATH,
+    job_fingerprint,
+    ResultsManifest,
+)
+from buildcloud.plans import (
+    DEFAULT_CACHE_PATH,
+    load_test_plan,
+    TestPlanIndex,
+)
+from buildcloud.scheduling import (
+    assign_jobs,
+    Assignment,
+    DEFAULT_HISTORY_PATH,
+    DEFAULT_QUEUE_HISTORY_PATH,
+    DurationHistory,
+    format_assignments,
+    format_duration,
+)
+from buildcloud.utility import run_concurrently
 
-from jenkins import Jenkins
 
+JENKINS_URL = 'http://juju-ci.vapour.ws:8080'
 
 Credentials = namedtuple('Credentials', ['user', 'password'])
+Submission = namedtuple('Submission', ['job', 'queue_url', 'error'])
+
+SCHEDULES = ('all', 'per-controller', 'balanced')
 
 
 def parse_args(argv=None):
@@ -28,19 +64,89 @@ def parse_args(argv=None):
         help='List of test plan files.  Instead of scheduling all the tests, '
              'this can be use to restrict the test plan files. If this is '
              'not set, all the test will be scheduled.')
+    parser.add_argument('--jenkins-url', default=JENKINS_URL)
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of jobs to submit concurrently.')
+    parser.add_argument(
+        '--retries', type=int, default=3,
+        help='Number of times to retry a failed submission.')
+    parser.add_argument(
+        '--rate-limit', type=float, default=None,
+        help='Maximum number of Jenkins requests per second.')
+    parser.add_argument(
+        '--plan-cache', default=DEFAULT_CACHE_PATH,
+        help='File to cache parsed test plans in.  Set to an empty string '
+             'to disable the cache.')
+    parser.add_argument(
+        '--parse-workers', type=int, default=1,
+        help='Number of processes used to parse changed test plans.')
+    parser.add_argument(
+        '--results-manifest', default=DEFAULT_MANIFEST_PATH,
+        help='File recording successful runs.  Test plans whose content, '
+             'bundle and controllers are unchanged since a recent '
+             'successful run are skipped.')
+    parser.add_argument(
+        '--max-age', type=float, default=24 * 60 * 60,
+        help='Seconds for which a successful run is considered recent.')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Schedule every test plan, even ones with a recent '
+             'successful run.')
+    parser.add_argument(
+        '--schedule', choices=SCHEDULES, default='all',
+        help='all: run every plan on all controllers in one job (default). '
+             'per-controller: one job per plan and controller, ordered to '
+             'minimise the estimated makespan. balanced: run every plan '
+             'once, on the controller that minimises the makespan.')
+    parser.add_argument(
+        '--max-per-controller', type=int,
+        help='Number of jobs that may be queued or running on a controller '
+             'at once.  Later jobs are submitted as earlier ones finish, '
+             'in the planned order.  No limit by default, in which case '
+             'jobs are planned as if each controller ran one at a time.')
+    parser.add_argument(
+        '--duration-history', default=DEFAULT_HISTORY_PATH,
+        help='File with the recorded durations of previous runs.')
+    parser.add_argument(
+        '--queue-history', default=DEFAULT_QUEUE_HISTORY_PATH,
+        help='File with the recorded time previous jobs waited in the '
+             'Jenkins queue, which is added to the estimated durations.')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Print the planned jobs and estimated completion time '
+             'without submitting them.')
+    parser.add_argument(
+        '--wait', action='store_true',
+        help='Follow the submitted jobs until they finish, report their '
+             'results and record their queue and run durations.  Exit '
+             'with an error unless they all passed.')
+    parser.add_argument(
+        '--poll-interval', type=float, default=5,
+        help='Seconds between polls of Jenkins after a job changes state.')
+    parser.add_argument(
+        '--max-poll-interval', type=float, default=60,
+        help='Seconds between polls of Jenkins once nothing has changed '
+             'for a while.')
+    parser.add_argument(
+        '--wait-timeout', type=float, default=None,
+        help='Seconds to wait for the jobs before reporting them as they '
+             'are.')
     args = parser.parse_args(argv)
-    if not args.cwr_test_token:
+    if args.max_per_controller is not None and args.max_per_controller < 1:
+        parser.error('--max-per-controller must be at least 1.')
+    if not args.cwr_test_token and not args.dry_run:
         parser.error("Please set the cwr-test Jenkins job token by "
                      "exporting the CWR_TEST_TOKEN environment variable.")
     return args
 
 
-def make_parameters(test_plan, args):
-    with open(test_plan, 'r') as f:
-        plan = yaml.load(f)
+def make_parameters(test_plan, args, plan=None, controllers=None):
+    if plan is None:
+        plan = load_test_plan(test_plan)
     parameters = {
         'test_plan': test_plan,
-        'controllers': " ".join(args.controllers),
+        'controllers': " ".join(controllers or args.controllers),
         'bundle_name': plan['bundle_name'],
         'bundle_file': plan.get('bundle_file')
     }
@@ -49,13 +155,71 @@ def make_parameters(test_plan, args):
     return parameters
 
 
-def make_jobs(args):
-    test_plans = args.test_plans or os.listdir(args.test_plan_dir)
-    for test_plan in test_plans:
-        if not test_plan.endswith('.yaml'):
-            continue
-        test_plan = os.path.join(args.test_plan_dir, test_plan)
-        yield make_parameters(test_plan, args)
+def load_test_plans(args):
+    """Load and validate every test plan to schedule.
+
+    All the plans are loaded first, so a malformed plan fails before
+    anything is submitted.
+    """
+    test_plans = args.test_plans or sorted(os.listdir(args.test_plan_dir))
+    test_plans = [os.path.join(args.test_plan_dir, test_plan)
+                  for test_plan in test_plans if test_plan.endswith('.yaml')]
+    index = TestPlanIndex(args.plan_cache, args.parse_workers)
+    return index.load(test_plans)
+
+
+def plan_jobs(args, test_plans):
+    """Return the jobs to submit as a list of Assignment.
+
+    With the "all" schedule every job runs on all the controllers; the
+    Assignment controller is then None and there is no estimated start or
+    duration.
+    """
+    recent = set()
+    if args.results_manifest and not args.force:
+        recent = ResultsManifest(args.results_manifest).recent(args.max_age)
+
+    def passed(test_plan, controllers):
+        return job_fingerprint(
+            test_plan.sha256, test_plan.data, controllers) in recent
+
+    jobs = []
+    for test_plan in test_plans.values():
+        if args.schedule == 'per-controller':
+            choices = [[c] for c in args.controllers]
+        else:
+            choices = [args.controllers]
+        for controllers in choices:
+            if passed(test_plan, controllers) or (
+                    args.schedule == 'balanced' and
+                    any(passed(test_plan, [c]) for c in controllers)):
+                logging.info('Skipping {} on {}: unchanged since its last '
+                             'successful run.'.format(
+                                 test_plan.path, ' '.join(controllers)))
+                continue
+            jobs.append((test_plan.path, controllers))
+    if args.schedule == 'all':
+        return [Assignment(job, None, None, None) for job in jobs]
+    run_estimate = DurationHistory(args.duration_history).estimator()
+    queue_estimate = DurationHistory(args.queue_history).estimator(default=0)
+
+    def estimate(test_plan, controller):
+        return (run_estimate(test_plan, controller) +
+                queue_estimate(test_plan, controller))
+
+    return assign_jobs(jobs, estimate, args.max_per_controller or 1)
+
+
+def make_jobs(args, test_plans=None):
+    """Yield the job parameters for every test plan to schedule."""
+    if test_plans is None:
+        test_plans = load_test_plans(args)
+    for assignment in plan_jobs(args, test_plans):
+        test_plan, controllers = assignment.job
+        if assignment.controller:
+            controllers = [assignment.controller]
+        yield make_parameters(
+            test_plan, args, test_plans[test_plan].data, controllers)
 
 
 def get_credentials(args):
@@ -65,17 +229,192 @@ def get_credentials(args):
     return Credentials(args.user, args.password)
 
 
-def build_jobs(credentials, jobs, args):
-    jenkins = Jenkins('http://juju-ci.vapour.ws:8080', *credentials)
-    for job in jobs:
-        jenkins.build_job('cwr-test', job, token=args.cwr_test_token)
+def make_client(credentials, args):
+    return JenkinsClient(
+        args.jenkins_url, credentials, pool_size=args.workers,
+        retries=args.retries, rate=args.rate_limit)
+
+
+def make_tracker(credentials, args):
+    return BuildTracker(
+        make_client(credentials, args), 'cwr-test',
+        min_interval=args.poll_interval,
+        max_interval=args.max_poll_interval)
+
+
+def submit_jobs(client, jobs, args):
+    """Submit jobs concurrently and return a Submission for each job."""
+    queue_urls = {}
+
+    def submit(index):
+        queue_urls[index] = client.build_job(
+            'cwr-test', jobs[index], token=args.cwr_test_token)
+
+    errors = run_concurrently(submit, range(len(jobs)), args.workers)
+    return [Submission(job, queue_urls.get(i), errors.get(i))
+            for i, job in enumerate(jobs)]
+
+
+def build_jobs(credentials, jobs, args, tracker=None):
+    """Submit jobs and return a Submission for each job, in order.
+
+    With args.max_per_controller, a job is only submitted while fewer
+    than that many builds are pending on each of its controllers; the
+    rest are submitted, in order, as the tracker sees builds finish.  The
+    queued builds are added to the tracker, by default a new one.
+    """
+    jobs = list(jobs)
+    limit = args.max_per_controller
+    if limit is None:
+        submissions = submit_jobs(make_client(credentials, args), jobs, args)
+        if tracker is not None:
+            for submission in submissions:
+                if submission.queue_url:
+                    tracker.add(submission.queue_url, submission.job)
+        return submissions
+    tracker = tracker or make_tracker(credentials, args)
+    submitted = {}
+    waiting = list(range(len(jobs)))
+    while waiting:
+        busy = Counter(c for b in tracker.pending()
+                       for c in b.job['controllers'].split())
+        ready = []
+        for index in waiting:
+            controllers = jobs[index]['controllers'].split()
+            if all(busy[c] < limit for c in controllers):
+                busy.update(controllers)
+                ready.append(index)
+        if not ready:
+            logging.info('{} jobs wait for a controller.'.format(
+                len(waiting)))
+            count = len(tracker.pending())
+            tracker.wait(until=lambda: len(tracker.pending()) < count)
+            continue
+        waiting = [i for i in waiting if i not in ready]
+        for index, submission in zip(ready, submit_jobs(
+                tracker.client, [jobs[i] for i in ready], args)):
+            submitted[index] = submission
+            if submission.queue_url:
+                tracker.add(submission.queue_url, submission.job)
+    return [submitted[i] for i in range(len(jobs))]
+
+
+def format_report(submissions):
+    lines = []
+    for submission in submissions:
+        status = ('FAILED: {}'.format(submission.error) if submission.error
+                  else 'queued {}'.format(submission.queue_url))
+        lines.append('{} [{}] {}'.format(
+            submission.job['test_plan'], submission.job['controllers'],
+            status))
+    failed = len([s for s in submissions if s.error])
+    lines.append('Submitted {} of {} jobs.'.format(
+        len(submissions) - failed, len(submissions)))
+    return '\n'.join(lines)
+
+
+def record_builds(args, builds, test_plans):
+    """Record the queue waits of the builds that started, and the run
+    durations and fingerprints of the ones that passed.
+
+    Durations are recorded for each controller of a job, as build_cloud
+    does.
+    """
+    manifest = None
+    if args.results_manifest:
+        manifest = ResultsManifest(args.results_manifest)
+    for build in builds:
+        test_plan = build.job['test_plan']
+        controllers = build.job['controllers'].split()
+        if build.queue_wait is not None and args.queue_history:
+            history = DurationHistory(args.queue_history)
+            for controller in controllers:
+                history.record(test_plan, controller, build.queue_wait)
+        if not build.passed:
+            continue
+        if args.duration_history:
+            history = DurationHistory(args.duration_history)
+            for controller in controllers:
+                history.record(test_plan, controller, build.duration)
+        if manifest is not None and test_plan in test_plans:
+            plan = test_plans[test_plan]
+            manifest.record_success(
+                job_fingerprint(plan.sha256, plan.data, controllers),
+                test_plan)
+
+
+def summarize_builds(builds, key):
+    """Return lines totalling the builds grouped by key(build)."""
+    groups = OrderedDict()
+    for build in builds:
+        for name in key(build):
+            groups.setdefault(name, []).append(build)
+    lines = []
+    for name, group in groups.items():
+        passed = len([b for b in group if b.passed])
+        failed = len([b for b in group if b.state == DONE]) - passed
+        waits = [b.queue_wait for b in group if b.queue_wait is not None]
+        durations = [b.duration for b in group if b.duration is not None]
+        lines.append('{:<30} {:>6} {:>6} {:>6} {:>10} {:>10}'.format(
+            name, passed, failed, len(group) - passed - failed,
+            format_duration(max(waits)) if waits else '-',
+            format_duration(sum(durations))))
+    return lines
+
+
+def format_results(builds):
+    header = '{:<30} {:>6} {:>6} {:>6} {:>10} {:>10}'
+    lines = []
+    for build in builds:
+        lines.append('{} [{}] {}{}'.format(
+            build.job['test_plan'], build.job['controllers'], build.status,
+            ' #{}'.format(build.number) if build.number else ''))
+        if build.queue_wait is not None:
+            lines[-1] += ', queued {}'.format(
+                format_duration(build.queue_wait))
+        if build.duration is not None:
+            lines[-1] += ', ran {}'.format(format_duration(build.duration))
+    for title, key in (
+            ('test plan', lambda b: [b.job['test_plan']]),
+            ('controller', lambda b: b.job['controllers'].split())):
+        lines.append(header.format(
+            title, 'passed', 'failed', 'other', 'max queue', 'run time'))
+        lines.extend(summarize_builds(builds, key))
+    finished = [b.started + b.duration for b in builds
+                if b.duration is not None]
+    passed = len([b for b in builds if b.passed])
+    summary = 'Passed {} of {} builds'.format(passed, len(builds))
+    if finished:
+        summary += ' in {}'.format(format_duration(
+            max(finished) - min(b.in_queue_since for b in builds)))
+    lines.append(summary + '.')
+    return '\n'.join(lines)
 
 
 def main():
     args = parse_args()
+    if args.dry_run:
+        assignments = plan_jobs(args, load_test_plans(args))
+        if args.schedule == 'all':
+            for test_plan, controllers in (a.job for a in assignments):
+                print('{} [{}]'.format(test_plan, ' '.join(controllers)))
+        else:
+            print(format_assignments(assignments))
+        return
     credentials = get_credentials(args)
-    jobs = make_jobs(args)
-    build_jobs(credentials, jobs, args)
+    test_plans = load_test_plans(args)
+    jobs = make_jobs(args, test_plans)
+    tracker = make_tracker(credentials, args)
+    submissions = build_jobs(credentials, jobs, args, tracker)
+    print(format_report(submissions))
+    failed = any(s.error for s in submissions)
+    if args.wait:
+        builds = tracker.wait(args.wait_timeout)
+        record_builds(args, builds, test_plans)
+        print(format_results(builds))
+        failed = failed or not all(b.passed for b in builds)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
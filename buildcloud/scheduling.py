@@ -0,0 +1,125 @@
+"""Plan job order and controller assignment from historical durations."""
+
+from collections import namedtuple
+import os
+
+from buildcloud.utility import (
+    file_lock,
+    load_json,
+    mkdir_p,
+    write_json_atomic,
+)
+
+
+DEFAULT_HISTORY_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'durations.json')
+DEFAULT_QUEUE_HISTORY_PATH = os.path.join(
+    os.path.expanduser('~'), '.cache', 'buildcloud', 'queue-waits.json')
+
+# Estimated seconds for a test plan that has never run anywhere.
+DEFAULT_DURATION = 3600
+
+Assignment = namedtuple(
+    'Assignment', ['job', 'controller', 'start', 'duration'])
+
+
+def plan_key(test_plan):
+    """Identify a test plan independently of where it is checked out."""
+    return os.path.basename(test_plan)
+
+
+class DurationHistory(object):
+    """Recent run durations per test plan and controller.
+
+    The file maps a test plan name to a mapping of controller to the last
+    samples durations, in seconds.
+    """
+
+    def __init__(self, path=DEFAULT_HISTORY_PATH, samples=10):
+        self.path = path
+        self.samples = samples
+
+    def load(self):
+        return load_json(self.path)
+
+    def record(self, test_plan, controller, duration):
+        mkdir_p(os.path.dirname(self.path))
+        with file_lock(self.path + '.lock'):
+            history = self.load()
+            durations = history.setdefault(
+                plan_key(test_plan), {}).setdefault(controller, [])
+            durations.append(duration)
+            del durations[:-self.samples]
+            write_json_atomic(self.path, history)
+
+    def estimator(self, default=DEFAULT_DURATION):
+        """Return a function estimating the duration of a plan on a controller.
+
+        The estimate is the mean duration of the plan on that controller,
+        falling back to its mean on any controller and then to default.
+        """
+        history = self.load()
+
+        def estimate(test_plan, controller):
+            durations = history.get(plan_key(test_plan), {})
+            samples = durations.get(controller)
+            if not samples:
+                samples = [d for ds in durations.values() for d in ds]
+            if not samples:
+                return default
+            return float(sum(samples)) / len(samples)
+
+        return estimate
+
+
+def assign_jobs(jobs, estimate, slots_per_controller=1):
+    """Assign jobs to controllers to minimise the estimated makespan.
+
+    jobs is a list of (test_plan, controllers) pairs, where controllers
+    are the ones the job may run on.  The estimate assumes that each
+    controller runs slots_per_controller jobs at once; Jenkins decides
+    how many actually do.  Jobs are placed longest first on the
+    controller where they would finish earliest (the LPT heuristic).
+
+    Return a list of Assignment sorted by estimated start time.
+    """
+    slots = {}
+    for _, controllers in jobs:
+        for controller in controllers:
+            slots.setdefault(controller, [0.0] * slots_per_controller)
+    by_length = sorted(
+        jobs, key=lambda job: -max(estimate(job[0], c) for c in job[1]))
+    assignments = []
+    for job in by_length:
+        test_plan, controllers = job
+        finish, controller = min(
+            (min(slots[c]) + estimate(test_plan, c), c) for c in controllers)
+        free = slots[controller]
+        slot = free.index(min(free))
+        start = free[slot]
+        free[slot] = finish
+        assignments.append(
+            Assignment(job, controller, start, finish - start))
+    return sorted(assignments, key=lambda a: (a.start, a.controller))
+
+
+def makespan(assignments):
+    return max([a.start + a.duration for a in assignments] or [0])
+
+
+def format_assignments(assignments):
+    lines = ['{:>10} {:>10}  {:<20} {}'.format(
+        'start', 'duration', 'controller', 'test plan')]
+    for a in assignments:
+        lines.append('{:>10} {:>10}  {:<20} {}'.format(
+            format_duration(a.start), format_duration(a.duration),
+            a.controller, a.job[0]))
+    lines.append('Estimated completion: {}'.format(
+        format_duration(makespan(assignments))))
+    return '\n'.join(lines)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""Benchmark the orchestration of build_cloud jobs with a fake backend."""
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+import logging
+import os
+import sys
+import time
+
+import yaml
+
+from buildcloud.backends import FakeBackend
+from buildcloud.build_cloud import (
+    job_graph,
+    parse_args as parse_job_args,
+)
+from buildcloud.timing import timer
+from buildcloud.utility import (
+    configure_logging,
+    run_concurrently,
+    temp_dir,
+)
+
+
+def parse_rates(values, parser):
+    """Parse OPERATION=NUMBER values into a dict."""
+    rates = {}
+    for value in values:
+        operation, _, number = value.partition('=')
+        try:
+            rates[operation] = float(number)
+        except ValueError:
+            parser.error('Expected OPERATION=NUMBER, not {!r}'.format(value))
+    return rates
+
+
+def parse_args(argv=None):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--jobs', type=int, default=200, help='Number of jobs to simulate.')
+    parser.add_argument(
+        '--workers', type=int, default=20,
+        help='Number of jobs to run concurrently.')
+    parser.add_argument(
+        '--models', type=int, default=2,
+        help='Number of models each job bootstraps.')
+    parser.add_argument(
+        '--plans', type=int, default=1,
+        help='Number of test plans each job runs.')
+    parser.add_argument('--bootstrap-workers', type=int, default=1)
+    parser.add_argument('--plan-workers', type=int, default=1)
+    parser.add_argument('--snapshot-juju-home', action='store_true')
+    parser.add_argument('--live-sync', action='store_true')
+    parser.add_argument('--per-model-containers', action='store_true')
+    parser.add_argument('--archive-results', action='store_true')
+    parser.add_argument('--max-bootstraps', type=int)
+    parser.add_argument('--max-controller-bootstraps', type=int)
+    parser.add_argument('--max-containers', type=int)
+    parser.add_argument('--max-controller-containers', type=int)
+    parser.add_argument(
+        '--latency', action='append', default=[], metavar='OPERATION=SECS',
+        help='Simulated seconds an operation (e.g. bootstrap, '
+             'run_container) takes.  May be repeated.')
+    parser.add_argument(
+        '--failure', action='append', default=[], metavar='OPERATION=P',
+        help='Probability that an operation fails.  May be repeated.')
+    parser.add_argument(
+        '--jitter', type=float, default=0.0,
+        help='Vary latencies by up to this fraction.')
+    parser.add_argument(
+        '--result-size', type=int, default=1024,
+        help='Bytes of results each container run writes.')
+    parser.add_argument('--seed', type=int, help='Seed for the jitter and '
+                        'failures.')
+    parser.add_argument('--verbose', action='count', default=0)
+    args = parser.parse_args(argv)
+    args.latency = parse_rates(args.latency, parser)
+    args.failure = parse_rates(args.failure, parser)
+    return args
+
+
+def make_fixture(root, models, plans):
+    """Create a juju home and test plans for the simulated jobs.
+
+    Return the juju home and the test plan paths.
+    """
+    juju_home = os.path.join(root, 'juju_home')
+    os.mkdir(juju_home)
+    with open(os.path.join(juju_home, 'environments.yaml'), 'w') as f:
+        yaml.safe_dump({'environments': dict(
+            (model, {'type': 'fake'}) for model in models)}, f)
+    with open(os.path.join(juju_home, 'staging-juju-rsa'), 'w') as f:
+        f.write('fake key\n')
+    plan_dir = os.path.join(root, 'test_plans')
+    os.mkdir(plan_dir)
+    test_plans = []
+    for i in range(plans):
+        test_plan = os.path.join(plan_dir, 'plan-{}.yaml'.format(i))
+        with open(test_plan, 'w') as f:
+            yaml.safe_dump({'bundle': 'cs:fake-{}'.format(i),
+                            'bundle_name': 'fake-{}'.format(i),
+                            'services': ['fake-{}'.format(i)]}, f)
+        test_plans.append(test_plan)
+    return juju_home, test_plans
+
+
+def run_job(index, backend, juju_home, test_plans, log_root, lock_dir,
+            args):
+    """Run one build_cloud job against backend."""
+    models = ['model-{}'.format(i) for i in range(args.models)]
+    argv = models + [test_plans[0], '--juju-home', juju_home,
+                     '--log-dir', os.path.join(log_root, str(index)),
+                     '--host-locks', lock_dir,
+                     '--bootstrap-workers', str(args.bootstrap_workers),
+                     '--plan-workers', str(args.plan_workers),
+                     '--sync-interval', '0.05']
+    if test_plans[1:]:
+        argv += ['--test-plans'] + test_plans[1:]
+    if args.snapshot_juju_home:
+        argv.append('--snapshot-juju-home')
+    if args.live_sync:
+        argv.append('--live-sync')
+    if args.per_model_containers:
+        argv.append('--per-model-containers')
+    if args.archive_results:
+        argv.append('--archive-results')
+    for option in ('max_bootstraps', 'max_controller_bootstraps',
+                   'max_containers', 'max_controller_containers'):
+        if getattr(args, option):
+            argv += ['--' + option.replace('_', '-'),
+                     str(getattr(args, option))]
+    job_args = parse_job_args(argv)
+    results = job_graph(job_args, test_plans, backend).run()['run']
+    errors = [error for error, _ in results.values() if error]
+    if errors:
+        raise errors[0]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def simulate(args):
+    """Run args.jobs simulated jobs and return (backend, durations, errors).
+
+    durations and errors map each job index to its duration and error.
+    """
+    backend = FakeBackend(args.latency, args.failure, args.jitter,
+                          args.result_size, args.seed)
+    durations = {}
+    with temp_dir() as root:
+        juju_home, test_plans = make_fixture(
+            root, ['model-{}'.format(i) for i in range(args.models)],
+            args.plans)
+        log_root = os.path.join(root, 'logs')
+        lock_dir = os.path.join(root, 'locks')
+
+        def job(index):
+            start = time.time()
+            try:
+                run_job(index, backend, juju_home, test_plans, log_root,
+                        lock_dir, args)
+            finally:
+                durations[index] = time.time() - start
+
+        errors = run_concurrently(job, range(args.jobs), args.workers)
+    return backend, durations, errors
+
+
+def format_report(args, backend, durations, errors, wall):
+    times = list(durations.values())
+    lines = [
+        'Jobs: {} ({} failed), {} at a time'.format(
+            len(times), len([e for e in errors.values() if e]),
+            args.workers),
+        'Wall clock: {:.2f}s, {:.1f} jobs/s'.format(
+            wall, len(times) / wall if wall else 0),
+        'Job duration: mean {:.3f}s, p50 {:.3f}s, p95 {:.3f}s, '
+        'max {:.3f}s'.format(
+            sum(times) / len(times), percentile(times, 0.5),
+            percentile(times, 0.95), max(times)),
+        'Peak concurrency: {}'.format(', '.join(
+            '{} {}'.format(op, n)
+            for op, n in sorted(backend.max_concurrent.items()))),
+        '',
+        timer.format_summary()]
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_logging(
+        max(logging.CRITICAL - args.verbose * 10, logging.DEBUG))
+    timer.reset()
+    start = time.time()
+    backend, durations, errors = simulate(args)
+    wall = time.time() - start
+    print(format_report(args, backend, durations, errors, wall))
+    return 1 if any(errors.values()) and not args.failure else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""Run the steps of a job as a graph of dependent tasks."""
+
+from collections import (
+    namedtuple,
+    OrderedDict,
+)
+import logging
+import threading
+import time
+
+try:
+    from Queue import (
+        Empty,
+        Queue,
+    )
+except ImportError:
+    from queue import (
+        Empty,
+        Queue,
+    )
+
+
+Task = namedtuple('Task', ['name', 'func', 'requires', 'context'])
+
+TaskTime = namedtuple('TaskTime', ['name', 'start', 'end'])
+
+
+class TaskGraph(object):
+    """Tasks that run as soon as the tasks they require have finished.
+
+    A task is called with the results of the tasks it requires, in
+    order.  A context task returns a context manager, which is entered
+    when the task runs and whose value is the task's result; it is
+    exited after every task has finished, or failed, in the reverse
+    order of entry, so a context is always exited before the contexts it
+    depends on.
+
+    Tasks run in threads, at most workers at a time (no limit by
+    default).  After a task fails, or the run is interrupted, no more
+    tasks are started; the running ones are waited for before the
+    contexts are exited and the first error is raised.
+    """
+
+    # How often run() wakes while waiting for tasks, so that it can be
+    # interrupted.
+    poll_interval = 1
+
+    def __init__(self):
+        self.tasks = OrderedDict()
+        self.results = {}
+        self.times = OrderedDict()
+        self.lock = threading.Lock()
+        self.entered = []
+
+    def add(self, name, func, requires=(), context=False):
+        """Add a task, which may only require tasks that were added before.
+        """
+        if name in self.tasks:
+            raise ValueError('Duplicate task {}'.format(name))
+        for required in requires:
+            if required not in self.tasks:
+                raise ValueError('{} requires unknown task {}'.format(
+                    name, required))
+        self.tasks[name] = Task(name, func, tuple(requires), context)
+
+    def run_task(self, task, done):
+        start = time.time()
+        error = None
+        try:
+            args = [self.results[r] for r in task.requires]
+            if task.context:
+                manager = task.func(*args)
+                result = manager.__enter__()
+                with self.lock:
+                    self.entered.append((task.name, manager))
+            else:
+                result = task.func(*args)
+            with self.lock:
+                self.results[task.name] = result
+        except BaseException as e:
+            logging.debug('Task {} failed.'.format(task.name), exc_info=True)
+            error = e
+        with self.lock:
+            self.times[task.name] = TaskTime(task.name, start, time.time())
+        done.put((task.name, error))
+
+    def run(self, workers=None):
+        """Run every task and return the results keyed by task name."""
+        pending = OrderedDict(self.tasks)
+        done = Queue()
+        running = set()
+        error = None
+        try:
+            try:
+                while True:
+                    self.start_tasks(pending, running, done, workers)
+                    if not running:
+                        break
+                    name, task_error = self.wait_task(done)
+                    if name is None:
+                        continue
+                    running.discard(name)
+                    if task_error is not None and error is None:
+                        logging.error('{} failed: {}'.format(
+                            name, task_error))
+                        error = task_error
+                        pending.clear()
+            except BaseException as e:
+                # Interrupted: tasks may still be entering contexts, so
+                # they must finish before the contexts are exited.
+                logging.error('Interrupted; waiting for {}.'.format(
+                    ', '.join(sorted(running))))
+                pending.clear()
+                error = e
+                while running:
+                    name, task_error = self.wait_task(done)
+                    running.discard(name)
+        finally:
+            error = self.exit_contexts(error)
+        if error is not None:
+            raise error
+        return dict(self.results)
+
+    def start_tasks(self, pending, running, done, workers):
+        """Start the pending tasks whose required tasks have finished."""
+        for name, task in list(pending.items()):
+            if workers is not None and len(running) >= workers:
+                break
+            if all(r in self.results for r in task.requires):
+                del pending[name]
+                running.add(name)
+                thread = threading.Thread(
+                    target=self.run_task, args=(task, done), name=name)
+                thread.daemon = True
+                thread.start()
+
+    def wait_task(self, done):
+        """Return the (name, error) of the next task to finish.
+
+        The wait is bounded by poll_interval so that a KeyboardInterrupt
+        is seen; (None, None) is returned when no task finished.
+        """
+        try:
+            return done.get(timeout=self.poll_interval)
+        except Empty:
+            return None, None
+
+    def exit_contexts(self, error):
+        """Exit the entered contexts, returning the first error."""
+        exc_info = (None, None, None)
+        if error is not None:
+            exc_info = (type(error), error, None)
+        while self.entered:
+            name, manager = self.entered.pop()
+            try:
+                manager.__exit__(*exc_info)
+            except BaseException as e:
+                if e is error:
+                    continue
+                logging.error('Cleaning up {} failed: {}'.format(name, e))
+                if error is None:
+                    error = e
+                    exc_info = (type(e), e, None)
+        return error
+
+    def critical_path(self):
+        """Return the TaskTimes of the chain of tasks that ended last.
+
+        Starting from the task that finished last, each step is to the
+        required task that finished last.
+        """
+        path = []
+        names = [n for n in self.times if n in self.results]
+        while names:
+            name = max(names, key=lambda n: self.times[n].end)
+            path.append(self.times[name])
+            names = list(self.tasks[name].requires)
+        return list(reversed(path))
+
+
+def format_critical_path(path):
+    lines = ['Critical path:']
+    for step in path:
+        lines.append('  {:<24} {:>9.1f}s'.format(
+            step.name, step.end - step.start))
+    if path:
+        lines.append('  {:<24} {:>9.1f}s'.format(
+            'total', path[-1].end - path[0].start))
+    return '\n'.join(lines)
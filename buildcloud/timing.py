@@ -0,0 +1,136 @@
+"""Time the phases of a job and report where the time went."""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+
+class Phase(object):
+
+    def __init__(self, name, start, thread, attrs):
+        self.name = name
+        self.start = start
+        self.end = None
+        self.thread = thread
+        self.attrs = attrs
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def to_dict(self):
+        return {'phase': self.name, 'start': self.start,
+                'duration': self.duration, 'thread': self.thread,
+                'attrs': self.attrs, 'error': self.error}
+
+
+class PhaseTimer(object):
+    """Record named, possibly nested and concurrent, phases of a job.
+
+    Each phase records its start, duration, thread and any attributes
+    (e.g. the model being bootstrapped), and whether it raised.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = []
+
+    def reset(self):
+        with self.lock:
+            del self.phases[:]
+
+    @contextmanager
+    def phase(self, name, **attrs):
+        phase = Phase(name, time.time(), threading.current_thread().name,
+                      attrs)
+        with self.lock:
+            self.phases.append(phase)
+        try:
+            yield phase
+        except BaseException as e:
+            phase.error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            phase.end = time.time()
+
+    def write_jsonl(self, path):
+        """Write one JSON object per phase to path."""
+        with self.lock:
+            phases = list(self.phases)
+        with open(path, 'w') as f:
+            for phase in phases:
+                f.write(json.dumps(phase.to_dict(), sort_keys=True) + '\n')
+
+    def write_chrome_trace(self, path):
+        """Write the phases to path in the Chrome trace event format.
+
+        The file can be opened in chrome://tracing or Perfetto.
+        """
+        with self.lock:
+            phases = list(self.phases)
+        pid = os.getpid()
+        tids = {}
+        events = []
+        for phase in phases:
+            if phase.thread not in tids:
+                tids[phase.thread] = len(tids) + 1
+                events.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                    'tid': tids[phase.thread],
+                    'args': {'name': phase.thread}})
+            args = dict(phase.attrs)
+            if phase.error:
+                args['error'] = phase.error
+            events.append({
+                'name': phase.name, 'cat': 'buildcloud', 'ph': 'X',
+                'pid': pid, 'tid': tids[phase.thread],
+                'ts': int(phase.start * 1e6),
+                'dur': int(phase.duration * 1e6), 'args': args})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        """Return (name, count, total, longest, errors) per phase name.
+
+        Names are in the order their first phase started.
+        """
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p.start)
+        rows = {}
+        order = []
+        for phase in phases:
+            if phase.name not in rows:
+                order.append(phase.name)
+                rows[phase.name] = [0, 0.0, 0.0, 0]
+            row = rows[phase.name]
+            row[0] += 1
+            row[1] += phase.duration
+            row[2] = max(row[2], phase.duration)
+            row[3] += 1 if phase.error else 0
+        return [tuple([name] + rows[name]) for name in order]
+
+    def format_summary(self):
+        lines = ['{:<24} {:>5} {:>10} {:>10} {:>6}'.format(
+            'phase', 'count', 'total', 'longest', 'errors')]
+        for name, count, total, longest, errors in self.summary():
+            lines.append('{:<24} {:>5} {:>9.1f}s {:>9.1f}s {:>6}'.format(
+                name, count, total, longest, errors))
+        with self.lock:
+            phases = list(self.phases)
+        if phases:
+            wall = (max(p.start + p.duration for p in phases) -
+                    min(p.start for p in phases))
+            lines.append('Wall clock: {:.1f}s'.format(wall))
+        return '\n'.join(lines)
+
+
+# The timer for this process's job.
+timer = PhaseTimer()
+
+
+def phase(name, **attrs):
+    """Time a phase of the job with the process's timer."""
+    return timer.phase(name, **attrs)
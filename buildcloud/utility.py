@@ -1,18 +1,43 @@
 from __future__ import print_function
 
+from collections import (
+    deque,
+    OrderedDict,
+)
 from contextlib import contextmanager
 import errno
+import fcntl
+import json
 import logging
 import os
+import re
+import select
 from shutil import (
+    copy2,
     copytree,
     rmtree,
 )
 import subprocess
 import sys
-from tempfile import mkdtemp
+from tempfile import (
+    mkdtemp,
+    NamedTemporaryFile,
+)
+import threading
+import time
 import yaml
 
+try:
+    from Queue import (
+        Empty,
+        Queue,
+    )
+except ImportError:
+    from queue import (
+        Empty,
+        Queue,
+    )
+
 
 @contextmanager
 def temp_dir(parent=None):
@@ -23,6 +48,49 @@ def temp_dir(parent=None):
         rmtree(directory)
 
 
+@contextmanager
+def file_lock(path, shared=False):
+    """Hold an flock() on path, creating the file if needed."""
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """Write path through a temporary file renamed over it, so that
+    readers never see a partial file.
+    """
+    tmp_path = '{}.{}.{}.tmp'.format(
+        path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    os.rename(tmp_path, path)
+
+
+def load_json(path, default=None):
+    """Return the JSON in path, or default (an empty dict) if it is
+    missing or unreadable.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {} if default is None else default
+
+
+def write_json_atomic(path, data, indent=2, sort_keys=True):
+    with atomic_write(path) as f:
+        json.dump(data, f, indent=indent, sort_keys=sort_keys)
+
+
 def configure_logging(log_level):
     logging.basicConfig(
         level=log_level, format='%(asctime)s %(levelname)s %(message)s',
@@ -39,23 +107,344 @@ def ensure_dir(path, parent=None):
             raise
 
 
-def run_command(command, verbose=True):
-    """Execute a command and maybe print the output."""
+def mkdir_p(path):
+    """Create path and any missing parents, ignoring existing dirs."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+OUTPUT_TAIL_LINES = 100
+# The subdirectory of the log directory holding the log of each command.
+COMMAND_LOG_DIR = 'commands'
+LOG_LEVELS = {
+    'TRACE': 5, 'DEBUG': logging.DEBUG, 'INFO': logging.INFO,
+    'WARN': logging.WARNING, 'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR, 'CRITICAL': logging.CRITICAL,
+}
+
+
+def log_level(line):
+    """Return the level of a log line, named in its first words, or None.
+    """
+    for word in line.split(None, 4)[:4]:
+        level = LOG_LEVELS.get(word.strip('[]:'))
+        if level is not None:
+            return level
+    return None
+
+
+class CommandOutput(object):
+    """Where run_commands sends the output of the commands.
+
+    Without a log_dir every line is printed.  With one, the full output of
+    each command is written to a file in log_dir/commands, and only the
+    lines at level or above are printed (a line that names no level has
+    the level of the line before it), at most rate lines a second across
+    all commands.  Each command keeps its last tail_lines lines, which
+    are printed if it fails.
+    """
+
+    def __init__(self, log_dir=None, level=logging.INFO, rate=20,
+                 tail_lines=OUTPUT_TAIL_LINES):
+        self.log_dir = log_dir
+        self.level = level
+        self.rate = rate
+        self.tail_lines = tail_lines
+        self.lock = threading.Lock()
+        self.count = 0
+        self.allowance = rate
+        self.checked = time.time()
+
+    def log_path(self, command):
+        """Return a new path for the log of command."""
+        with self.lock:
+            self.count += 1
+            count = self.count
+        words = []
+        for word in command[:3]:
+            if word.startswith('-'):
+                break
+            words.append(os.path.basename(word))
+        name = re.sub(r'[^A-Za-z0-9_.]+', '-', '-'.join(words))[:60]
+        return os.path.join(
+            self.log_dir, COMMAND_LOG_DIR,
+            '{:03d}-{}.log'.format(count, name.strip('-')))
+
+    def allow(self):
+        """Return whether a line may be printed now."""
+        if not self.rate:
+            return True
+        with self.lock:
+            now = time.time()
+            self.allowance = min(
+                self.rate, self.allowance + (now - self.checked) * self.rate)
+            self.checked = now
+            if self.allowance < 1:
+                return False
+            self.allowance -= 1
+            return True
+
+
+command_output = CommandOutput()
+
+
+def configure_command_output(log_dir=None, level=logging.INFO, rate=20,
+                             tail_lines=OUTPUT_TAIL_LINES):
+    """Set where run_commands sends output; see CommandOutput."""
+    global command_output
+    command_output = CommandOutput(log_dir, level, rate, tail_lines)
+
+
+class CommandTimeoutError(subprocess.CalledProcessError):
+    """A command was killed because it exceeded one of its timeouts."""
+
+    def __init__(self, returncode, cmd, output=None, reason=None):
+        super(CommandTimeoutError, self).__init__(returncode, cmd, output)
+        self.reason = reason
+
+    def __str__(self):
+        return "Command '{}' was killed: {}".format(self.cmd, self.reason)
+
+
+class _Command(object):
+    """A running child process and the state used to stream its output."""
+
+    def __init__(self, command, verbose=True, timeout=None,
+                 idle_timeout=None, tail_lines=None, env=None):
+        if isinstance(command, str):
+            command = command.split()
+        self.command = command
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.output = command_output
+        self.tail = deque(maxlen=tail_lines or self.output.tail_lines)
+        self.killed_reason = None
+        self.log = self.log_path = None
+        # The level of the last line that named one.
+        self.level = None
+        self.lines = self.hidden = 0
+        if self.output.log_dir:
+            self.log_path = self.output.log_path(command)
+            mkdir_p(os.path.dirname(self.log_path))
+            self.log = open(self.log_path, 'wb')
+            self.log.write('$ {}\n'.format(' '.join(command)).encode('utf-8'))
+        if verbose:
+            print_now('Executing: {}'.format(command))
+        self.proc = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            close_fds=True, env=env)
+        self.started = self.last_output = time.time()
+        self.streams = {}
+        self.partial = {}
+        for stream in (self.proc.stdout, self.proc.stderr):
+            self.streams[stream.fileno()] = stream
+            self.partial[stream.fileno()] = b''
+
+    def deadline(self):
+        deadlines = []
+        if self.timeout:
+            deadlines.append(self.started + self.timeout)
+        if self.idle_timeout:
+            deadlines.append(self.last_output + self.idle_timeout)
+        return min(deadlines) if deadlines else None
+
+    def read(self, fd):
+        data = os.read(fd, 65536)
+        if not data:
+            if self.partial[fd]:
+                self._emit([self.partial[fd]])
+            self.streams.pop(fd).close()
+            return
+        self.last_output = time.time()
+        if self.log is not None:
+            self.log.write(data)
+        lines = (self.partial[fd] + data).split(b'\n')
+        self.partial[fd] = lines.pop()
+        self._emit(lines)
+
+    def _emit(self, lines):
+        """Keep lines in the tail and print those to show, all at once."""
+        shown = []
+        for line in lines:
+            if not isinstance(line, str):
+                line = line.decode('utf-8', 'replace')
+            line = line.rstrip('\r')
+            self.tail.append(line)
+            self.lines += 1
+            if self.show(line):
+                shown.append(line)
+            else:
+                self.hidden += 1
+        if shown:
+            print_now('\n'.join(shown))
+
+    def show(self, line):
+        if self.log is None:
+            return True
+        level = log_level(line)
+        if level is not None:
+            self.level = level
+        if self.level is not None and self.level < self.output.level:
+            return False
+        return self.output.allow()
+
+    def check_timeout(self, now):
+        if self.timeout and now - self.started >= self.timeout:
+            reason = 'exceeded its {}s timeout'.format(self.timeout)
+        elif self.idle_timeout and now - self.last_output >= self.idle_timeout:
+            reason = 'produced no output for {}s'.format(self.idle_timeout)
+        else:
+            return
+        self.killed_reason = reason
+        logging.error('Killing {}: {}'.format(self.command, reason))
+        try:
+            self.proc.kill()
+        except OSError as e:
+            logging.error('Unable to kill {}: {}'.format(self.command, e))
+        for stream in self.streams.values():
+            stream.close()
+        self.streams.clear()
+
+    def done(self):
+        return not self.streams and self.proc.poll() is not None
+
+    def close(self):
+        if self.log is None:
+            return
+        self.log.close()
+        if self.hidden:
+            print_now('{} of {} lines not shown, see {}'.format(
+                self.hidden, self.lines, self.log_path))
+
+    def error(self):
+        """Return the exception describing a failure, or None."""
+        output = '\n'.join(self.tail)
+        if self.killed_reason:
+            e = CommandTimeoutError(
+                self.proc.returncode, self.command, output,
+                self.killed_reason)
+        elif self.proc.returncode != 0:
+            e = subprocess.CalledProcessError(
+                self.proc.returncode, self.command, output)
+        else:
+            return None
+        print_now("ERROR: run_command failed: {}".format(output))
+        e.stderr = output
+        return e
+
+
+def run_commands(commands, max_running=None, verbose=True, timeout=None,
+                 idle_timeout=None, tail_lines=None, env=None):
+    """Run commands as concurrent child processes.
+
+    The stdout and stderr of every child are multiplexed with select(), so
+    no process is polled in a busy loop.  A child is killed when it runs
+    longer than timeout seconds or goes idle_timeout seconds without any
+    output.  At most max_running children run at once.
+
+    Return a list with, for each command, None if it succeeded or the
+    CalledProcessError describing its failure.  The error output is the
+    last tail_lines lines the command wrote (by default those configured
+    by configure_command_output).  env, if given, is the environment of
+    every child.
+    """
+    pending = deque(enumerate(commands))
+    running = {}
+    errors = [None] * len(pending)
+    while pending or running:
+        while pending and (not max_running or len(running) < max_running):
+            index, command = pending.popleft()
+            running[index] = _Command(
+                command, verbose, timeout, idle_timeout, tail_lines, env)
+        readers = dict((fd, cmd) for cmd in running.values()
+                       for fd in cmd.streams)
+        deadlines = [cmd.deadline() for cmd in running.values()
+                     if cmd.deadline() is not None]
+        wait = max(0, min(deadlines) - time.time()) if deadlines else None
+        if not readers:
+            # Every stream is closed but some child has not exited yet.
+            wait = min(wait, 0.1) if wait is not None else 0.1
+        ready = select.select(list(readers), [], [], wait)[0]
+        for fd in ready:
+            readers[fd].read(fd)
+        now = time.time()
+        for index, cmd in list(running.items()):
+            cmd.check_timeout(now)
+            if cmd.done():
+                errors[index] = cmd.error()
+                cmd.close()
+                del running[index]
+    return errors
+
+
+def run_command(command, verbose=True, timeout=None, idle_timeout=None,
+                env=None):
+    """Execute a command and maybe print the output.
+
+    Raise CalledProcessError if the command fails, or CommandTimeoutError
+    if it is killed for exceeding timeout or idle_timeout seconds.
+    """
+    error = run_commands(
+        [command], verbose=verbose, timeout=timeout,
+        idle_timeout=idle_timeout, env=env)[0]
+    if error:
+        raise error
+
+
+def get_output(command, env=None):
+    """Run command and return its stdout as a string."""
     if isinstance(command, str):
         command = command.split()
-    if verbose:
-        print_now('Executing: {}'.format(command))
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
-    while proc.poll() is None:
-        status = proc.stdout.readline()
-        if status:
-            print_now(status)
-    if proc.returncode != 0 and proc.returncode is not None:
-        output, error = proc.communicate()
-        print_now("ERROR: run_command failed: {}".format(error))
-        e = subprocess.CalledProcessError(proc.returncode, command, error)
-        e.stderr = error
-        raise e
+    output = subprocess.check_output(command, env=env)
+    return output if isinstance(output, str) else output.decode('utf-8')
+
+
+def run_concurrently(func, items, max_workers=1, stop_on_error=False):
+    """Call func(item) for every item using up to max_workers threads.
+
+    Return an OrderedDict that maps every item that was started to the
+    exception it raised, or None if it succeeded.  If stop_on_error is set,
+    items that have not been started when the first error occurs are
+    skipped and left out of the result.
+    """
+    items = list(items)
+    pending = Queue()
+    for item in items:
+        pending.put(item)
+    results = {}
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    def worker():
+        while not (stop_on_error and failed.is_set()):
+            try:
+                item = pending.get_nowait()
+            except Empty:
+                return
+            with lock:
+                results[item] = None
+            try:
+                func(item)
+            except Exception as e:
+                logging.error('{} failed: {}'.format(item, e))
+                with lock:
+                    results[item] = e
+                failed.set()
+
+    if max_workers <= 1 or len(items) <= 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(max_workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return OrderedDict((i, results[i]) for i in items if i in results)
 
 
 def print_now(string):
@@ -70,17 +459,93 @@ def get_juju_home():
     return home
 
 
-def copytree_force(src, dst, ignore=None):
-    if os.path.exists(dst):
+def copytree_force(src, dst, ignore=None, keep=()):
+    """Replace dst with a copy of src, leaving the entries of dst named in
+    keep in place.
+    """
+    if not os.path.exists(dst):
+        copytree(src, dst, ignore=ignore)
+        return
+    if not keep:
         rmtree(dst)
-    copytree(src, dst, ignore=ignore)
+        copytree(src, dst, ignore=ignore)
+        return
+    for name in os.listdir(dst):
+        if name in keep:
+            continue
+        path = os.path.join(dst, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            rmtree(path)
+        else:
+            os.remove(path)
+    names = os.listdir(src)
+    ignored = ignore(src, names) if ignore else ()
+    for name in names:
+        if name in ignored or name in keep:
+            continue
+        path = os.path.join(src, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            copytree(path, os.path.join(dst, name), ignore=ignore)
+        else:
+            copy2(path, os.path.join(dst, name))
 
 
-def rename_env(from_env, to_env, env_path):
+def snapshot_tree(src, dst, copy=(), ignore=None):
+    """Recreate the src tree at dst using hard links instead of copies.
+
+    Files whose path relative to src is listed in copy are copied because
+    they will be modified, as are files that cannot be linked (for example
+    when dst is on another filesystem).  ignore works like the ignore
+    argument of shutil.copytree.
+    """
+    copy = set(os.path.normpath(path) for path in copy)
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel_dir = os.path.relpath(dirpath, src)
+        dst_dir = os.path.normpath(os.path.join(dst, rel_dir))
+        os.mkdir(dst_dir)
+        ignored = ignore(dirpath, dirnames + filenames) if ignore else ()
+        dirnames[:] = [d for d in dirnames if d not in ignored]
+        for name in list(dirnames) + filenames:
+            if name in ignored:
+                continue
+            src_path = os.path.join(dirpath, name)
+            dst_path = os.path.join(dst_dir, name)
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in dirnames:
+                continue
+            elif os.path.normpath(os.path.join(rel_dir, name)) in copy:
+                copy2(src_path, dst_path)
+            else:
+                try:
+                    os.link(src_path, dst_path)
+                except OSError:
+                    copy2(src_path, dst_path)
+
+
+def rename_envs(from_envs, to_env, env_path, suffix=''):
+    """Rename several environments with a single rewrite of env_path.
+
+    Each environment is renamed to to_env + its name + suffix.  The new
+    file is written next to env_path and renamed over it, so the update
+    is atomic and never modifies a file that is hard linked.
+    """
     with open(env_path, 'r') as f:
-        env = yaml.load(f)
-    new_env = to_env + from_env
-    env['environments'][new_env] = env['environments'].pop(from_env)
-    with open(env_path, 'w') as f:
+        env = yaml.safe_load(f)
+    new_envs = []
+    for from_env in from_envs:
+        new_env = to_env + from_env + suffix
+        env['environments'][new_env] = env['environments'].pop(from_env)
+        new_envs.append(new_env)
+    with NamedTemporaryFile('w', dir=os.path.dirname(env_path),
+                            delete=False) as f:
         yaml.dump(env, f, indent=4, default_flow_style=False)
-    return new_env
+    os.chmod(f.name, os.stat(env_path).st_mode & 0o777)
+    os.rename(f.name, env_path)
+    return new_envs
+
+
+def rename_env(from_env, to_env, env_path):
+    return rename_envs([from_env], to_env, env_path)[0]
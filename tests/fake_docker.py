@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""A stand-in for the docker CLI backed by a fake local registry.
+
+The state file is JSON with a "registry" mapping of image name to the
+digest the registry currently serves, a "local" mapping of the images
+present locally and a "calls" list recording every invocation.
+"""
+
+from __future__ import print_function
+
+from argparse import (
+    ArgumentParser,
+    REMAINDER,
+)
+import json
+import sys
+
+
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument('--state', required=True)
+    parser.add_argument('command')
+    parser.add_argument('args', nargs=REMAINDER)
+    args = parser.parse_args(argv)
+    with open(args.state) as f:
+        state = json.load(f)
+    state.setdefault('local', {})
+    state.setdefault('calls', []).append([args.command] + args.args)
+    reference = args.args[-1] if args.args else ''
+    name, _, digest = reference.partition('@')
+    status = 0
+    if args.command == 'pull':
+        served = state['registry'].get(name)
+        if served is None or digest and digest != served:
+            print('Error: manifest for {} not found'.format(reference),
+                  file=sys.stderr)
+            status = 1
+        else:
+            state['local'][name] = served
+            print('Status: Downloaded newer image for {}'.format(reference))
+    elif args.command == 'inspect':
+        local = state['local'].get(name)
+        if local is None or digest and digest != local:
+            print('Error: No such image: {}'.format(reference),
+                  file=sys.stderr)
+            status = 1
+        else:
+            print(json.dumps(['{}@{}'.format(name, local)]))
+    with open(args.state, 'w') as f:
+        json.dump(state, f)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
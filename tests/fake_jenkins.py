@@ -0,0 +1,196 @@
+"""A local HTTP server that fakes the parts of the Jenkins API we use."""
+
+import json
+import threading
+import time
+
+try:
+    from BaseHTTPServer import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from SocketServer import ThreadingMixIn
+    from urlparse import (
+        parse_qsl,
+        urlparse,
+    )
+except ImportError:
+    from http.server import (
+        BaseHTTPRequestHandler,
+        HTTPServer,
+    )
+    from socketserver import ThreadingMixIn
+    from urllib.parse import (
+        parse_qsl,
+        urlparse,
+    )
+
+
+class FakeJenkinsHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.jenkins.handle(self, 'GET')
+
+    def do_POST(self):
+        self.server.jenkins.handle(self, 'POST')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class FakeJenkins:
+    """Record build requests and answer them like Jenkins would.
+
+    fail_next(count, status, method) makes the next count requests (of
+    method, if given) fail with status, to exercise retries.  With
+    drop_connections, every connection is closed after one answer, as
+    if it had been idle for too long.
+
+    Each queued build waits queue_time seconds in the queue and then runs
+    for run_time seconds.  Its result is results[test_plan], SUCCESS by
+    default, and the queue items of the test plans in cancelled are
+    cancelled.  With hide_builds, the job lists none of its builds.
+    """
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), FakeJenkinsHandler)
+        self.server.jenkins = self
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.builds = []
+        self.clients = set()
+        self.failures = []
+        self.items = []
+        self.queue_time = 0.0
+        self.run_time = 0.0
+        self.results = {}
+        self.cancelled = set()
+        self.hide_builds = False
+        self.drop_connections = False
+        self.last_number = 0
+
+    def __enter__(self):
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail_next(self, count, status=503, method=None):
+        with self.lock:
+            self.failures.extend([(status, method)] * count)
+
+    def next_failure(self, method):
+        for failure in self.failures:
+            if failure[1] in (None, method):
+                self.failures.remove(failure)
+                return failure[0]
+        return None
+
+    def item_state(self, item, now):
+        if item['query'].get('test_plan') in self.cancelled:
+            return 'cancelled'
+        started = item['submitted'] + self.queue_time
+        if now < started:
+            return 'queued'
+        if item['number'] is None:
+            self.last_number += 1
+            item['number'] = self.last_number
+        return 'running' if now < started + self.run_time else 'done'
+
+    def build_json(self, item, now):
+        running = self.item_state(item, now) == 'running'
+        return {
+            'number': item['number'], 'queueId': item['id'],
+            'building': running,
+            'result': None if running else self.results.get(
+                item['query'].get('test_plan'), 'SUCCESS'),
+            'timestamp': int((item['submitted'] + self.queue_time) * 1000),
+            'duration': 0 if running else int(self.run_time * 1000),
+            'url': '{}/job/cwr-test/{}/'.format(self.url, item['number'])}
+
+    def get(self, path):
+        """Return the JSON answer to GET path, or None."""
+        now = time.time()
+        states = [(item, self.item_state(item, now)) for item in self.items]
+        parts = path.strip('/').split('/')
+        if path == '/queue/api/json':
+            return {'items': [
+                {'id': item['id'], 'why': 'Waiting for next executor',
+                 'inQueueSince': int(item['submitted'] * 1000)}
+                for item, state in states if state == 'queued']}
+        if parts[:2] == ['queue', 'item'] and parts[3:] == ['api', 'json']:
+            for item, state in states:
+                if str(item['id']) == parts[2]:
+                    executable = None
+                    if item['number'] is not None:
+                        executable = {'number': item['number'], 'url': None}
+                    return {'id': item['id'],
+                            'inQueueSince': int(item['submitted'] * 1000),
+                            'cancelled': state == 'cancelled',
+                            'executable': executable}
+            return None
+        if parts[0] == 'job' and parts[-2:] == ['api', 'json']:
+            built = [item for item, _ in states if item['number'] is not None]
+            if len(parts) == 4:
+                if self.hide_builds:
+                    built = []
+                return {'builds': [
+                    self.build_json(item, now) for item in sorted(
+                        built, key=lambda i: -i['number'])]}
+            for item in built:
+                if str(item['number']) == parts[2]:
+                    return self.build_json(item, now)
+        return None
+
+    def handle(self, handler, method):
+        url = urlparse(handler.path)
+        query = dict(parse_qsl(url.query))
+        with self.lock:
+            self.clients.add(handler.client_address)
+            self.requests.append({
+                'method': method, 'path': url.path, 'query': query,
+                'authorization': handler.headers.get('Authorization')})
+            status = self.next_failure(method)
+        if self.drop_connections:
+            handler.close_connection = True
+        if status:
+            return handler.send(status)
+        if url.path == '/crumbIssuer/api/json':
+            return handler.send(404)
+        if (method == 'POST' and url.path.startswith('/job/') and
+                url.path.endswith('/buildWithParameters')):
+            with self.lock:
+                self.builds.append(query)
+                queue_id = len(self.builds)
+                self.items.append({'id': queue_id, 'query': query,
+                                   'submitted': time.time(), 'number': None})
+            return handler.send(201, headers={
+                'Location': '{}/queue/item/{}/'.format(self.url, queue_id)})
+        if method == 'GET':
+            with self.lock:
+                answer = self.get(url.path)
+            if answer is not None:
+                return handler.send(200, json.dumps(answer).encode('utf-8'))
+        handler.send(404)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""A stand-in for the juju 1.x CLI that keeps models in a state file.
+
+The state lives in fake-juju.json in $JUJU_HOME.  It maps "models" to
+the bootstrapped models and their services and machines, records every
+invocation in "calls", and lists models whose status should fail in
+"unhealthy" and models whose bootstrap should fail in "fail_bootstrap".
+Destroyed services and machines stay in the status for the next
+"linger" status calls, as juju destroys them asynchronously.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+
+import yaml
+
+
+def state_path():
+    return os.path.join(os.environ['JUJU_HOME'], 'fake-juju.json')
+
+
+def load_state():
+    try:
+        with open(state_path()) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return {}
+
+
+def option(args, name):
+    return args[args.index(name) + 1]
+
+
+def main(args):
+    state = load_state()
+    for key in ('models', 'calls', 'unhealthy', 'fail_bootstrap', 'dying'):
+        state.setdefault(key, {} if key == 'models' else [])
+    linger = state.get('linger', 0)
+    state['calls'].append(args)
+    command = args[0]
+    status = 0
+    if command == '--version':
+        print('1.25.6-xenial-amd64')
+    elif command == 'bootstrap':
+        model = option(args, '-e')
+        if model in state['fail_bootstrap']:
+            print('ERROR cannot bootstrap {}'.format(model), file=sys.stderr)
+            status = 1
+        else:
+            state['models'][model] = {
+                'machines': {'0': {}}, 'services': {}}
+    elif command == 'destroy-environment':
+        if state['models'].pop(args[-1], None) is None:
+            status = 1
+    elif command in ('status', 'set-constraints', 'destroy-service',
+                     'destroy-machine', 'deploy'):
+        model = state['models'].get(option(args, '-e'))
+        if model is None or option(args, '-e') in state['unhealthy']:
+            print('ERROR unable to connect', file=sys.stderr)
+            status = 1
+        elif command == 'status':
+            print(yaml.safe_dump(model))
+            dying = []
+            for name, kind, key, polls in state['dying']:
+                if name != option(args, '-e'):
+                    dying.append([name, kind, key, polls])
+                elif polls > 1:
+                    dying.append([name, kind, key, polls - 1])
+                else:
+                    del model[kind][key]
+            state['dying'] = dying
+        elif command == 'deploy':
+            machine = str(len(model['machines']))
+            model['machines'][machine] = {}
+            model['services'][args[-1]] = {'units': [machine]}
+        elif command in ('destroy-service', 'destroy-machine'):
+            name = option(args, '-e')
+            if command == 'destroy-service':
+                doomed = [('services', args[-1])]
+            else:
+                doomed = [('machines', m)
+                          for m in args[args.index('--force') + 3:]]
+            for kind, key in doomed:
+                if linger:
+                    state['dying'].append([name, kind, key, linger])
+                else:
+                    del model[kind][key]
+    else:
+        print('ERROR unknown command {}'.format(command), file=sys.stderr)
+        status = 2
+    with open(state_path(), 'w') as f:
+        json.dump(state, f)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
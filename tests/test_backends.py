@@ -0,0 +1,143 @@
+from argparse import Namespace
+import os
+import subprocess
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.backends import (
+    FakeBackend,
+    ShellBackend,
+)
+from buildcloud.constraints import Constraints
+from buildcloud.utility import temp_dir
+
+
+class TestShellBackend(TestCase):
+
+    def test_bootstrap(self):
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            ShellBackend().bootstrap('cwr-aws')
+        self.assertEqual([c[0][0] for c in rc_mock.call_args_list], [
+            ['juju', 'bootstrap', '--show-log', '-e', 'cwr-aws',
+             '--constraints', 'mem=4G'],
+            'juju set-constraints -e cwr-aws mem=2G'])
+
+    def test_bootstrap_constraints(self):
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            ShellBackend().bootstrap(
+                'cwr-aws', Constraints('mem=8G cores=4', 'mem=4G cores=2'))
+        self.assertEqual([c[0][0] for c in rc_mock.call_args_list], [
+            ['juju', 'bootstrap', '--show-log', '-e', 'cwr-aws',
+             '--constraints', 'mem=8G cores=4'],
+            'juju set-constraints -e cwr-aws mem=4G cores=2'])
+
+    def test_timeouts(self):
+        backend = ShellBackend(60, 30, {'bootstrap': 900})
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            backend.bootstrap('cwr-aws')
+            backend.run_container(['sudo', 'docker', 'run'], '/results')
+        self.assertEqual(
+            [(c[1]['timeout'], c[1]['idle_timeout'])
+             for c in rc_mock.call_args_list],
+            [(900, 30), (60, 30), (60, 30)])
+
+    def test_pull_image_timeouts(self):
+        backend = ShellBackend(60, 30, {'pull_image': 600})
+        args = Namespace(image_cache='/tmp/images.json', image_pull_ttl=0,
+                         image_digest=None, background_pull=False)
+        with patch('buildcloud.backends.ImageCache',
+                   autospec=True) as cache_mock:
+            backend.pull_image('seman/cwrbox', args)
+        cache_mock.assert_called_once_with(
+            '/tmp/images.json', ttl=0, timeout=600, idle_timeout=30)
+
+    def test_using_juju_home(self):
+        backend = ShellBackend()
+        bound = backend.using_juju_home('/tmp/juju')
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            backend.destroy('cwr-aws')
+            bound.destroy('cwr-aws')
+        self.assertIsNone(backend.juju_home)
+        self.assertIsNone(rc_mock.call_args_list[0][1]['env'])
+        env = rc_mock.call_args_list[1][1]['env']
+        self.assertEqual(env['JUJU_HOME'], '/tmp/juju')
+        self.assertEqual(env['PATH'], os.environ['PATH'])
+
+    def test_copy_juju_home(self):
+        with temp_dir() as d:
+            src = os.path.join(d, 'src')
+            os.mkdir(src)
+            for name in ('environments.yaml', 'staging-juju-rsa'):
+                with open(os.path.join(src, name), 'w') as f:
+                    f.write(name)
+            dst = os.path.join(d, 'dst')
+            ShellBackend().copy_juju_home(
+                src, dst, snapshot_copy=['environments.yaml'])
+            self.assertEqual(os.stat(
+                os.path.join(dst, 'staging-juju-rsa')).st_nlink, 2)
+            self.assertEqual(os.stat(
+                os.path.join(dst, 'environments.yaml')).st_nlink, 1)
+
+
+class TestFakeBackend(TestCase):
+
+    def test_using_juju_home_shares_state(self):
+        backend = FakeBackend()
+        backend.using_juju_home('/tmp/a').bootstrap('cwr-aws-a')
+        backend.using_juju_home('/tmp/b').bootstrap('cwr-aws-b')
+        self.assertEqual(backend.models, set(['cwr-aws-a', 'cwr-aws-b']))
+        self.assertEqual(backend.juju_homes,
+                         {'cwr-aws-a': '/tmp/a', 'cwr-aws-b': '/tmp/b'})
+        self.assertEqual(len(backend.calls), 2)
+
+    def test_records_calls(self):
+        backend = FakeBackend()
+        backend.bootstrap('cwr-aws')
+        backend.bootstrap('cwr-gce')
+        backend.destroy('cwr-aws')
+        self.assertEqual(backend.calls, [
+            ('bootstrap', 'cwr-aws'), ('bootstrap', 'cwr-gce'),
+            ('destroy', 'cwr-aws')])
+        self.assertEqual(backend.models, set(['cwr-gce']))
+
+    def test_latency(self):
+        backend = FakeBackend(latencies={'bootstrap': 5}, jitter=0.1,
+                              seed=1)
+        with patch('buildcloud.backends.time.sleep',
+                   autospec=True) as sleep_mock:
+            backend.bootstrap('cwr-aws')
+            backend.destroy('cwr-aws')
+        first, second = [c[0][0] for c in sleep_mock.call_args_list]
+        self.assertTrue(4.5 <= first <= 5.5)
+        self.assertEqual(second, 0)
+
+    def test_failures(self):
+        backend = FakeBackend(failures={'bootstrap': 1})
+        with self.assertRaises(subprocess.CalledProcessError):
+            backend.bootstrap('cwr-aws')
+        self.assertEqual(backend.models, set())
+        backend.destroy('cwr-aws')
+
+    def test_max_concurrent(self):
+        backend = FakeBackend(latencies={'bootstrap': 0.05})
+        threads = [threading.Thread(target=backend.bootstrap, args=(m,))
+                   for m in ('cwr-aws', 'cwr-gce', 'cwr-azure')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(backend.max_concurrent['bootstrap'], 3)
+        self.assertEqual(backend.running['bootstrap'], 0)
+
+    def test_run_container(self):
+        backend = FakeBackend(result_size=10)
+        with temp_dir() as d:
+            backend.run_container(['sh', '-c', 'cwr'], d)
+            self.assertEqual(os.listdir(d), ['result.json'])
+        self.assertEqual(backend.calls, [('run_container', 'cwr')])
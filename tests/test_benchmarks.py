@@ -0,0 +1,149 @@
+import json
+import os
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.benchmarks import (
+    BenchmarkStore,
+    extract_metrics,
+    ingest_results,
+    main,
+    Metric,
+    regression_score,
+)
+from buildcloud.utility import temp_dir
+
+
+def write_json(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def cwr_result(*benchmarks):
+    return {
+        'bundle': {'name': 'mongodb'},
+        'results': [{'provider_name': 'AWS', 'test_outcome': 'PASS'}],
+        'benchmarks': list(benchmarks)}
+
+
+def runtime(value, provider='AWS'):
+    return {'name': 'perf', 'results': [
+        {'provider_name': provider, 'value': value, 'units': 'secs',
+         'direction': 'desc'}]}
+
+
+class TestExtractMetrics(TestCase):
+
+    def test_extract_metrics(self):
+        with temp_dir() as d:
+            write_json(os.path.join(d, 'mongodb', 'result.json'), cwr_result(
+                runtime('61.5'), runtime(70, provider='GCE'),
+                {'name': 'terasort', 'value': 12, 'direction': 'asc'}))
+            metrics = extract_metrics(d, 'cwr-aws')
+        self.assertEqual(metrics, [
+            Metric('AWS', 'perf', 61.5, 'secs', 'desc'),
+            Metric('GCE', 'perf', 70.0, 'secs', 'desc'),
+            Metric('cwr-aws', 'terasort', 12.0, None, 'asc')])
+
+    def test_extract_metrics_skips_malformed(self):
+        with temp_dir() as d:
+            with open(os.path.join(d, 'broken.json'), 'w') as f:
+                f.write('{not json')
+            with open(os.path.join(d, 'index.html'), 'w') as f:
+                f.write('<html></html>')
+            write_json(os.path.join(d, 'result.json'), cwr_result(
+                runtime('n/a'), runtime(None), {'value': 3}, 'perf'))
+            with patch('logging.warning') as warning_mock:
+                self.assertEqual(extract_metrics(d, 'cwr-aws'), [])
+        self.assertEqual(warning_mock.call_count, 1)
+
+
+class TestRegressionScore(TestCase):
+
+    def test_regression_score(self):
+        self.assertEqual(regression_score(14, 10, 2, 'desc'), 2)
+        self.assertEqual(regression_score(14, 10, 2, 'asc'), -2)
+        self.assertEqual(regression_score(6, 10, 2, 'asc'), 2)
+        self.assertEqual(regression_score(11, 10, 0, 'desc'), float('inf'))
+        self.assertEqual(regression_score(10, 10, 0, 'desc'), 0)
+
+
+class TestBenchmarkStore(TestCase):
+
+    def record_runs(self, store, values, direction='desc'):
+        for i, value in enumerate(values):
+            store.record('run-{}'.format(i), '/plans/mongodb.yaml',
+                         'cs:mongodb', [Metric('aws', 'perf', value, 'secs',
+                                               direction)], timestamp=i)
+
+    def test_compare_regressed(self):
+        with temp_dir() as d:
+            store = BenchmarkStore(os.path.join(d, 'b', 'benchmarks.sqlite'))
+            self.record_runs(store, [60, 61, 59, 60, 75])
+            self.assertEqual(store.latest_run(), 'run-4')
+            [comparison] = store.compare('run-4')
+        self.assertEqual(comparison.test_plan, 'mongodb.yaml')
+        self.assertEqual(comparison.samples, 4)
+        self.assertEqual(comparison.mean, 60)
+        self.assertTrue(comparison.regressed)
+
+    def test_compare_not_regressed(self):
+        with temp_dir() as d:
+            store = BenchmarkStore(os.path.join(d, 'benchmarks.sqlite'))
+            # Faster runs, and slower runs within the noise, are fine.
+            self.record_runs(store, [60, 61, 59, 60, 45, 61.5])
+            self.assertFalse(store.compare('run-4')[0].regressed)
+            self.assertFalse(store.compare('run-5')[0].regressed)
+            # Too few samples to judge.
+            self.assertFalse(
+                store.compare('run-2', min_samples=3)[0].regressed)
+            self.assertEqual(store.compare('run-0')[0].samples, 0)
+
+    def test_compare_window(self):
+        with temp_dir() as d:
+            store = BenchmarkStore(os.path.join(d, 'benchmarks.sqlite'))
+            self.record_runs(store, [100, 100, 100, 60, 61, 59, 62])
+            comparison = store.compare('run-6', window=3)[0]
+        self.assertEqual(comparison.mean, 60)
+        self.assertFalse(comparison.regressed)
+
+    def test_record_replaces_rerun(self):
+        with temp_dir() as d:
+            store = BenchmarkStore(os.path.join(d, 'benchmarks.sqlite'))
+            self.record_runs(store, [60, 61])
+            self.record_runs(store, [62])
+            self.assertEqual(store.compare('run-1')[0].mean, 62)
+
+
+class TestIngest(TestCase):
+
+    def make_run(self, d, value):
+        results = os.path.join(d, 'results')
+        write_json(os.path.join(results, 'result.json'),
+                   cwr_result(runtime(value)))
+        return results
+
+    def test_ingest_and_compare(self):
+        with temp_dir() as d:
+            test_plan = os.path.join(d, 'mongodb.yaml')
+            with open(test_plan, 'w') as f:
+                f.write('bundle: cs:mongodb\nbundle_name: mongodb\n')
+            db = os.path.join(d, 'benchmarks.sqlite')
+            for i, value in enumerate([60, 61, 59, 60]):
+                ingest_results(db, self.make_run(d, value), test_plan,
+                               ['aws'], 'run-{}'.format(i), timestamp=i)
+            with patch('buildcloud.benchmarks.print',
+                       create=True) as print_mock:
+                self.assertEqual(main(['--db', db, 'compare']), 0)
+            self.assertIn('0 of 1 benchmarks regressed.',
+                          print_mock.call_args[0][0])
+            self.assertEqual(main(['--db', db, 'ingest',
+                                   self.make_run(d, 90), test_plan, 'aws',
+                                   '--run', 'run-4']), 0)
+            with patch('buildcloud.benchmarks.print',
+                       create=True) as print_mock:
+                self.assertEqual(main(['--db', db, 'compare']), 1)
+            self.assertIn('REGRESSED', print_mock.call_args[0][0])
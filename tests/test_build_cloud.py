@@ -1,15 +1,61 @@
+import json
 import os
 from argparse import Namespace
+from collections import namedtuple
+import subprocess
 from unittest import TestCase
 
+import yaml
+
+from mock import (
+    call,
+    patch,
+)
+
+from buildcloud.backends import FakeBackend
+from buildcloud.checkpoint import Checkpoint
+from buildcloud.constraints import Constraints
 from buildcloud.build_cloud import (
+    env,
+    get_test_plans,
+    job_constraints,
+    job_graph,
+    juju,
     parse_args,
+    plan_workers,
+    record_success,
+    resumable_env,
+    run_container,
+    run_test_plans,
+    teardown,
+)
+from buildcloud.container_stats import (
+    BudgetExceeded,
+    STATS_FILE,
+)
+from buildcloud.host_locks import DEFAULT_LOCK_DIR
+from buildcloud.image_cache import DEFAULT_CACHE_PATH
+from buildcloud.results_archive import (
+    archive_path,
+    ResultsArchive,
+)
+from buildcloud.manifest import (
+    job_fingerprint,
+    ResultsManifest,
+)
+from buildcloud.utility import (
+    configure_command_output,
+    run_command,
+    temp_dir,
 )
 from tests.common_test import (
     setup_test_logging,
 )
 
 
+Host = namedtuple('Host', ['models', 'test_results'])
+
+
 class TestCloudBuild(TestCase):
 
     def setUp(self):
@@ -24,11 +70,659 @@ class TestCloudBuild(TestCase):
 
     def test_parse_args(self):
         args = parse_args(['cwr-model', 'test-plan'])
-        expected = Namespace(bundle_file='',
-                             juju_home='/tmp/home/cloud-city', log_dir=None,
-                             model=['cwr-model'], test_plan='test-plan',
-                             verbose=0)
+        expected = Namespace(archive_results=False,
+                             background_pull=False, bootstrap_workers=1,
+                             benchmark_db=None, bundle_file='',
+                             charm_cache=None, charm_cache_size=10240,
+                             checkpoint=None, console_level='INFO',
+                             console_rate=20, container_cpus=None,
+                             container_memory=None,
+                             container_sudo=False, cpu_budget=None,
+                             duration_history=None,
+                             fail_over_budget=False,
+                             host_locks=DEFAULT_LOCK_DIR,
+                             image_cache=DEFAULT_CACHE_PATH,
+                             image_digest=None, image_pull_ttl=0,
+                             job_id=None,
+                             juju_home='/tmp/home/cloud-city',
+                             live_sync=False, log_dir=None,
+                             max_bootstraps=None, max_containers=None,
+                             max_controller_bootstraps=None,
+                             max_controller_containers=None,
+                             max_lease_age=21600, max_model_age=86400,
+                             memory_budget=None, model=['cwr-model'],
+                             model_pool=None,
+                             per_model_containers=False, plan_workers=1,
+                             results_manifest=None, resume=False,
+                             snapshot_juju_home=False, stats_interval=None,
+                             sync_interval=10, tail_lines=100,
+                             teardown=False, test_plan='test-plan',
+                             test_plans=[], trace=False, verbose=0,
+                             command_timeout=1800, bootstrap_timeout=2700,
+                             cwr_timeout=21600, idle_timeout=None)
         self.assertEqual(args, expected)
 
+    def test_parse_args_resume_requires_checkpoint(self):
+        args = parse_args(['aws', 'plan', '--checkpoint', 'job.json',
+                           '--resume'])
+        self.assertEqual(args.checkpoint, 'job.json')
+        self.assertTrue(args.resume)
+        with patch('sys.stderr'):
+            with self.assertRaises(SystemExit):
+                parse_args(['aws', 'plan', '--resume'])
+            with self.assertRaises(SystemExit):
+                parse_args(['aws', 'plan', '--teardown'])
+            with self.assertRaises(SystemExit):
+                parse_args(['aws', 'plan', '--plan-workers', '2',
+                            '--benchmark-db', 'benchmarks.db'])
+
+    def test_parse_args_bootstrap_workers(self):
+        args = parse_args(
+            ['cwr-model', 'test-plan', '--bootstrap-workers', '3'])
+        self.assertEqual(args.bootstrap_workers, 3)
+
+    def make_juju_home(self, parent):
+        juju_home = os.path.join(parent, 'cloud-city')
+        os.makedirs(os.path.join(juju_home, 'environments'))
+        with open(os.path.join(juju_home, 'environments.yaml'), 'w') as f:
+            yaml.safe_dump({'environments': {'aws': {}, 'gce': {}}}, f)
+        for name in ('staging-juju-rsa', 'big-credentials'):
+            with open(os.path.join(juju_home, name), 'w') as f:
+                f.write(name)
+        return juju_home
+
+    def make_test_plan(self, parent, name='mongodb.yaml', **extra):
+        test_plan = os.path.join(parent, name)
+        with open(test_plan, 'w') as f:
+            yaml.safe_dump(dict(bundle='cs:mongodb', bundle_name='mongodb',
+                                **extra), f)
+        return test_plan
+
+    def test_env(self):
+        with temp_dir() as d:
+            args = Namespace(juju_home=self.make_juju_home(d),
+                             model=['aws', 'gce'], snapshot_juju_home=False,
+                             charm_cache=None, job_id='job1')
+            with env(args) as (host, container):
+                self.assertEqual(host.models,
+                                 ['cwr-aws-job1', 'cwr-gce-job1'])
+                self.assertFalse(os.path.exists(
+                    os.path.join(host.tmp_juju_home, 'environments')))
+                self.assertTrue(os.path.isfile(
+                    os.path.join(host.ssh_path, 'id_rsa')))
+                self.assertEqual(container.name, 'seman/cwrbox')
+                self.assertEqual(host.deployer_cache, os.path.join(
+                    host.tmp, '.deployer-store-cache'))
+                st = os.stat(host.deployer_cache)
+                self.assertEqual((st.st_uid, st.st_gid),
+                                 (os.getuid(), os.getgid()))
+                self.assertTrue(os.access(host.deployer_cache, os.W_OK))
+                self.assertEqual(os.stat(os.path.join(
+                    host.tmp_juju_home, 'big-credentials')).st_nlink, 1)
+            self.assertFalse(os.path.exists(host.root))
+
+    def test_env_snapshot_juju_home(self):
+        with temp_dir() as d:
+            juju_home = self.make_juju_home(d)
+            args = Namespace(juju_home=juju_home, model=['aws', 'gce'],
+                             snapshot_juju_home=True, charm_cache=None,
+                             job_id=None)
+            with env(args) as (host, container):
+                self.assertRegexpMatches(
+                    host.models[0], '^cwr-aws-[0-9a-f]{8}$')
+                self.assertEqual(host.models[1],
+                                 'cwr-gce' + host.models[0][len('cwr-aws'):])
+                self.assertEqual(os.stat(os.path.join(
+                    host.tmp_juju_home, 'big-credentials')).st_nlink, 2)
+                self.assertEqual(os.stat(os.path.join(
+                    host.tmp_juju_home, 'environments.yaml')).st_nlink, 1)
+            with open(os.path.join(juju_home, 'environments.yaml')) as f:
+                self.assertEqual(yaml.safe_load(f)['environments'],
+                                 {'aws': {}, 'gce': {}})
+
+    def test_juju(self):
+        host = Namespace(tmp_juju_home='/tmp/juju', root='/tmp/root',
+                         models=['cwr-aws', 'cwr-gce'])
+        args = Namespace(bootstrap_workers=1, model_pool=None,
+                         container_sudo=False, model=['aws', 'gce'])
+        with patch.dict(os.environ, {'JUJU_HOME': '/elsewhere'}):
+            juju_env = dict(os.environ, JUJU_HOME='/tmp/juju')
+            with patch('buildcloud.backends.run_command',
+                       autospec=True) as rc_mock:
+                with juju(host, args):
+                    self.assertEqual(os.environ['JUJU_HOME'], '/elsewhere')
+
+        def juju_call(command):
+            return call(command, timeout=None, idle_timeout=None,
+                        env=juju_env)
+
+        calls = rc_mock.call_args_list
+        self.assertEqual(calls[0], juju_call('juju --version'))
+        self.assertEqual(calls[1], juju_call(
+            ['juju', 'bootstrap', '--show-log', '-e', 'cwr-aws',
+             '--constraints', 'mem=4G']))
+        self.assertEqual(calls[2], juju_call(
+            'juju set-constraints -e cwr-aws mem=2G'))
+        self.assertEqual(calls[3], juju_call(
+            ['juju', 'bootstrap', '--show-log', '-e', 'cwr-gce',
+             '--constraints', 'mem=4G']))
+        self.assertEqual(calls[-2], juju_call(
+            'juju destroy-environment --force --yes cwr-aws'))
+        self.assertEqual(calls[-1], juju_call(
+            'juju destroy-environment --force --yes cwr-gce'))
+
+    def test_juju_container_sudo_fixes_ownership(self):
+        host = Namespace(tmp_juju_home='/tmp/juju', root='/tmp/root',
+                         models=['cwr-aws'])
+        args = Namespace(bootstrap_workers=1, model_pool=None,
+                         container_sudo=True, model=['aws'])
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            with juju(host, args):
+                pass
+        ids = [str(os.getuid()), str(os.getgid())]
+        self.assertEqual(rc_mock.call_args_list[-1], call([
+            'sudo', 'find', '/tmp/root', '(', '!', '-uid', ids[0], '-o',
+            '!', '-gid', ids[1], ')', '-exec', 'chown', '-h', ':'.join(ids),
+            '{}', '+'], timeout=None, idle_timeout=None, env=None))
+
+    def container_fixture(self, root='/tmp/root'):
+        host = Namespace(
+            test_results=os.path.join(root, 'results'),
+            tmp_juju_home='/tmp/juju', tmp=os.path.join(root, 'tmp'),
+            juju_repository=os.path.join(root, 'repo'), root=root,
+            models=['cwr-aws', 'cwr-gce'],
+            deployer_cache=os.path.join(root, 'tmp', '.deployer-store-cache'))
+        container = Namespace(
+            user='ubuntu', home='/home/ubuntu',
+            juju_home='/home/ubuntu/.juju',
+            test_results='/home/ubuntu/results',
+            juju_repository='/home/ubuntu/charm-repo',
+            test_plans='/home/ubuntu/test_plans')
+        args = Namespace(test_plan='/plans/mongodb.yaml', log_dir=None,
+                         model=['aws', 'gce'],
+                         bundle_file='', container_sudo=False,
+                         live_sync=False, per_model_containers=False,
+                         archive_results=False, stats_interval=None,
+                         memory_budget=None, cpu_budget=None,
+                         fail_over_budget=False,
+                         container_memory=None, container_cpus=None)
+        return host, container, args
+
+    def test_run_container(self):
+        host, container, args = self.container_fixture()
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            run_container(host, container, args, image='seman/cwrbox')
+        command = rc_mock.call_args[0][0]
+        user = command[command.index('-u') + 1]
+        self.assertEqual(user, '{}:{}'.format(os.getuid(), os.getgid()))
+        self.assertEqual(command[-1], 'cwr -F -l DEBUG -v  cwr-aws cwr-gce '
+                                      '/home/ubuntu/test_plans/mongodb.yaml')
+        args.container_sudo = True
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            run_container(host, container, args, image='seman/cwrbox')
+        command = rc_mock.call_args[0][0]
+        self.assertEqual(command[command.index('-u') + 1], 'ubuntu')
+        self.assertTrue(command[-1].startswith('sudo cwr -F'))
+        self.assertNotIn('--name', command)
+        self.assertNotIn('--memory', command)
+
+    def test_run_container_stats(self):
+        with temp_dir() as d:
+            host, container, args = self.container_fixture(
+                os.path.join(d, 'root'))
+            os.makedirs(host.test_results)
+            args.stats_interval = 0.01
+            args.memory_budget = 1024
+            backend = FakeBackend(latencies={'run_container': 0.1})
+            with patch('buildcloud.build_cloud.print_now') as pn_mock:
+                with patch('logging.warning') as lw_mock:
+                    run_container(host, container, args, image='seman/cwrbox',
+                                  backend=backend)
+                args.fail_over_budget = True
+                with self.assertRaises(BudgetExceeded):
+                    run_container(host, container, args, image='seman/cwrbox',
+                                  backend=backend)
+            with open(os.path.join(host.test_results, STATS_FILE)) as f:
+                stats = json.load(f)
+        self.assertIn(('container_stats', 'root-mongodb'), backend.calls)
+        command = [c for c in backend.calls if c[0] == 'run_container']
+        self.assertEqual(stats['fields'][:3], ['time', 'cpu', 'memory'])
+        self.assertGreater(len(stats['samples']), 0)
+        self.assertGreater(stats['summary']['memory']['peak'], 1024)
+        self.assertTrue(pn_mock.call_args[0][0].startswith(
+            'root-mongodb: CPU peak'))
+        self.assertIn('root-mongodb exceeded its budget: peak memory',
+                      lw_mock.call_args[0][0])
+        self.assertEqual(len(command), 2)
+
+    def test_run_container_archive_results(self):
+        with temp_dir() as d:
+            host, container, args = self.container_fixture(
+                os.path.join(d, 'root'))
+            os.makedirs(host.test_results)
+            args.archive_results = True
+            log_dir = os.path.join(d, 'logs')
+            backend = FakeBackend()
+            run_container(host, container, args, log_dir=log_dir,
+                          image='seman/cwrbox', backend=backend)
+            archive = ResultsArchive(archive_path(log_dir))
+            self.assertEqual(list(archive.load_index()), ['result.json'])
+            self.assertItemsEqual(os.listdir(log_dir), [
+                os.path.basename(archive.path),
+                os.path.basename(archive.index_path)])
+        self.assertIn(('archive_results', archive.path), backend.calls)
+
+    def test_run_container_keeps_command_logs(self):
+        self.addCleanup(configure_command_output)
+        with temp_dir() as d:
+            host, container, args = self.container_fixture(
+                os.path.join(d, 'root'))
+            args.log_dir = os.path.join(d, 'logs')
+            os.makedirs(host.test_results)
+            configure_command_output(args.log_dir)
+            with patch('buildcloud.utility.print_now'):
+                run_command(['echo', 'bootstrapped'])
+            run_container(host, container, args, image='seman/cwrbox',
+                          backend=FakeBackend())
+            self.assertTrue(os.path.exists(
+                os.path.join(args.log_dir, 'result.json')))
+            with open(os.path.join(
+                    args.log_dir, 'commands', '001-echo-bootstrapped.log')
+                    ) as f:
+                self.assertIn('bootstrapped\n', f.read())
+
+    def test_run_container_per_model(self):
+        commands = {}
+
+        def fake_run_container(command, test_results):
+            model = command[-1].split()[-2]
+            commands[model] = command
+            result_dir = os.path.join(test_results, 'mongodb')
+            os.makedirs(result_dir)
+            with open(os.path.join(result_dir, 'result.json'), 'w') as f:
+                json.dump({'bundle': {'name': 'mongodb'},
+                           'results': [{'provider_name': model}]}, f)
+            if model == 'cwr-gce':
+                raise subprocess.CalledProcessError(1, 'cwr')
+
+        with temp_dir() as d:
+            host, container, args = self.container_fixture(
+                os.path.join(d, 'root'))
+            args.per_model_containers = True
+            args.container_memory = '4g'
+            args.container_cpus = 1.5
+            args.log_dir = os.path.join(d, 'logs')
+            backend = FakeBackend()
+            with patch.object(backend, 'run_container',
+                              side_effect=fake_run_container):
+                with patch('logging.error'):
+                    with self.assertRaises(subprocess.CalledProcessError):
+                        run_container(host, container, args,
+                                      image='seman/cwrbox', backend=backend)
+            with open(os.path.join(args.log_dir, 'status.json')) as f:
+                status = json.load(f)
+            with open(os.path.join(
+                    args.log_dir, 'mongodb', 'result.json')) as f:
+                merged = json.load(f)
+            self.assertTrue(os.path.exists(os.path.join(
+                args.log_dir, 'cwr-aws', 'mongodb', 'result.json')))
+        self.assertEqual(sorted(commands), ['cwr-aws', 'cwr-gce'])
+        command = commands['cwr-aws']
+        self.assertEqual(command[command.index('--name') + 1],
+                         'root-mongodb-cwr-aws')
+        self.assertEqual(command[command.index('--memory') + 1], '4g')
+        self.assertEqual(command[command.index('--cpus') + 1], '1.5')
+        self.assertEqual(
+            command[command.index('-v') + 1],
+            '{}:/home/ubuntu/results'.format(
+                os.path.join(host.test_results, 'cwr-aws')))
+        self.assertTrue(command[-1].startswith('cwr -F -l DEBUG -v  cwr-aws '))
+        self.assertEqual(status['cwr-aws'], {'passed': True, 'error': None})
+        self.assertFalse(status['cwr-gce']['passed'])
+        self.assertEqual(merged['bundle'], {'name': 'mongodb'})
+        self.assertEqual(merged['results'], [{'provider_name': 'cwr-aws'},
+                                             {'provider_name': 'cwr-gce'}])
+
+    def test_run_container_per_model_concurrent_plans(self):
+        names = []
+        backend = FakeBackend()
+
+        def fake_run_container(command, test_results):
+            with backend.lock:
+                names.append(command[command.index('--name') + 1])
+
+        with temp_dir() as d:
+            fixture, container, args = self.container_fixture(
+                os.path.join(d, 'root'))
+            host = namedtuple('PlanHost', sorted(vars(fixture)))(
+                **vars(fixture))
+            container.name = 'seman/cwrbox'
+            args.per_model_containers = True
+            args.plan_workers = 2
+            args.benchmark_db = None
+            test_plans = [
+                self.make_test_plan(d, 'a.yaml', services=['mongodb']),
+                self.make_test_plan(d, 'b.yaml', services=['mediawiki'])]
+            with patch.object(backend, 'run_container',
+                              side_effect=fake_run_container):
+                results = run_test_plans(
+                    host, container, args, test_plans, backend,
+                    image='seman/cwrbox')
+        self.assertEqual([r[0] for r in results.values()], [None, None])
+        self.assertItemsEqual(names, [
+            'root-a-cwr-aws', 'root-a-cwr-gce',
+            'root-b-cwr-aws', 'root-b-cwr-gce'])
+
+    def test_juju_parallel(self):
+        models = ['cwr-{}'.format(i) for i in range(4)]
+        host = Namespace(tmp_juju_home='/tmp/juju', root='/tmp/root',
+                         models=models)
+        args = Namespace(bootstrap_workers=4, model_pool=None,
+                         container_sudo=False,
+                         model=[str(i) for i in range(4)])
+        with patch('buildcloud.backends.run_command',
+                   autospec=True) as rc_mock:
+            with juju(host, args):
+                pass
+        destroyed = [c[0][0] for c in rc_mock.call_args_list
+                     if 'destroy-environment' in c[0][0]]
+        self.assertItemsEqual(destroyed, [
+            'juju destroy-environment --force --yes {}'.format(m)
+            for m in models])
+
+    def test_juju_bootstrap_failure_destroys_started_models(self):
+        host = Namespace(tmp_juju_home='/tmp/juju', root='/tmp/root',
+                         models=['cwr-aws', 'cwr-gce', 'cwr-azure'])
+        args = Namespace(bootstrap_workers=1, model_pool=None,
+                         container_sudo=False, model=['aws', 'gce', 'azure'])
+
+        def fake_run_command(command, **kwargs):
+            if command[:5] == ['juju', 'bootstrap', '--show-log', '-e',
+                               'cwr-gce']:
+                raise subprocess.CalledProcessError(1, command)
+
+        with patch('buildcloud.backends.run_command', autospec=True,
+                   side_effect=fake_run_command) as rc_mock:
+            with patch('logging.error'):
+                with self.assertRaises(subprocess.CalledProcessError):
+                    with juju(host, args):
+                        self.fail('Models should not be used.')
+        commands = [c[0][0] for c in rc_mock.call_args_list]
+        self.assertIn(
+            'juju destroy-environment --force --yes cwr-aws', commands)
+        self.assertIn(
+            'juju destroy-environment --force --yes cwr-gce', commands)
+        self.assertNotIn(
+            ['juju', 'bootstrap', '--show-log', '-e', 'cwr-azure',
+             '--constraints', 'mem=4G'], commands)
+        self.assertNotIn(
+            'juju destroy-environment --force --yes cwr-azure', commands)
+
+    def test_record_success(self):
+        with temp_dir() as d:
+            test_plan = os.path.join(d, 'plan.yaml')
+            with open(test_plan, 'w') as f:
+                yaml.safe_dump({'bundle': 'cs:mongodb-37',
+                                'bundle_name': 'mongodb'}, f)
+            manifest_path = os.path.join(d, 'results.json')
+            args = Namespace(model=['aws', 'gce'],
+                             results_manifest=manifest_path)
+            record_success(args, test_plan)
+            fingerprints = list(ResultsManifest(manifest_path).load())
+        self.assertEqual(len(fingerprints), 1)
+        self.assertNotEqual(fingerprints[0], job_fingerprint(
+            '', {'bundle': 'cs:mongodb-37'}, ['aws', 'gce']))
+
+    def test_get_test_plans(self):
+        with temp_dir() as d:
+            plan_dir = os.path.join(d, 'plans')
+            os.mkdir(plan_dir)
+            for name in ('b.yaml', 'a.yaml', 'README'):
+                open(os.path.join(plan_dir, name), 'w').close()
+            args = parse_args(['aws', 'first.yaml', '--test-plans', plan_dir,
+                               'last.yaml'])
+            self.assertEqual(get_test_plans(args), [
+                'first.yaml', os.path.join(plan_dir, 'a.yaml'),
+                os.path.join(plan_dir, 'b.yaml'), 'last.yaml'])
+
+    def run_test_plans(self, test_plans, plan_workers=1, fail=()):
+        backend = FakeBackend()
+
+        def fake_run_container(host, container, args, test_plan, log_dir,
+                               image, backend, locks):
+            with backend.lock:
+                backend.calls.append(('run', host.test_results, test_plan,
+                                      log_dir, image))
+            if test_plan in fail:
+                raise subprocess.CalledProcessError(1, 'cwr')
+
+        with temp_dir() as d:
+            host = Host(models=['cwr-aws', 'cwr-gce'], test_results=d)
+            container = Namespace(name='seman/cwrbox')
+            args = Namespace(log_dir='/logs', plan_workers=plan_workers,
+                             bootstrap_workers=1, benchmark_db=None,
+                             image_digest=None)
+            with patch('buildcloud.build_cloud.run_container',
+                       side_effect=fake_run_container):
+                with patch('logging.error'):
+                    results = run_test_plans(
+                        host, container, args, test_plans, backend)
+            calls = [c for c in backend.calls if c[0] != 'pull_image']
+            return d, calls, results
+
+    def test_run_test_plans_single(self):
+        d, calls, results = self.run_test_plans(['/plans/mongodb.yaml'])
+        self.assertEqual(calls, [('run', d, '/plans/mongodb.yaml', '/logs',
+                                  'seman/cwrbox')])
+        self.assertEqual(list(results), ['/plans/mongodb.yaml'])
+        self.assertIsNone(results['/plans/mongodb.yaml'][0])
+
+    def test_run_test_plans_sequential(self):
+        d, calls, results = self.run_test_plans(
+            ['/plans/a.yaml', '/plans/b.yaml'], fail=['/plans/a.yaml'])
+        self.assertEqual(calls, [
+            ('run', os.path.join(d, 'a'), '/plans/a.yaml', '/logs/a',
+             'seman/cwrbox'),
+            ('reset', 'cwr-aws'),
+            ('reset', 'cwr-gce'),
+            ('run', os.path.join(d, 'b'), '/plans/b.yaml', '/logs/b',
+             'seman/cwrbox')])
+        self.assertIsInstance(results['/plans/a.yaml'][0],
+                              subprocess.CalledProcessError)
+        self.assertIsNone(results['/plans/b.yaml'][0])
+
+    def test_run_test_plans_concurrent(self):
+        with temp_dir() as plan_dir:
+            a = self.make_test_plan(plan_dir, 'a.yaml', services=['mongodb'])
+            b = self.make_test_plan(plan_dir, 'b.yaml',
+                                    services=['mediawiki', 'mysql'])
+            d, calls, results = self.run_test_plans([a, b], plan_workers=2)
+        self.assertItemsEqual(calls, [
+            ('run', os.path.join(d, 'a'), a, '/logs/a', 'seman/cwrbox'),
+            ('run', os.path.join(d, 'b'), b, '/logs/b', 'seman/cwrbox')])
+
+    def test_run_test_plans_shared_services(self):
+        with temp_dir() as plan_dir:
+            a = self.make_test_plan(plan_dir, 'a.yaml',
+                                    services=['namenode', 'pig'])
+            b = self.make_test_plan(plan_dir, 'b.yaml',
+                                    services=['namenode', 'hive'])
+            with patch('logging.warning') as lw_mock:
+                d, calls, results = self.run_test_plans(
+                    [a, b], plan_workers=2)
+        lw_mock.assert_called_once_with(
+            '{} and {} both deploy namenode; running the test plans '
+            'sequentially.'.format(a, b))
+        self.assertEqual(calls, [
+            ('run', os.path.join(d, 'a'), a, '/logs/a', 'seman/cwrbox'),
+            ('reset', 'cwr-aws'),
+            ('reset', 'cwr-gce'),
+            ('run', os.path.join(d, 'b'), b, '/logs/b', 'seman/cwrbox')])
+
+    def test_plan_workers(self):
+        args = Namespace(plan_workers=2)
+        with temp_dir() as d:
+            a = self.make_test_plan(d, 'a.yaml', services=['mongodb'])
+            b = self.make_test_plan(d, 'b.yaml', services=['mediawiki'])
+            plain = self.make_test_plan(d, 'plain.yaml')
+            self.assertEqual(plan_workers(args, [a, b]), 2)
+            self.assertEqual(plan_workers(args, [plain]), 2)
+            with patch('logging.warning') as lw_mock:
+                self.assertEqual(plan_workers(args, [a, plain]), 1)
+            lw_mock.assert_called_once_with(
+                '{} does not declare its services; running the test plans '
+                'sequentially.'.format(plain))
+
+    def test_job_graph(self):
+        backend = FakeBackend(latencies={'bootstrap': 0.1,
+                                         'pull_image': 0.1})
+        with temp_dir() as d:
+            test_plan = self.make_test_plan(d)
+            args = parse_args(['aws', 'gce', test_plan, '--juju-home',
+                               self.make_juju_home(d)])
+            with patch.dict(os.environ):
+                graph = job_graph(args, [test_plan], backend)
+                results = graph.run()
+        self.assertEqual(list(results['run']), [test_plan])
+        self.assertIsNone(results['run'][test_plan][0])
+        # The image is pulled while the models are bootstrapped.
+        self.assertLess(graph.times['pull image'].start,
+                        graph.times['models'].end)
+        self.assertEqual(backend.max_concurrent['pull_image'], 1)
+        operations = [c[0] for c in backend.calls]
+        self.assertEqual(operations[-2:], ['destroy', 'destroy'])
+        self.assertEqual(backend.models, set())
+
+    def test_job_graph_charm_cache(self):
+        backend = FakeBackend()
+        commands = []
+
+        def fake_run_container(command, results_dir):
+            commands.append(command)
+
+        with temp_dir() as d:
+            test_plan = self.make_test_plan(d)
+            cache_dir = os.path.join(d, 'charms')
+            args = parse_args(['aws', test_plan, '--juju-home',
+                               self.make_juju_home(d), '--charm-cache',
+                               cache_dir])
+            with patch.dict(os.environ):
+                with patch.object(backend, 'run_container',
+                                  side_effect=fake_run_container):
+                    with patch('buildcloud.build_cloud.print_now') as pn_mock:
+                        graph = job_graph(args, [test_plan], backend)
+                        graph.run()
+            self.assertTrue(os.path.isfile(os.path.join(
+                cache_dir, 'index.json')))
+            workspace = graph.results['env'][0].deployer_cache
+            self.assertFalse(os.path.exists(workspace))
+        self.assertEqual(os.path.dirname(workspace),
+                         os.path.join(cache_dir, 'jobs'))
+        volumes = [commands[0][i + 1] for i, arg in enumerate(commands[0])
+                   if arg == '-v']
+        self.assertIn('{}:/home/ubuntu/.juju/.deployer-store-cache'.format(
+            workspace), volumes)
+        pn_mock.assert_called_once_with(
+            'Charm cache: 0 hits, 0 misses, 0 evicted, 0 entries, 0.0 MB')
+
+    def test_job_constraints(self):
+        with temp_dir() as d:
+            small = self.make_test_plan(
+                d, 'small.yaml', constraints={'model': 'mem=1G'})
+            big = self.make_test_plan(d, 'big.yaml', constraints={
+                'bootstrap': 'mem=8G', 'model': 'mem=8G cores=4'})
+            self.assertEqual(job_constraints([small]),
+                             Constraints('mem=4G', 'mem=1G'))
+            self.assertEqual(job_constraints([small, big]),
+                             Constraints('mem=8G', 'mem=8G cores=4'))
+            plain = self.make_test_plan(d, 'plain.yaml')
+            self.assertEqual(job_constraints([plain]),
+                             Constraints('mem=4G', 'mem=2G'))
+
+    def test_job_graph_constraints(self):
+        backend = FakeBackend()
+        with temp_dir() as d:
+            test_plan = self.make_test_plan(
+                d, constraints={'model': 'mem=4G cores=2'})
+            args = parse_args(['aws', test_plan, '--juju-home',
+                               self.make_juju_home(d)])
+            with patch.dict(os.environ):
+                with patch.object(backend, 'destroy'):
+                    job_graph(args, [test_plan], backend).run()
+        self.assertEqual(list(backend.constraints.values()),
+                         [Constraints('mem=4G', 'mem=4G cores=2')])
+
+    def run_failing_job(self, d, backend):
+        """Run a job whose test plan fails, returning (args, checkpoint)."""
+        test_plan = self.make_test_plan(d)
+        args = parse_args(['aws', 'gce', test_plan, '--juju-home',
+                           self.make_juju_home(d)])
+        checkpoint = Checkpoint(os.path.join(d, 'job.json'))
+        checkpoint.reset(controllers=args.model)
+        backend.failures['run_container'] = 1
+        with patch.dict(os.environ):
+            with patch('logging.error'):
+                results = job_graph(
+                    args, [test_plan], backend, checkpoint).run()
+        self.assertIsNotNone(results['run'][test_plan][0])
+        return args, checkpoint
+
+    def test_job_graph_resume(self):
+        backend = FakeBackend()
+        with temp_dir() as d:
+            args, checkpoint = self.run_failing_job(d, backend)
+            root = checkpoint.get('root')
+            self.assertTrue(os.path.isdir(root))
+            self.assertEqual(backend.models, set(checkpoint.get('models')))
+            self.assertTrue(resumable_env(args, checkpoint))
+            self.assertFalse(resumable_env(
+                parse_args(['aws', 'plan']), checkpoint))
+            del backend.calls[:]
+            del backend.failures['run_container']
+            checkpoint = Checkpoint(checkpoint.path)
+            checkpoint.load()
+            with patch.dict(os.environ):
+                results = job_graph(
+                    args, [args.test_plan], backend, checkpoint).run()
+            self.assertIsNone(results['run'][args.test_plan][0])
+            self.assertTrue(checkpoint.done)
+            self.assertFalse(os.path.exists(root))
+        operations = [c[0] for c in backend.calls]
+        self.assertNotIn('bootstrap', operations)
+        self.assertNotIn('pull_image', operations)
+        self.assertNotIn('copy_juju_home', operations)
+        # The models ran the failed plan, so they are reset first.
+        self.assertLess(operations.index('reset'),
+                        operations.index('run_container'))
+        self.assertEqual(backend.models, set())
+
+    def test_job_graph_resume_replaces_dead_models(self):
+        backend = FakeBackend()
+        with temp_dir() as d:
+            args, checkpoint = self.run_failing_job(d, backend)
+            aws, gce = checkpoint.get('models')
+            backend.models.discard(gce)
+            del backend.calls[:]
+            del backend.failures['run_container']
+            with patch.dict(os.environ):
+                job_graph(args, [args.test_plan], backend, checkpoint).run()
+        self.assertIn(('destroy', gce), backend.calls)
+        self.assertIn(('bootstrap', gce), backend.calls)
+        self.assertNotIn(('bootstrap', aws), backend.calls)
+
+    def test_teardown(self):
+        backend = FakeBackend()
+        with temp_dir() as d:
+            args, checkpoint = self.run_failing_job(d, backend)
+            root = checkpoint.get('root')
+            with patch.dict(os.environ):
+                teardown(args, checkpoint, backend)
+            self.assertFalse(os.path.exists(root))
+            self.assertFalse(os.path.exists(checkpoint.path))
+        self.assertEqual(backend.models, set())
+
     def get_args(self):
         return Namespace(env='juju-env')
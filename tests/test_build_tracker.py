@@ -0,0 +1,136 @@
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.build_tracker import (
+    BuildTracker,
+    CANCELLED,
+    DONE,
+    LOST,
+    QUEUED,
+    TrackedBuild,
+)
+from buildcloud.jenkins_client import JenkinsClient
+from tests.fake_jenkins import FakeJenkins
+
+
+def queue_builds(client, test_plans, **kwargs):
+    tracker = BuildTracker(client, 'cwr-test', **kwargs)
+    for test_plan in test_plans:
+        job = {'test_plan': test_plan, 'controllers': 'aws'}
+        tracker.add(client.build_job('cwr-test', job), job)
+    return tracker
+
+
+class TestTrackedBuild(TestCase):
+
+    def test_update(self):
+        build = TrackedBuild(3, {}, in_queue_since=100)
+        build.update({'number': 7, 'building': True, 'result': None,
+                      'timestamp': 105000, 'duration': 0, 'url': 'u'})
+        self.assertEqual(build.status, 'RUNNING')
+        self.assertEqual(build.queue_wait, 5)
+        self.assertIsNone(build.duration)
+        self.assertFalse(build.passed)
+        build.update({'number': 7, 'building': False, 'result': 'SUCCESS',
+                      'timestamp': 105000, 'duration': 2500, 'url': 'u'})
+        self.assertEqual(build.status, 'SUCCESS')
+        self.assertEqual(build.duration, 2.5)
+        self.assertTrue(build.passed)
+
+
+class TestBuildTracker(TestCase):
+
+    def test_wait(self):
+        with FakeJenkins() as jenkins:
+            jenkins.queue_time = 0.3
+            jenkins.run_time = 0.05
+            jenkins.results['b.yaml'] = 'FAILURE'
+            client = JenkinsClient(jenkins.url)
+            tracker = queue_builds(
+                client, ['a.yaml', 'b.yaml', 'c.yaml'],
+                min_interval=0.05, max_interval=0.05)
+            builds = tracker.wait()
+        self.assertEqual([b.job['test_plan'] for b in builds],
+                         ['a.yaml', 'b.yaml', 'c.yaml'])
+        self.assertEqual([b.status for b in builds],
+                         ['SUCCESS', 'FAILURE', 'SUCCESS'])
+        self.assertEqual([b.passed for b in builds], [True, False, True])
+        for build in builds:
+            self.assertEqual(build.duration, 0.05)
+            self.assertAlmostEqual(build.queue_wait, 0.3, delta=0.05)
+        self.assertItemsEqual([b.number for b in builds], [1, 2, 3])
+        # Two requests per poll, whatever the number of builds.
+        gets = [r for r in jenkins.requests if r['method'] == 'GET' and
+                r['path'] != '/crumbIssuer/api/json']
+        self.assertEqual(len(gets), 2 * tracker.polls)
+        self.assertEqual(
+            sorted(set(r['path'] for r in gets)),
+            ['/job/cwr-test/api/json', '/queue/api/json'])
+
+    def test_wait_looks_up_unlisted_builds(self):
+        with FakeJenkins() as jenkins:
+            jenkins.hide_builds = True
+            jenkins.cancelled.add('b.yaml')
+            client = JenkinsClient(jenkins.url)
+            tracker = queue_builds(client, ['a.yaml', 'b.yaml'],
+                                   min_interval=0.01)
+            builds = tracker.wait()
+        self.assertEqual([b.state for b in builds], [DONE, CANCELLED])
+        self.assertEqual(builds[0].number, 1)
+        self.assertIsNone(builds[1].number)
+        paths = [r['path'] for r in jenkins.requests]
+        self.assertIn('/queue/item/1/api/json', paths)
+        self.assertIn('/job/cwr-test/1/api/json', paths)
+
+    def test_wait_expired_queue_item(self):
+        with FakeJenkins() as jenkins:
+            client = JenkinsClient(jenkins.url)
+            tracker = BuildTracker(client, 'cwr-test')
+            tracker.add(jenkins.url + '/queue/item/9/', {})
+            with patch('logging.warning') as warning_mock:
+                builds = tracker.wait()
+        self.assertEqual(builds[0].state, LOST)
+        self.assertEqual(warning_mock.call_count, 1)
+
+    def test_wait_timeout(self):
+        with FakeJenkins() as jenkins:
+            jenkins.queue_time = 60
+            client = JenkinsClient(jenkins.url)
+            tracker = queue_builds(client, ['a.yaml'],
+                                   min_interval=0.01)
+            builds = tracker.wait(timeout=0.05)
+        self.assertEqual(builds[0].state, QUEUED)
+        self.assertIsNone(builds[0].queue_wait)
+
+    def test_wait_adapts_interval(self):
+        with FakeJenkins() as jenkins:
+            jenkins.queue_time = 60
+            client = JenkinsClient(jenkins.url)
+            tracker = queue_builds(client, ['a.yaml'],
+                                   min_interval=1, max_interval=3)
+            calls = []
+
+            def sleep(delay):
+                calls.append(delay)
+                if len(calls) == 4:
+                    jenkins.queue_time = 0
+                if len(calls) == 5:
+                    jenkins.run_time = 0
+
+            jenkins.run_time = 60
+            with patch('time.sleep', side_effect=sleep):
+                builds = tracker.wait()
+        self.assertEqual(builds[0].state, DONE)
+        self.assertEqual(calls, [1.5, 2.25, 3, 3, 1])
+
+    def test_wait_retries_failed_polls(self):
+        with FakeJenkins() as jenkins:
+            client = JenkinsClient(jenkins.url, retries=0)
+            tracker = queue_builds(client, ['a.yaml'],
+                                   min_interval=0.01)
+            jenkins.fail_next(1)
+            with patch('logging.warning') as warning_mock:
+                builds = tracker.wait()
+        self.assertEqual(builds[0].state, DONE)
+        self.assertEqual(warning_mock.call_count, 1)
@@ -0,0 +1,127 @@
+import os
+import time
+from unittest import TestCase
+
+from buildcloud.charm_cache import (
+    CharmCache,
+    tree_stats,
+)
+from buildcloud.utility import (
+    file_lock,
+    temp_dir,
+)
+
+
+def add_entry(cache, name, size, age=0, store=None):
+    path = os.path.join(store or cache.store, name)
+    os.makedirs(path)
+    with open(os.path.join(path, 'charm.zip'), 'wb') as f:
+        f.write(b'x' * size)
+    when = time.time() - age
+    os.utime(os.path.join(path, 'charm.zip'), (when, when))
+    return path
+
+
+class TestCharmCache(TestCase):
+
+    def test_tree_stats(self):
+        with temp_dir() as d:
+            cache = CharmCache(d)
+            os.makedirs(cache.store)
+            path = add_entry(cache, 'cs_trusty_mongodb-37', 10, age=100)
+            with open(os.path.join(path, 'metadata.yaml'), 'w') as f:
+                f.write('name: mongodb\n')
+            size, atime, mtime = tree_stats(path)
+        self.assertEqual(size, 24)
+        self.assertGreater(mtime, time.time() - 10)
+
+    def test_using_records_hits_and_misses(self):
+        with temp_dir() as d:
+            cache = CharmCache(d)
+            os.makedirs(cache.store)
+            add_entry(cache, 'cs_trusty_mongodb-37', 10, age=100)
+            add_entry(cache, 'cs_trusty_haproxy-2', 10, age=100)
+            workspace = cache.workspace('job1')
+            with cache.using(workspace):
+                with open(os.path.join(workspace, 'cs_trusty_mongodb-37',
+                                       'charm.zip')) as f:
+                    f.read()
+                add_entry(cache, 'cs_trusty_mysql-5', 10, store=workspace)
+            index = cache.load_index()
+            self.assertEqual(sorted(os.listdir(cache.store)), [
+                'cs_trusty_haproxy-2', 'cs_trusty_mongodb-37',
+                'cs_trusty_mysql-5'])
+            self.assertFalse(os.path.exists(workspace))
+        self.assertEqual(cache.stats, {
+            'hits': 1, 'misses': 1, 'evicted': 0, 'entries': 3,
+            'size': 30})
+        self.assertEqual(sorted(index),
+                         ['cs_trusty_mongodb-37', 'cs_trusty_mysql-5'])
+        self.assertEqual(
+            cache.format_stats(),
+            'Charm cache: 1 hits, 1 misses, 0 evicted, 3 entries, 0.0 MB')
+
+    def test_concurrent_downloads_publish_once(self):
+        with temp_dir() as d:
+            cache = CharmCache(d)
+            first, second = cache.workspace('job1'), cache.workspace('job2')
+            with cache.using(first):
+                with CharmCache(d).using(second):
+                    add_entry(cache, 'cs_trusty_mysql-5', 10, store=second)
+                    add_entry(cache, 'cs_trusty_mysql-5', 20, store=first)
+                    # Nothing is written to the store while jobs run.
+                    self.assertEqual(os.listdir(cache.store), [])
+                # The first job to finish adds the entry.
+                with open(os.path.join(cache.store, 'cs_trusty_mysql-5',
+                                       'charm.zip'), 'rb') as f:
+                    self.assertEqual(len(f.read()), 10)
+            self.assertEqual(cache.stats['misses'], 1)
+            self.assertEqual(cache.stats['size'], 10)
+            self.assertFalse(os.path.exists(first))
+
+    def test_using_keeps_other_jobs_access_times(self):
+        with temp_dir() as d:
+            cache = CharmCache(d)
+            os.makedirs(cache.store)
+            path = add_entry(cache, 'cs_trusty_mongodb-37', 10, age=100)
+            read = time.time()
+            os.utime(os.path.join(path, 'charm.zip'), (read, read - 100))
+            with file_lock(cache.usage_lock, shared=True):
+                with cache.using(cache.workspace('job1')):
+                    pass
+            self.assertEqual(
+                os.stat(os.path.join(path, 'charm.zip')).st_atime, read)
+            with cache.using(cache.workspace('job2')):
+                pass
+            self.assertLess(
+                os.stat(os.path.join(path, 'charm.zip')).st_atime, read)
+
+    def test_evict_least_recently_used(self):
+        with temp_dir() as d:
+            cache = CharmCache(d, max_size=25)
+            os.makedirs(cache.store)
+            add_entry(cache, 'old', 10, age=300)
+            add_entry(cache, 'used', 10, age=200)
+            add_entry(cache, 'new', 10, age=100)
+            cache.save_index({'used': time.time()})
+            evicted = cache.evict()
+            remaining = sorted(os.listdir(cache.store))
+        self.assertEqual(evicted, ['old'])
+        self.assertEqual(remaining, ['new', 'used'])
+
+    def test_evict_skipped_while_in_use(self):
+        with temp_dir() as d:
+            cache = CharmCache(d, max_size=0)
+            os.makedirs(cache.store)
+            add_entry(cache, 'cs_trusty_mongodb-37', 10)
+            with file_lock(cache.usage_lock, shared=True):
+                self.assertEqual(cache.evict(), [])
+            self.assertEqual(cache.evict(), ['cs_trusty_mongodb-37'])
+
+    def test_evict_removes_stale_workspaces(self):
+        with temp_dir() as d:
+            cache = CharmCache(d)
+            os.makedirs(cache.store)
+            os.makedirs(cache.workspace('dead-job'))
+            cache.evict()
+            self.assertFalse(os.path.exists(cache.workspaces))
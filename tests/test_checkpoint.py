@@ -0,0 +1,52 @@
+import json
+import os
+from unittest import TestCase
+
+from buildcloud.checkpoint import Checkpoint
+from buildcloud.utility import temp_dir
+
+
+class TestCheckpoint(TestCase):
+
+    def test_update_and_load(self):
+        with temp_dir() as d:
+            path = os.path.join(d, 'state', 'job.json')
+            checkpoint = Checkpoint(path)
+            self.assertEqual(checkpoint.load(), {})
+            checkpoint.reset(controllers=['aws'])
+            checkpoint.update(root='/tmp/cwr_tst_x')
+            checkpoint.add('passed', 'a.yaml')
+            checkpoint.add('passed', 'a.yaml')
+            with open(path) as f:
+                saved = json.load(f)
+            loaded = Checkpoint(path)
+            loaded.load()
+        self.assertEqual(saved, {'controllers': ['aws'],
+                                 'root': '/tmp/cwr_tst_x',
+                                 'passed': ['a.yaml']})
+        self.assertEqual(loaded.get('passed'), ['a.yaml'])
+        self.assertFalse(loaded.done)
+
+    def test_reset(self):
+        with temp_dir() as d:
+            checkpoint = Checkpoint(os.path.join(d, 'job.json'))
+            checkpoint.update(root='/tmp/x', done=True)
+            checkpoint.reset(controllers=['gce'])
+            self.assertEqual(checkpoint.state, {'controllers': ['gce']})
+            self.assertFalse(checkpoint.done)
+
+    def test_clear(self):
+        with temp_dir() as d:
+            checkpoint = Checkpoint(os.path.join(d, 'job.json'))
+            checkpoint.update(done=True)
+            checkpoint.clear()
+            self.assertFalse(os.path.exists(checkpoint.path))
+            self.assertEqual(checkpoint.state, {})
+            checkpoint.clear()
+
+    def test_load_corrupt(self):
+        with temp_dir() as d:
+            path = os.path.join(d, 'job.json')
+            with open(path, 'w') as f:
+                f.write('{')
+            self.assertEqual(Checkpoint(path).load(), {})
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from buildcloud.constraints import (
+    Constraints,
+    merge_constraints,
+    parse_constraints,
+    plan_constraints,
+    validate_constraints,
+)
+
+
+class TestConstraints(TestCase):
+
+    def test_parse_constraints(self):
+        self.assertEqual(list(parse_constraints('mem=4G cores=2').items()),
+                         [('mem', '4G'), ('cores', '2')])
+        self.assertEqual(parse_constraints(None), {})
+        with self.assertRaises(ValueError):
+            parse_constraints('mem')
+
+    def test_merge_constraints(self):
+        self.assertEqual(merge_constraints(
+            ['mem=2G arch=amd64', 'mem=3072M cores=2', 'mem=1G arch=arm64']),
+            'mem=3072M arch=amd64 cores=2')
+        self.assertEqual(merge_constraints([]), '')
+
+    def test_validate_constraints(self):
+        self.assertEqual(validate_constraints(
+            {'bootstrap': 'mem=4G', 'model': 'mem=2G cores=2'}), [])
+        self.assertEqual(validate_constraints(
+            {'models': 'mem=2G', 'model': 'mem=lots', 'bootstrap': 4}), [
+            "unknown constraints 'models'",
+            "invalid bootstrap constraints 4",
+            "invalid model constraints 'mem=lots'"])
+
+    def test_plan_constraints(self):
+        self.assertEqual(plan_constraints([{}]),
+                         Constraints('mem=4G', 'mem=2G'))
+        self.assertEqual(plan_constraints([
+            {'constraints': {'model': 'mem=8G'}},
+            {'constraints': {'model': 'mem=4G cores=4'}}]),
+            Constraints('mem=4G', 'mem=8G cores=4'))
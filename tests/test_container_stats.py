@@ -0,0 +1,102 @@
+import json
+import os
+from unittest import TestCase
+
+from buildcloud.container_stats import (
+    FIELDS,
+    parse_docker_stats,
+    parse_size,
+    StatsSampler,
+)
+from buildcloud.utility import temp_dir
+
+
+DOCKER_STATS = json.dumps({
+    'BlockIO': '4.1MB / 20.5kB', 'CPUPerc': '153.25%',
+    'Container': 'cwr_tst_abc-mongodb', 'MemPerc': '12.50%',
+    'MemUsage': '512MiB / 4GiB', 'NetIO': '1.2kB / 648B', 'PIDs': '37'})
+
+
+def fake_stats(cpu, memory):
+    stats = dict((field, 0) for field in FIELDS)
+    stats.update(cpu=cpu, memory=memory)
+    return stats
+
+
+class TestParse(TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(parse_size('0B'), 0)
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('2g'), 2 * 1024 ** 3)
+        self.assertEqual(parse_size('1.5GiB'), int(1.5 * 1024 ** 3))
+        self.assertEqual(parse_size(' 20kB'), 20000)
+        for invalid in ('', 'lots', '2 parsecs'):
+            with self.assertRaises(ValueError):
+                parse_size(invalid)
+
+    def test_parse_docker_stats(self):
+        self.assertEqual(parse_docker_stats(DOCKER_STATS), {
+            'cpu': 153.25, 'memory': 512 * 1024 ** 2,
+            'block_read': 4100000, 'block_write': 20500,
+            'net_rx': 1200, 'net_tx': 648, 'pids': 37})
+
+
+class TestStatsSampler(TestCase):
+
+    def make_sampler(self, readings):
+        readings = list(readings)
+        sampler = StatsSampler(lambda: readings.pop(0), 1)
+        sampler.start = 0
+        for _ in range(len(readings)):
+            sampler.sample()
+        return sampler
+
+    def test_summary(self):
+        sampler = self.make_sampler([
+            None, fake_stats(50, 100), fake_stats(150, 300)])
+        self.assertEqual(len(sampler.samples), 2)
+        summary = sampler.summary()
+        self.assertEqual(summary['cpu'], {'peak': 150, 'mean': 100})
+        self.assertEqual(summary['memory'], {'peak': 300, 'mean': 200})
+
+    def test_sample_error(self):
+        def read():
+            raise ValueError('bad stats')
+
+        sampler = StatsSampler(read, 1)
+        sampler.start = 0
+        sampler.sample()
+        self.assertEqual(sampler.samples, [])
+        self.assertEqual(sampler.format_summary('job'), 'job: no samples')
+
+    def test_over_budget(self):
+        sampler = self.make_sampler([fake_stats(150, 3 * 1024 ** 2)])
+        self.assertEqual(sampler.over_budget(), [])
+        self.assertEqual(sampler.over_budget(4 * 1024 ** 2, 200), [])
+        self.assertEqual(sampler.over_budget(2 * 1024 ** 2, 100), [
+            'peak memory 3.0 MiB > 2.0 MiB', 'peak CPU 150.0% > 100.0%'])
+
+    def test_running(self):
+        readings = []
+
+        def read():
+            readings.append(1)
+            return fake_stats(10, 10)
+
+        sampler = StatsSampler(read, 0.01)
+        with sampler.running():
+            while len(readings) < 3:
+                pass
+        self.assertGreaterEqual(len(sampler.samples), 3)
+
+    def test_write(self):
+        sampler = self.make_sampler([fake_stats(50, 100)])
+        with temp_dir() as d:
+            path = os.path.join(d, 'stats.json')
+            sampler.write(path)
+            with open(path) as f:
+                written = json.load(f)
+        self.assertEqual(written['fields'], ['time'] + list(FIELDS))
+        self.assertEqual(written['samples'][0][1:], [50, 100, 0, 0, 0, 0, 0])
+        self.assertEqual(written['summary']['cpu']['peak'], 50)
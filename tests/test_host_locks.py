@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.host_locks import (
+    HostLocks,
+    HostSemaphore,
+)
+from buildcloud.utility import (
+    run_concurrently,
+    temp_dir,
+)
+
+
+class TestHostSemaphore(TestCase):
+
+    def test_held(self):
+        with temp_dir() as d:
+            semaphore = HostSemaphore(d, 'bootstrap', 2)
+            with semaphore.held():
+                with semaphore.held():
+                    self.assertIsNone(semaphore.try_acquire())
+                f = semaphore.try_acquire()
+                self.assertIsNotNone(f)
+                f.close()
+            self.assertItemsEqual(
+                os.listdir(d), ['bootstrap.0.lock', 'bootstrap.1.lock'])
+
+    def test_held_waits_for_a_slot(self):
+        with temp_dir() as d:
+            semaphore = HostSemaphore(d, 'bootstrap', 1, poll_interval=0.01)
+            lock = threading.Lock()
+            holders = []
+            most = []
+
+            def hold(index):
+                with semaphore.held():
+                    with lock:
+                        holders.append(index)
+                        most.append(len(holders))
+                    time.sleep(0.02)
+                    with lock:
+                        holders.remove(index)
+
+            with patch('logging.info'):
+                errors = run_concurrently(hold, range(4), 4)
+        self.assertEqual(list(errors.values()), [None] * 4)
+        self.assertEqual(max(most), 1)
+
+
+class TestHostLocks(TestCase):
+
+    def test_holding(self):
+        with temp_dir() as d:
+            locks = HostLocks(d, {'bootstrap': 2}, {'bootstrap': 1})
+            with locks.holding('bootstrap', ['gce', 'aws']):
+                self.assertItemsEqual(os.listdir(d), [
+                    'bootstrap.0.lock', 'bootstrap-aws.0.lock',
+                    'bootstrap-gce.0.lock'])
+                aws = HostSemaphore(d, 'bootstrap-aws', 1)
+                self.assertIsNone(aws.try_acquire())
+                with locks.holding('bootstrap', ['azure']):
+                    pass
+            f = aws.try_acquire()
+            self.assertIsNotNone(f)
+            f.close()
+
+    def test_holding_unlimited(self):
+        with temp_dir() as d:
+            locks = HostLocks(os.path.join(d, 'locks'), {'bootstrap': None})
+            with locks.holding('bootstrap', ['aws']):
+                with locks.holding('container', ['aws']):
+                    pass
+            self.assertFalse(os.path.exists(locks.directory))
+
+    def test_holding_releases_on_error(self):
+        with temp_dir() as d:
+            locks = HostLocks(d, {'container': 1})
+            with self.assertRaises(ValueError):
+                with locks.holding('container'):
+                    raise ValueError()
+            f = HostSemaphore(d, 'container', 1).try_acquire()
+            self.assertIsNotNone(f)
+            f.close()
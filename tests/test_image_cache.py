@@ -0,0 +1,162 @@
+import json
+import os
+import sys
+import time
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.image_cache import (
+    image_reference,
+    ImageCache,
+)
+from buildcloud.utility import (
+    run_concurrently,
+    temp_dir,
+)
+
+FAKE_DOCKER = os.path.join(os.path.dirname(__file__), 'fake_docker.py')
+
+
+class FakeRegistry:
+
+    def __init__(self, directory, registry, local=None):
+        self.state = os.path.join(directory, 'docker.json')
+        self.write({'registry': registry, 'local': local or {}, 'calls': []})
+        self.docker = '{} {} --state {}'.format(
+            sys.executable, FAKE_DOCKER, self.state)
+
+    def read(self):
+        with open(self.state) as f:
+            return json.load(f)
+
+    def write(self, state):
+        with open(self.state, 'w') as f:
+            json.dump(state, f)
+
+    def pulls(self):
+        return [c for c in self.read()['calls'] if c[0] == 'pull']
+
+
+class TestImageCache(TestCase):
+
+    def setUp(self):
+        print_patcher = patch('buildcloud.utility.print_now')
+        print_patcher.start()
+        self.addCleanup(print_patcher.stop)
+
+    def make_cache(self, directory, registry, ttl=3600):
+        return ImageCache(os.path.join(directory, 'cache', 'images.json'),
+                          ttl=ttl, docker=registry.docker)
+
+    def test_image_reference(self):
+        self.assertEqual(image_reference('seman/cwrbox'), 'seman/cwrbox')
+        self.assertEqual(image_reference('seman/cwrbox', 'sha256:abc'),
+                         'seman/cwrbox@sha256:abc')
+
+    def test_ensure_pulls_missing_image(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:aaa'})
+            cache = self.make_cache(d, registry)
+            self.assertEqual(cache.ensure('seman/cwrbox'), 'seman/cwrbox')
+            self.assertEqual(registry.pulls(), [['pull', 'seman/cwrbox']])
+            entry = cache.load()['seman/cwrbox']
+            self.assertEqual(entry['digest'], 'sha256:aaa')
+
+    def test_ensure_skips_fresh_image(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:aaa'})
+            cache = self.make_cache(d, registry)
+            cache.ensure('seman/cwrbox')
+            cache.ensure('seman/cwrbox')
+            self.assertEqual(len(registry.pulls()), 1)
+
+    def test_ensure_pulls_when_ttl_expired(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:aaa'},
+                                    local={'seman/cwrbox': 'sha256:aaa'})
+            cache = self.make_cache(d, registry)
+            cache.record('seman/cwrbox', 'sha256:aaa',
+                         pulled_at=time.time() - 7200)
+            cache.ensure('seman/cwrbox')
+            self.assertEqual(len(registry.pulls()), 1)
+
+    def test_ensure_pulls_when_local_digest_changed(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:bbb'},
+                                    local={'seman/cwrbox': 'sha256:old'})
+            cache = self.make_cache(d, registry)
+            cache.record('seman/cwrbox', 'sha256:aaa')
+            cache.ensure('seman/cwrbox')
+            self.assertEqual(len(registry.pulls()), 1)
+            self.assertEqual(cache.load()['seman/cwrbox']['digest'],
+                             'sha256:bbb')
+
+    def test_ensure_zero_ttl_always_pulls(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:aaa'})
+            cache = self.make_cache(d, registry, ttl=0)
+            cache.ensure('seman/cwrbox')
+            cache.ensure('seman/cwrbox')
+            self.assertEqual(len(registry.pulls()), 2)
+
+    def test_pull_timeouts(self):
+        with temp_dir() as d:
+            cache = ImageCache(os.path.join(d, 'images.json'), timeout=600,
+                               idle_timeout=30)
+            with patch('buildcloud.image_cache.run_command',
+                       autospec=True) as rc_mock:
+                with patch.object(cache, 'local_digest', autospec=True,
+                                  return_value='sha256:aaa'):
+                    cache.pull('seman/cwrbox')
+        rc_mock.assert_called_once_with(
+            ['sudo', 'docker', 'pull', 'seman/cwrbox'], timeout=600,
+            idle_timeout=30)
+
+    def test_ensure_background_pull(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:aaa'},
+                                    local={'seman/cwrbox': 'sha256:aaa'})
+            cache = self.make_cache(d, registry, ttl=0)
+            with patch('threading.Thread', autospec=True) as thread_mock:
+                reference = cache.ensure('seman/cwrbox', background=True)
+            self.assertEqual(reference, 'seman/cwrbox')
+            thread_mock.assert_called_once_with(
+                target=cache.background_pull, args=('seman/cwrbox',))
+            thread_mock.return_value.start.assert_called_once_with()
+            self.assertEqual(registry.pulls(), [])
+
+    def test_background_pull_logs_failures(self):
+        with temp_dir() as d:
+            cache = self.make_cache(d, FakeRegistry(d, {}))
+            with patch.object(cache, 'pull', autospec=True,
+                              side_effect=ValueError('boom')):
+                with patch('logging.warning') as warning_mock:
+                    cache.background_pull('seman/cwrbox')
+        warning_mock.assert_called_once_with(
+            'Unable to refresh seman/cwrbox: boom')
+
+    def test_record_concurrently(self):
+        with temp_dir() as d:
+            cache = self.make_cache(d, FakeRegistry(d, {}))
+            images = ['image-{}'.format(i) for i in range(20)]
+            errors = run_concurrently(
+                lambda image: cache.record(image, 'sha256:aaa'), images, 10)
+            self.assertEqual(list(errors.values()), [None] * 20)
+            self.assertEqual(sorted(cache.load()), sorted(images))
+
+    def test_ensure_pinned_digest(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {'seman/cwrbox': 'sha256:aaa'})
+            cache = self.make_cache(d, registry, ttl=0)
+            reference = cache.ensure('seman/cwrbox', digest='sha256:aaa')
+            self.assertEqual(reference, 'seman/cwrbox@sha256:aaa')
+            cache.ensure('seman/cwrbox', digest='sha256:aaa')
+            self.assertEqual(registry.pulls(),
+                             [['pull', 'seman/cwrbox@sha256:aaa']])
+
+    def test_local_digest_missing(self):
+        with temp_dir() as d:
+            registry = FakeRegistry(d, {})
+            cache = self.make_cache(d, registry)
+            self.assertIsNone(cache.local_digest('seman/cwrbox'))
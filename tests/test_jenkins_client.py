@@ -0,0 +1,95 @@
+import socket
+from unittest import TestCase
+
+from mock import (
+    call,
+    patch,
+)
+
+from buildcloud.jenkins_client import (
+    JenkinsClient,
+    JenkinsError,
+    RateLimiter,
+)
+from tests.fake_jenkins import FakeJenkins
+
+
+class TestRateLimiter(TestCase):
+
+    def test_wait(self):
+        limiter = RateLimiter(rate=2)
+        with patch('time.time', return_value=100.0):
+            with patch('time.sleep') as sleep_mock:
+                for _ in range(3):
+                    limiter.wait()
+        self.assertEqual(sleep_mock.call_args_list, [call(0.5), call(1.0)])
+
+    def test_wait_unlimited(self):
+        limiter = RateLimiter()
+        with patch('time.sleep') as sleep_mock:
+            for _ in range(3):
+                limiter.wait()
+        self.assertEqual(sleep_mock.call_count, 0)
+
+
+class TestJenkinsClient(TestCase):
+
+    def test_build_job(self):
+        with FakeJenkins() as jenkins:
+            client = JenkinsClient(jenkins.url, ('joe', 'pass'))
+            queue_url = client.build_job(
+                'cwr-test', {'test_plan': 'a.yaml'}, token='secret')
+        self.assertEqual(queue_url, jenkins.url + '/queue/item/1/')
+        self.assertEqual(jenkins.builds,
+                         [{'test_plan': 'a.yaml', 'token': 'secret'}])
+
+    def test_request_does_not_retry_client_errors(self):
+        with FakeJenkins() as jenkins:
+            client = JenkinsClient(jenkins.url)
+            with patch('time.sleep') as sleep_mock:
+                with self.assertRaises(JenkinsError) as ctx:
+                    client.request('GET', '/missing')
+        self.assertEqual(ctx.exception.status, 404)
+        self.assertEqual(sleep_mock.call_count, 0)
+        self.assertEqual(len(jenkins.requests), 1)
+
+    def test_request_reuses_connection(self):
+        with FakeJenkins() as jenkins:
+            client = JenkinsClient(jenkins.url, pool_size=1)
+            for _ in range(3):
+                client.build_job('cwr-test', {'test_plan': 'a.yaml'})
+        self.assertEqual(len(jenkins.builds), 3)
+        self.assertEqual(len(jenkins.clients), 1)
+
+    def test_request_does_not_retry_failed_posts(self):
+        with FakeJenkins() as jenkins:
+            jenkins.fail_next(1, 503, method='POST')
+            client = JenkinsClient(jenkins.url)
+            with patch('time.sleep') as sleep_mock:
+                with self.assertRaises(JenkinsError) as ctx:
+                    client.build_job('cwr-test', {'test_plan': 'a.yaml'})
+        self.assertEqual(ctx.exception.status, 503)
+        self.assertEqual(sleep_mock.call_count, 0)
+        self.assertEqual(
+            [r['method'] for r in jenkins.requests], ['GET', 'POST'])
+
+    def test_request_retries_unsent_posts(self):
+        with FakeJenkins() as jenkins:
+            url = jenkins.url
+        client = JenkinsClient(url, retries=2, backoff=0)
+        client.crumb = {}
+        with patch('logging.warning') as warning_mock:
+            with self.assertRaises(socket.error):
+                client.build_job('cwr-test', {'test_plan': 'a.yaml'})
+        self.assertEqual(warning_mock.call_count, 2)
+
+    def test_request_retries_posts_on_closed_connections(self):
+        with FakeJenkins() as jenkins:
+            jenkins.drop_connections = True
+            client = JenkinsClient(jenkins.url, pool_size=1, backoff=0)
+            with patch('logging.warning') as warning_mock:
+                for _ in range(3):
+                    client.build_job('cwr-test', {'test_plan': 'a.yaml'})
+        self.assertEqual(len(jenkins.builds), 3)
+        # Each POST first went out on the connection Jenkins had closed.
+        self.assertEqual(warning_mock.call_count, 3)
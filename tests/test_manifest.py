@@ -0,0 +1,41 @@
+import os
+from unittest import TestCase
+
+from buildcloud.manifest import (
+    job_fingerprint,
+    ResultsManifest,
+)
+from buildcloud.utility import temp_dir
+
+
+class TestJobFingerprint(TestCase):
+
+    def test_job_fingerprint(self):
+        plan = {'bundle': 'cs:mongodb-37', 'bundle_name': 'mongodb'}
+        fingerprint = job_fingerprint('abc', plan, ['aws', 'gce'])
+        self.assertEqual(fingerprint,
+                         job_fingerprint('abc', plan, ['gce', 'aws']))
+        self.assertNotEqual(fingerprint,
+                            job_fingerprint('abd', plan, ['aws', 'gce']))
+        self.assertNotEqual(fingerprint,
+                            job_fingerprint('abc', plan, ['aws']))
+        self.assertNotEqual(fingerprint, job_fingerprint(
+            'abc', dict(plan, bundle='cs:mongodb-38'), ['aws', 'gce']))
+
+
+class TestResultsManifest(TestCase):
+
+    def test_record_success(self):
+        with temp_dir() as d:
+            manifest = ResultsManifest(os.path.join(d, 'cache', 'r.json'))
+            manifest.record_success('abc', 'plan.yaml', timestamp=100)
+            self.assertEqual(manifest.load(), {
+                'abc': {'test_plan': 'plan.yaml', 'timestamp': 100}})
+
+    def test_recent(self):
+        with temp_dir() as d:
+            manifest = ResultsManifest(os.path.join(d, 'r.json'))
+            self.assertEqual(manifest.recent(60), set())
+            manifest.record_success('old', 'a.yaml', timestamp=100)
+            manifest.record_success('new', 'b.yaml', timestamp=150)
+            self.assertEqual(manifest.recent(60, now=200), set(['new']))
@@ -0,0 +1,263 @@
+import json
+import os
+import sys
+import time
+from unittest import TestCase
+
+from mock import (
+    call,
+    patch,
+)
+import yaml
+
+from buildcloud.model_pool import (
+    EXPIRING,
+    IDLE,
+    LEASED,
+    ModelPool,
+    reset_model,
+    ResetTimeout,
+)
+from buildcloud.utility import temp_dir
+
+FAKE_JUJU = '{} {}'.format(
+    sys.executable, os.path.join(os.path.dirname(__file__), 'fake_juju.py'))
+
+
+class TestResetModel(TestCase):
+
+    def test_reset_model(self):
+        status = yaml.safe_dump({
+            'machines': {'0': {}, '1': {}, '2': {}},
+            'services': {'mongodb': {}, 'benchmark-gui': {}}})
+        reset = yaml.safe_dump({'machines': {'0': {}}, 'services': {}})
+        with patch('buildcloud.model_pool.get_output', autospec=True,
+                   side_effect=[status, reset]) as go_mock:
+            with patch('buildcloud.model_pool.run_command',
+                       autospec=True) as rc_mock:
+                reset_model('cwr-aws', env={'JUJU_HOME': '/j'})
+        self.assertEqual(go_mock.call_args_list, [call(
+            ['juju', 'status', '--format', 'yaml', '-e', 'cwr-aws'],
+            env={'JUJU_HOME': '/j'})] * 2)
+        self.assertEqual([c[0][0] for c in rc_mock.call_args_list], [
+            ['juju', 'destroy-service', '-e', 'cwr-aws', 'benchmark-gui'],
+            ['juju', 'destroy-service', '-e', 'cwr-aws', 'mongodb'],
+            ['juju', 'destroy-machine', '--force', '-e', 'cwr-aws', '1',
+             '2']])
+
+    def test_reset_model_empty(self):
+        status = yaml.safe_dump({'machines': {'0': {}}, 'services': {}})
+        with patch('buildcloud.model_pool.get_output', autospec=True,
+                   return_value=status):
+            with patch('buildcloud.model_pool.run_command',
+                       autospec=True) as rc_mock:
+                reset_model('cwr-aws')
+        self.assertEqual(rc_mock.call_count, 0)
+
+    def test_reset_model_waits_for_destruction(self):
+        with temp_dir() as juju_home:
+            with open(os.path.join(juju_home, 'fake-juju.json'), 'w') as f:
+                json.dump({'linger': 3, 'models': {'cwr-aws': {
+                    'machines': {'0': {}, '1': {}},
+                    'services': {'mongodb': {'units': ['1']}}}}}, f)
+            env = dict(os.environ, JUJU_HOME=juju_home)
+            reset_model('cwr-aws', FAKE_JUJU, env, poll_interval=0.01)
+            with open(os.path.join(juju_home, 'fake-juju.json')) as f:
+                state = json.load(f)
+        self.assertEqual(state['models']['cwr-aws'],
+                         {'machines': {'0': {}}, 'services': {}})
+        statuses = [c for c in state['calls'] if c[0] == 'status']
+        # The initial status, three that still list the dying services and
+        # machines, and the one that finds them gone.
+        self.assertEqual(len(statuses), 5)
+
+    def test_reset_model_timeout(self):
+        status = yaml.safe_dump({
+            'machines': {'0': {}, '1': {}}, 'services': {'mongodb': {}}})
+        with patch('buildcloud.model_pool.get_output', autospec=True,
+                   return_value=status):
+            with patch('buildcloud.model_pool.run_command', autospec=True):
+                with self.assertRaisesRegexp(
+                        ResetTimeout, r"cwr-aws still has services "
+                        r"\['mongodb'\] and machines \['1'\]"):
+                    reset_model('cwr-aws', timeout=0.05, poll_interval=0.01)
+
+
+class TestModelPool(TestCase):
+
+    def setUp(self):
+        patcher = patch('buildcloud.utility.print_now')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ('info', 'warning', 'error'):
+            patcher = patch('logging.{}'.format(name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_pool(self, directory, **kwargs):
+        juju_home = os.path.join(directory, 'cloud-city')
+        os.mkdir(juju_home)
+        with open(os.path.join(juju_home, 'environments.yaml'), 'w') as f:
+            yaml.safe_dump({'environments': {
+                'aws': {'type': 'ec2'}, 'gce': {'type': 'gce'}}}, f)
+        return ModelPool(os.path.join(directory, 'pool'), juju_home,
+                         juju=FAKE_JUJU, **kwargs)
+
+    def juju_state(self, pool):
+        with open(os.path.join(pool.juju_home, 'fake-juju.json')) as f:
+            return json.load(f)
+
+    def set_juju_state(self, pool, **kwargs):
+        state = self.juju_state(pool)
+        state.update(kwargs)
+        with open(os.path.join(pool.juju_home, 'fake-juju.json'), 'w') as f:
+            json.dump(state, f)
+
+    def environments(self, pool):
+        with open(os.path.join(pool.juju_home, 'environments.yaml')) as f:
+            return yaml.safe_load(f)['environments']
+
+    def bootstraps(self, pool):
+        return [c for c in self.juju_state(pool)['calls']
+                if c[0] == 'bootstrap']
+
+    def test_lease_bootstraps_new_model(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            name = pool.lease('aws')
+            self.assertTrue(name.startswith('cwr-aws-'))
+            self.assertEqual(self.environments(pool)[name], {'type': 'ec2'})
+            self.assertIn(name, self.juju_state(pool)['models'])
+            entry = pool.load()[name]
+            self.assertEqual(entry['status'], LEASED)
+            self.assertEqual(entry['controller'], 'aws')
+            self.assertIsNotNone(entry['bootstrapped_at'])
+
+    def test_release_and_reuse(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            name = pool.lease('aws')
+            pool.run_juju('deploy', '-e', name, 'mongodb')
+            pool.release(name)
+            self.assertEqual(pool.load()[name]['status'], IDLE)
+            self.assertEqual(self.juju_state(pool)['models'][name],
+                             {'machines': {'0': {}}, 'services': {}})
+            self.assertEqual(pool.lease('aws'), name)
+            self.assertEqual(len(self.bootstraps(pool)), 1)
+            self.assertNotEqual(pool.lease('aws'), name)
+            self.assertEqual(len(self.bootstraps(pool)), 2)
+
+    def test_lease_other_controller(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            aws = pool.lease('aws')
+            pool.release(aws)
+            gce = pool.lease('gce')
+            self.assertNotEqual(aws, gce)
+            self.assertTrue(gce.startswith('cwr-gce-'))
+
+    def test_lease_replaces_unhealthy_model(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            name = pool.lease('aws')
+            pool.release(name)
+            self.set_juju_state(pool, unhealthy=[name])
+            new_name = pool.lease('aws')
+            self.assertNotEqual(new_name, name)
+            self.assertNotIn(name, pool.load())
+            self.assertNotIn(name, self.environments(pool))
+
+    def test_lease_bootstrap_failure(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            pool.ensure_juju_home()
+            with open(os.path.join(pool.juju_home, 'fake-juju.json'),
+                      'w') as f:
+                json.dump({'fail_bootstrap': ['cwr-aws-deadbeef']}, f)
+            with patch('uuid.uuid4') as uuid_mock:
+                uuid_mock.return_value.hex = 'deadbeef'
+                with self.assertRaises(Exception):
+                    pool.lease('aws')
+            self.assertEqual(pool.load(), {})
+            self.assertEqual(set(self.environments(pool)),
+                             set(['aws', 'gce']))
+
+    def test_release_destroys_unresettable_model(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            name = pool.lease('aws')
+            self.set_juju_state(pool, unhealthy=[name])
+            pool.release(name)
+            self.assertEqual(pool.load(), {})
+
+    def test_expire(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d, max_lease_age=100, max_model_age=1000)
+            stale = pool.lease('aws')
+            old = pool.lease('aws')
+            fresh = pool.lease('gce')
+            pool.release(old)
+            pool.release(fresh)
+            state = pool.load()
+            state[stale]['leased_at'] -= 200
+            state[old]['bootstrapped_at'] -= 2000
+            pool.save(state)
+            self.assertEqual(pool.expire(), sorted([stale, old]))
+            self.assertEqual(list(pool.load()), [fresh])
+            self.assertEqual(list(self.juju_state(pool)['models']), [fresh])
+
+    def test_expire_marks_models_before_destroying_them(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d, max_lease_age=100)
+            stale = pool.lease('aws')
+            state = pool.load()
+            state[stale]['leased_at'] -= 200
+            pool.save(state)
+            statuses = []
+
+            def destroy(name):
+                statuses.append(pool.load()[name]['status'])
+                # A job leasing meanwhile must not be given the model.
+                self.assertNotEqual(pool.lease('aws'), name)
+
+            with patch.object(pool, 'destroy', side_effect=destroy):
+                self.assertEqual(pool.expire(), [stale])
+            self.assertEqual(statuses, [EXPIRING])
+            # The job holding the stale lease finishes late.
+            pool.release(stale)
+            self.assertEqual(pool.load()[stale]['status'], EXPIRING)
+
+    def test_lease_uses_default_constraints(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d)
+            name = pool.lease('aws')
+            calls = self.juju_state(pool)['calls']
+            bootstrap = self.bootstraps(pool)[0]
+        self.assertIn(['set-constraints', '-e', name, 'mem=2G'], calls)
+        self.assertEqual(bootstrap[bootstrap.index('--constraints') + 1],
+                         'mem=4G')
+
+    def test_run_juju_timeouts(self):
+        with temp_dir() as d:
+            pool = ModelPool(d, d, timeout=60, idle_timeout=30,
+                             timeouts={'bootstrap': 900})
+            with patch('buildcloud.model_pool.run_command',
+                       autospec=True) as rc_mock:
+                pool.run_juju('bootstrap', '-e', 'cwr-aws')
+                pool.run_juju('set-constraints', '-e', 'cwr-aws', 'mem=2G')
+        self.assertEqual(
+            [(c[1]['timeout'], c[1]['idle_timeout'])
+             for c in rc_mock.call_args_list], [(900, 30), (60, 30)])
+
+    def test_renewing_keeps_long_leases(self):
+        with temp_dir() as d:
+            pool = self.make_pool(d, max_lease_age=0.3)
+            other = ModelPool(pool.path, pool.source_juju_home,
+                              juju=FAKE_JUJU, max_lease_age=0.3)
+            with pool.renewing(0.02):
+                name = pool.lease('aws')
+                time.sleep(0.5)
+                self.assertEqual(other.expire(), [])
+                self.assertEqual(pool.load()[name]['status'], LEASED)
+            time.sleep(0.4)
+            self.assertEqual(other.expire(), [name])
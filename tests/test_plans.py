@@ -0,0 +1,135 @@
+import json
+import os
+from unittest import TestCase
+
+from mock import patch
+import yaml
+
+from buildcloud.plans import (
+    InvalidTestPlan,
+    load_test_plan,
+    TestPlanIndex,
+    validate_test_plan,
+)
+from buildcloud.utility import temp_dir
+
+TEST_PLAN_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), 'test_plans')
+
+
+def write_plan(path, **plan):
+    plan.setdefault('bundle', 'cs:foo')
+    plan.setdefault('bundle_name', 'foo')
+    with open(path, 'w') as f:
+        yaml.safe_dump(plan, f)
+    return path
+
+
+class TestValidateTestPlan(TestCase):
+
+    def test_shipped_test_plans(self):
+        for name in os.listdir(TEST_PLAN_DIR):
+            load_test_plan(os.path.join(TEST_PLAN_DIR, name))
+
+    def test_valid(self):
+        validate_test_plan({'bundle': 'cs:foo', 'bundle_name': 'foo',
+                            'bundle_file': '', 'benchmark': {'a': 1}}, 'p')
+
+    def test_missing_keys(self):
+        with self.assertRaisesRegexp(
+                InvalidTestPlan, "p: missing required key 'bundle', "
+                                 "missing required key 'bundle_name'"):
+            validate_test_plan({}, 'p')
+
+    def test_wrong_type(self):
+        with self.assertRaisesRegexp(InvalidTestPlan,
+                                     "'benchmark' must be a dict"):
+            validate_test_plan({'bundle': 'cs:foo', 'bundle_name': 'foo',
+                                'benchmark': 'terasort'}, 'p')
+
+    def test_constraints(self):
+        plan = {'bundle': 'cs:foo', 'bundle_name': 'foo',
+                'constraints': {'bootstrap': 'mem=8G', 'model': 'cores=4'}}
+        validate_test_plan(plan, 'p')
+        plan['constraints']['model'] = 'cores=many'
+        with self.assertRaisesRegexp(
+                InvalidTestPlan, "p: invalid model constraints 'cores=many'"):
+            validate_test_plan(plan, 'p')
+
+    def test_not_a_mapping(self):
+        with self.assertRaisesRegexp(InvalidTestPlan, 'must be a mapping'):
+            validate_test_plan(['cs:foo'], 'p')
+
+
+class TestTestPlanIndex(TestCase):
+
+    def test_load(self):
+        with temp_dir() as d:
+            plan_a = write_plan(os.path.join(d, 'a.yaml'), bundle='cs:a')
+            plan_b = write_plan(os.path.join(d, 'b.yaml'), bundle='cs:b')
+            index = TestPlanIndex(os.path.join(d, 'cache', 'plans.json'))
+            plans = index.load([plan_b, plan_a])
+            self.assertEqual(list(plans), [plan_b, plan_a])
+            self.assertEqual(plans[plan_a].data['bundle'], 'cs:a')
+            self.assertEqual(plans[plan_b].path, plan_b)
+            self.assertEqual(len(plans[plan_b].sha256), 64)
+            with open(index.cache_path) as f:
+                self.assertItemsEqual(json.load(f), [plan_a, plan_b])
+
+    def test_load_uses_cache(self):
+        with temp_dir() as d:
+            plan_a = write_plan(os.path.join(d, 'a.yaml'))
+            index = TestPlanIndex(os.path.join(d, 'plans.json'))
+            first = index.load([plan_a])
+            with patch('buildcloud.plans._parse') as parse_mock:
+                second = index.load([plan_a])
+            self.assertEqual(parse_mock.call_count, 0)
+            self.assertEqual(first, second)
+
+    def test_load_touched_but_unchanged(self):
+        with temp_dir() as d:
+            plan_a = write_plan(os.path.join(d, 'a.yaml'))
+            index = TestPlanIndex(os.path.join(d, 'plans.json'))
+            index.load([plan_a])
+            os.utime(plan_a, (0, 0))
+            with patch('buildcloud.plans._parse') as parse_mock:
+                index.load([plan_a])
+            self.assertEqual(parse_mock.call_count, 0)
+
+    def test_load_reparses_changed_plan(self):
+        with temp_dir() as d:
+            plan_a = write_plan(os.path.join(d, 'a.yaml'), bundle='cs:a')
+            index = TestPlanIndex(os.path.join(d, 'plans.json'))
+            index.load([plan_a])
+            write_plan(plan_a, bundle='cs:changed')
+            os.utime(plan_a, (0, 0))
+            self.assertEqual(index.load([plan_a])[plan_a].data['bundle'],
+                             'cs:changed')
+
+    def test_load_reports_every_invalid_plan(self):
+        with temp_dir() as d:
+            good = write_plan(os.path.join(d, 'good.yaml'))
+            bad = os.path.join(d, 'bad.yaml')
+            with open(bad, 'w') as f:
+                f.write('bundle: [')
+            missing = os.path.join(d, 'missing.yaml')
+            with open(missing, 'w') as f:
+                f.write('bundle: cs:foo')
+            index = TestPlanIndex(os.path.join(d, 'plans.json'))
+            with self.assertRaises(InvalidTestPlan) as ctx:
+                index.load([good, bad, missing])
+            message = str(ctx.exception)
+            self.assertIn(bad, message)
+            self.assertIn("{}: missing required key 'bundle_name'".format(
+                missing), message)
+            with open(index.cache_path) as f:
+                self.assertEqual(list(json.load(f)), [good])
+
+    def test_load_parallel(self):
+        with temp_dir() as d:
+            paths = [write_plan(os.path.join(d, '{}.yaml'.format(i)),
+                                bundle='cs:{}'.format(i)) for i in range(4)]
+            index = TestPlanIndex(None, workers=2)
+            plans = index.load(paths)
+            self.assertEqual([p.data['bundle'] for p in plans.values()],
+                             ['cs:0', 'cs:1', 'cs:2', 'cs:3'])
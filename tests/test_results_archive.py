@@ -0,0 +1,117 @@
+import os
+from shutil import ignore_patterns
+import tarfile
+from unittest import (
+    skipIf,
+    TestCase,
+)
+
+from mock import patch
+
+from buildcloud.results_archive import (
+    archive_path,
+    GZIP,
+    main,
+    ResultsArchive,
+    ZSTD,
+    zstandard,
+)
+from buildcloud.utility import temp_dir
+
+
+def make_results(root):
+    files = {
+        'result.json': b'{"results": []}',
+        'mongodb/log.txt': b'line\n' * 1000,
+        'mongodb/copy.txt': b'line\n' * 1000,
+        'static/style.css': b'body {}',
+        'index.html': b'<html/>',
+        'empty': b'',
+    }
+    for rel_path, data in files.items():
+        path = os.path.join(root, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+    return files
+
+
+class TestResultsArchive(TestCase):
+
+    def write_archive(self, d, compression=GZIP):
+        src = os.path.join(d, 'results')
+        files = make_results(src)
+        archive = ResultsArchive(
+            archive_path(os.path.join(d, 'logs'), compression), compression)
+        index = archive.write(src)
+        return files, archive, index
+
+    def test_write(self):
+        with temp_dir() as d:
+            files, archive, index = self.write_archive(d)
+            self.assertTrue(archive.path.endswith('results.tar.gz'))
+            with tarfile.open(archive.path) as tar:
+                members = dict((m.name, m) for m in tar.getmembers())
+                self.assertEqual(tar.extractfile(
+                    'mongodb/log.txt').read(), files['mongodb/log.txt'])
+            self.assertItemsEqual(os.listdir(os.path.dirname(archive.path)),
+                                  ['results.tar.gz',
+                                   'results.tar.gz.index.json'])
+        self.assertEqual(sorted(members), sorted(files))
+        # Duplicate content is stored once.
+        self.assertTrue(members['mongodb/log.txt'].islnk())
+        self.assertEqual(members['mongodb/log.txt'].linkname,
+                         'mongodb/copy.txt')
+        self.assertEqual(index['mongodb/log.txt']['link'],
+                         'mongodb/copy.txt')
+        self.assertEqual(index['result.json']['size'], 15)
+
+    def test_write_ignore(self):
+        with temp_dir() as d:
+            src = os.path.join(d, 'results')
+            make_results(src)
+            archive = ResultsArchive(os.path.join(d, 'results.tar.gz'))
+            index = archive.write(src, ignore_patterns('static', '*.html'))
+        self.assertEqual(sorted(index), [
+            'empty', 'mongodb/copy.txt', 'mongodb/log.txt', 'result.json'])
+
+    def test_read(self):
+        with temp_dir() as d:
+            files, archive, index = self.write_archive(d)
+            loaded = ResultsArchive(archive.path)
+            self.assertEqual(loaded.load_index(), index)
+            for rel_path, data in files.items():
+                self.assertEqual(loaded.read(rel_path), data)
+
+    def test_read_only_decompresses_the_member(self):
+        with temp_dir() as d:
+            files, archive, index = self.write_archive(d)
+            with patch.object(archive, 'read_member',
+                              wraps=archive.read_member) as rm_mock:
+                archive.read('result.json')
+        rm_mock.assert_called_once_with(index['result.json'])
+
+    @skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        with temp_dir() as d:
+            files, archive, index = self.write_archive(d, ZSTD)
+            self.assertTrue(archive.path.endswith('results.tar.zst'))
+            self.assertEqual(ResultsArchive(archive.path).read(
+                'mongodb/log.txt'), files['mongodb/log.txt'])
+
+    @skipIf(zstandard is not None, 'zstandard is installed')
+    def test_zstd_unavailable(self):
+        with self.assertRaises(ValueError):
+            ResultsArchive('results.tar.zst')
+
+    def test_main_extract(self):
+        with temp_dir() as d:
+            files, archive, index = self.write_archive(d)
+            output_dir = os.path.join(d, 'out')
+            with patch('buildcloud.results_archive.print', create=True):
+                self.assertEqual(main(['list', archive.path]), 0)
+            self.assertEqual(main(['extract', archive.path, 'mongodb/log.txt',
+                                   '--output-dir', output_dir]), 0)
+            with open(os.path.join(output_dir, 'mongodb/log.txt'), 'rb') as f:
+                self.assertEqual(f.read(), files['mongodb/log.txt'])
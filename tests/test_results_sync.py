@@ -0,0 +1,91 @@
+import os
+import shutil
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.results_sync import ResultsMirror
+from buildcloud.utility import temp_dir
+
+
+def write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class TestResultsMirror(TestCase):
+
+    def make_mirror(self, d):
+        src = os.path.join(d, 'results')
+        dst = os.path.join(d, 'logs')
+        write(os.path.join(src, 'mongodb', 'result.json'), '{}')
+        write(os.path.join(src, 'mongodb', 'index.html'), '<html>')
+        write(os.path.join(src, 'static', 'style.css'), 'body {}')
+        mirror = ResultsMirror(
+            src, dst, ignore=shutil.ignore_patterns('static', '*.html'))
+        return src, dst, mirror
+
+    def test_sync(self):
+        with temp_dir() as d:
+            src, dst, mirror = self.make_mirror(d)
+            self.assertEqual(mirror.sync(), ['mongodb/result.json'])
+            self.assertEqual(os.listdir(dst), ['mongodb'])
+            self.assertEqual(os.listdir(os.path.join(dst, 'mongodb')),
+                             ['result.json'])
+            self.assertEqual(mirror.sync(), [])
+            write(os.path.join(src, 'mongodb', 'result.json'), '{"a": 1}')
+            write(os.path.join(src, 'mongodb', 'log.txt'), 'log')
+            self.assertEqual(mirror.sync(), ['mongodb/log.txt',
+                                             'mongodb/result.json'])
+            self.assertEqual(read(os.path.join(dst, 'mongodb',
+                                               'result.json')), '{"a": 1}')
+
+    def test_sync_removes_deleted_files(self):
+        with temp_dir() as d:
+            src, dst, mirror = self.make_mirror(d)
+            write(os.path.join(dst, 'other.txt'), 'not mirrored')
+            mirror.sync()
+            os.remove(os.path.join(src, 'mongodb', 'result.json'))
+            mirror.sync()
+            self.assertFalse(os.path.exists(
+                os.path.join(dst, 'mongodb', 'result.json')))
+            self.assertTrue(os.path.exists(os.path.join(dst, 'other.txt')))
+
+    def test_sync_skips_files_already_mirrored(self):
+        with temp_dir() as d:
+            src, dst, mirror = self.make_mirror(d)
+            mirror.sync()
+            mirror = ResultsMirror(src, dst)
+            with patch.object(mirror, 'copy', autospec=True) as copy_mock:
+                mirror.sync()
+            copy_mock.assert_any_call('mongodb/index.html')
+            self.assertNotIn(('mongodb/result.json',),
+                             [c[0] for c in copy_mock.call_args_list])
+
+    def test_running(self):
+        with temp_dir() as d:
+            src, dst, mirror = self.make_mirror(d)
+            with mirror.running(0.01):
+                write(os.path.join(src, 'late.txt'), 'late')
+            self.assertEqual(read(os.path.join(dst, 'late.txt')), 'late')
+            self.assertTrue(
+                os.path.exists(os.path.join(dst, 'mongodb', 'result.json')))
+
+    def test_running_keeps_the_run_error(self):
+        with temp_dir() as d:
+            src, dst, mirror = self.make_mirror(d)
+            with patch.object(mirror, 'sync', autospec=True,
+                              side_effect=OSError('disk full')):
+                with patch('logging.warning') as warning_mock:
+                    with self.assertRaisesRegexp(ValueError, 'cwr failed'):
+                        with mirror.running(60):
+                            raise ValueError('cwr failed')
+        warning_mock.assert_called_once_with(
+            'Unable to sync {} to {}: disk full'.format(src, dst))
@@ -1,5 +1,6 @@
 from argparse import Namespace
 from contextlib import contextmanager
+from hashlib import sha256
 import os
 from unittest import TestCase
 
@@ -9,15 +10,39 @@ from mock import (
 )
 import yaml
 
+from buildcloud.build_tracker import TrackedBuild
+from buildcloud.jenkins_client import JenkinsError
+from buildcloud.manifest import (
+    DEFAULT_MANIFEST_PATH,
+    job_fingerprint,
+    ResultsManifest,
+)
+from buildcloud.plans import (
+    DEFAULT_CACHE_PATH,
+    InvalidTestPlan,
+    TestPlan,
+)
 from buildcloud.schedule_cwr_jobs import (
     build_jobs,
     Credentials,
+    format_report,
+    format_results,
     get_credentials,
+    JENKINS_URL,
     make_jobs,
     make_parameters,
-    parse_args
+    make_tracker,
+    parse_args,
+    record_builds,
+    Submission,
+)
+from buildcloud.scheduling import (
+    DEFAULT_HISTORY_PATH,
+    DEFAULT_QUEUE_HISTORY_PATH,
+    DurationHistory,
 )
 from buildcloud.utility import temp_dir
+from tests.fake_jenkins import FakeJenkins
 
 
 class TestSchedule(TestCase):
@@ -28,8 +53,24 @@ class TestSchedule(TestCase):
             expected = Namespace(
                 controllers=['default-aws', 'default-azure'],
                 cwr_test_token='fake_pass',
+                dry_run=False,
+                duration_history=DEFAULT_HISTORY_PATH,
+                force=False,
+                jenkins_url=JENKINS_URL,
+                max_age=86400,
+                max_per_controller=None,
+                max_poll_interval=60,
+                parse_workers=1,
                 password='bar',
-                test_plan_dir='test_dir', test_plans=None, user='foo')
+                plan_cache=DEFAULT_CACHE_PATH,
+                poll_interval=5,
+                queue_history=DEFAULT_QUEUE_HISTORY_PATH,
+                rate_limit=None,
+                results_manifest=DEFAULT_MANIFEST_PATH,
+                retries=3,
+                schedule='all',
+                test_plan_dir='test_dir', test_plans=None, user='foo',
+                wait=False, wait_timeout=None, workers=4)
             self.assertEqual(args, expected)
 
     def test_make_parameters(self):
@@ -45,7 +86,9 @@ class TestSchedule(TestCase):
 
     def test_make_jobs(self):
         args = Namespace(controllers=['default-aws'], password='bar',
-                         test_plan_dir='', test_plans=None, user='foo')
+                         test_plan_dir='', test_plans=None, user='foo',
+                         plan_cache='', parse_workers=1,
+                         results_manifest=None, schedule='all')
         with temp_dir() as test_dir:
             args.test_plan_dir = test_dir
             test_plan = self.fake_parameters(test_dir)
@@ -61,6 +104,92 @@ class TestSchedule(TestCase):
                  'test_plan': test_plan_2}]
             self.assertItemsEqual(parameters, expected)
 
+    def test_make_jobs_invalid_plan(self):
+        with temp_dir() as test_dir:
+            args = Namespace(controllers=['default-aws'],
+                             test_plan_dir=test_dir, test_plans=None,
+                             plan_cache='', parse_workers=1,
+                             results_manifest=None, schedule='all')
+            self.fake_parameters(test_dir)
+            with open(os.path.join(test_dir, 'bad.yaml'), 'w') as f:
+                yaml.dump({'bundle': 'cs:foo'}, f)
+            jobs = make_jobs(args)
+            with self.assertRaisesRegexp(InvalidTestPlan, 'bundle_name'):
+                next(jobs)
+
+    def test_make_jobs_skips_recent_successes(self):
+        with temp_dir() as test_dir:
+            manifest = ResultsManifest(os.path.join(test_dir, 'm.json'))
+            args = Namespace(controllers=['default-aws'],
+                             test_plan_dir=test_dir, test_plans=None,
+                             plan_cache='', parse_workers=1,
+                             results_manifest=manifest.path, max_age=3600,
+                             force=False, schedule='all')
+            test_plan = self.fake_parameters(test_dir)
+            test_plan_2 = os.path.join(test_dir, 'test2.yaml')
+            with open(test_plan_2, 'w') as f:
+                yaml.dump({'bundle': 'cs:other', 'bundle_name': 'other'}, f)
+            with open(test_plan, 'rb') as f:
+                digest = sha256(f.read()).hexdigest()
+            with open(test_plan) as f:
+                plan = yaml.safe_load(f)
+            manifest.record_success(
+                job_fingerprint(digest, plan, ['default-aws']), test_plan)
+            with patch('logging.info'):
+                self.assertEqual(
+                    [j['test_plan'] for j in make_jobs(args)], [test_plan_2])
+            args.controllers = ['default-aws', 'default-gce']
+            self.assertEqual(len(list(make_jobs(args))), 2)
+            args.controllers = ['default-aws']
+            args.force = True
+            self.assertEqual(len(list(make_jobs(args))), 2)
+            args.force = False
+            manifest.record_success(
+                job_fingerprint(digest, plan, ['default-aws']), test_plan,
+                timestamp=0)
+            self.assertEqual(len(list(make_jobs(args))), 2)
+
+    def test_make_jobs_per_controller(self):
+        with temp_dir() as test_dir:
+            history = DurationHistory(os.path.join(test_dir, 'd.json'))
+            args = Namespace(controllers=['aws', 'gce'],
+                             test_plan_dir=test_dir, test_plans=None,
+                             plan_cache='', parse_workers=1,
+                             results_manifest=None,
+                             schedule='per-controller', max_per_controller=1,
+                             duration_history=history.path,
+                             queue_history=os.path.join(test_dir, 'q.json'))
+            short = self.fake_parameters(test_dir, 1)
+            long = self.fake_parameters(test_dir, 2)
+            history.record(short, 'aws', 60)
+            history.record(long, 'aws', 600)
+            jobs = [(j['test_plan'], j['controllers'])
+                    for j in make_jobs(args)]
+        self.assertItemsEqual(jobs[:2], [(long, 'aws'), (long, 'gce')])
+        self.assertItemsEqual(jobs[2:], [(short, 'aws'), (short, 'gce')])
+
+    def test_make_jobs_balanced(self):
+        with temp_dir() as test_dir:
+            history = DurationHistory(os.path.join(test_dir, 'd.json'))
+            args = Namespace(controllers=['aws', 'gce'],
+                             test_plan_dir=test_dir, test_plans=None,
+                             plan_cache='', parse_workers=1,
+                             results_manifest=None, schedule='balanced',
+                             max_per_controller=None,
+                             duration_history=history.path,
+                             queue_history=os.path.join(test_dir, 'q.json'))
+            plans = [self.fake_parameters(test_dir, i) for i in range(3)]
+            for plan, duration in zip(plans, [100, 50, 50]):
+                history.record(plan, 'aws', duration)
+                history.record(plan, 'gce', duration)
+            jobs = [(j['test_plan'], j['controllers'])
+                    for j in make_jobs(args)]
+        self.assertEqual(len(jobs), 3)
+        self.assertEqual(jobs[0][0], plans[0])
+        controller = jobs[0][1]
+        self.assertEqual(set(c for _, c in jobs[1:]),
+                         set(['aws', 'gce']) - set([controller]))
+
     def test_get_credentials(self):
         args = Namespace(controllers=['default-aws'], password='bar',
                          test_plan_dir='', test_plans=None, user='foo')
@@ -79,9 +208,14 @@ class TestSchedule(TestCase):
             yaml.dump(plan, f)
         return test_plan
 
+    def build_args(self, url, **kwargs):
+        args = Namespace(cwr_test_token='fake', jenkins_url=url, workers=2,
+                         retries=3, rate_limit=None, max_per_controller=None)
+        args.__dict__.update(kwargs)
+        return args
+
     def test_build_jobs_credentials(self):
         credentials = Credentials('joe', 'pass')
-        args = Namespace(cwr_test_token='fake')
         params = [
             {'controllers': 'default-aws',
              'bundle_name': 'make_life_easy',
@@ -89,24 +223,218 @@ class TestSchedule(TestCase):
             {'controllers': 'default-aws',
              'bundle_name': 'made life easy',
              'test_plan': 'test_plan_2'}]
-        with patch('buildcloud.schedule_cwr_jobs.Jenkins',
-                   autospec=True) as jenkins_mock:
-            build_jobs(credentials, params, args)
-        jenkins_mock.assert_called_once_with(
-            'http://juju-ci.vapour.ws:8080', 'joe', 'pass')
-        calls = [
-            call('cwr-test',
-                 {'controllers': 'default-aws',
-                  'bundle_name': 'make_life_easy',
-                  'test_plan': 'test_plan'},
-                 token='fake'),
-            call('cwr-test',
-                 {'controllers': 'default-aws',
-                  'bundle_name': 'made life easy',
-                  'test_plan': 'test_plan_2'},
-                 token='fake')]
+        with FakeJenkins() as jenkins:
+            submissions = build_jobs(
+                credentials, params, self.build_args(jenkins.url))
+        builds = [r for r in jenkins.requests if r['method'] == 'POST']
+        self.assertEqual(len(builds), 2)
+        for build in builds:
+            self.assertEqual(
+                build['path'], '/job/cwr-test/buildWithParameters')
+            self.assertEqual(build['authorization'], 'Basic am9lOnBhc3M=')
+        self.assertItemsEqual(jenkins.builds, [
+            dict(params[0], token='fake'), dict(params[1], token='fake')])
+        self.assertEqual([s.job for s in submissions], params)
+        self.assertEqual([s.error for s in submissions], [None, None])
         self.assertItemsEqual(
-            jenkins_mock.return_value.build_job.call_args_list, calls)
+            [s.queue_url for s in submissions],
+            ['{}/queue/item/{}/'.format(jenkins.url, i) for i in (1, 2)])
+
+    def test_build_jobs_reuses_connections(self):
+        params = [{'controllers': 'default-aws', 'bundle_name': 'b',
+                   'test_plan': 'test_plan_{}'.format(i)} for i in range(12)]
+        with FakeJenkins() as jenkins:
+            build_jobs(Credentials('joe', 'pass'), params,
+                       self.build_args(jenkins.url, workers=3))
+        self.assertEqual(len(jenkins.builds), 12)
+        self.assertLessEqual(len(jenkins.clients), 3)
+
+    def test_build_jobs_retries(self):
+        params = [{'controllers': 'default-aws', 'bundle_name': 'b',
+                   'test_plan': 'test_plan'}]
+        with FakeJenkins() as jenkins:
+            jenkins.fail_next(2)
+            with patch('time.sleep') as sleep_mock:
+                with patch('logging.warning'):
+                    submissions = build_jobs(
+                        Credentials('joe', 'pass'), params,
+                        self.build_args(jenkins.url, workers=1))
+        self.assertIsNone(submissions[0].error)
+        self.assertEqual(len(jenkins.builds), 1)
+        self.assertEqual(sleep_mock.call_args_list, [call(1.0), call(2.0)])
+
+    def test_build_jobs_reports_failures(self):
+        params = [{'controllers': 'default-aws', 'bundle_name': 'b',
+                   'test_plan': 'test_plan'}]
+        with FakeJenkins() as jenkins:
+            jenkins.fail_next(10)
+            with patch('time.sleep'):
+                with patch('logging.warning'):
+                    with patch('logging.error'):
+                        submissions = build_jobs(
+                            Credentials('joe', 'pass'), params,
+                            self.build_args(jenkins.url, retries=2))
+        self.assertIsInstance(submissions[0].error, JenkinsError)
+        self.assertEqual(submissions[0].error.status, 503)
+        self.assertEqual(len(jenkins.requests), 3)
+        self.assertEqual(jenkins.builds, [])
+
+    def test_build_jobs_reports_failed_posts(self):
+        params = [{'controllers': 'default-aws', 'bundle_name': 'b',
+                   'test_plan': 'test_plan'}]
+        with FakeJenkins() as jenkins:
+            jenkins.fail_next(1, 500, method='POST')
+            with patch('logging.error'):
+                submissions = build_jobs(
+                    Credentials('joe', 'pass'), params,
+                    self.build_args(jenkins.url, retries=2))
+        self.assertEqual(submissions[0].error.status, 500)
+        self.assertIn('FAILED: 500', format_report(submissions))
+        self.assertEqual(
+            len([r for r in jenkins.requests if r['method'] == 'POST']), 1)
+
+    def test_format_report(self):
+        submissions = [
+            Submission({'test_plan': 'a.yaml', 'controllers': 'aws gce'},
+                       'http://jenkins/queue/item/1/', None),
+            Submission({'test_plan': 'b.yaml', 'controllers': 'aws gce'},
+                       None, ValueError('boom'))]
+        self.assertEqual(format_report(submissions), '\n'.join([
+            'a.yaml [aws gce] queued http://jenkins/queue/item/1/',
+            'b.yaml [aws gce] FAILED: boom',
+            'Submitted 1 of 2 jobs.']))
+
+    def test_build_jobs_tracks_builds(self):
+        params = [{'controllers': 'aws', 'bundle_name': 'b',
+                   'test_plan': 'test_plan_{}'.format(i)} for i in range(3)]
+        with FakeJenkins() as jenkins:
+            jenkins.results['test_plan_1'] = 'FAILURE'
+            jenkins.fail_next(1, 500, method='POST')
+            args = self.build_args(
+                jenkins.url, workers=1, poll_interval=0.01,
+                max_poll_interval=0.1)
+            tracker = make_tracker(Credentials('joe', 'pass'), args)
+            with patch('logging.error'):
+                submissions = build_jobs(
+                    Credentials('joe', 'pass'), params, args, tracker)
+            builds = tracker.wait()
+        self.assertEqual(submissions[0].error.status, 500)
+        self.assertEqual([b.job for b in builds], params[1:])
+        self.assertEqual([b.status for b in builds], ['FAILURE', 'SUCCESS'])
+
+    def test_build_jobs_max_per_controller(self):
+        params = [{'controllers': controllers, 'bundle_name': 'b',
+                   'test_plan': 'test_plan_{}'.format(i)}
+                  for i, controllers in enumerate(
+                      ['aws', 'aws', 'gce', 'aws gce', 'aws'])]
+        with FakeJenkins() as jenkins:
+            jenkins.run_time = 0.1
+            args = self.build_args(
+                jenkins.url, poll_interval=0.01, max_poll_interval=0.01,
+                max_per_controller=1)
+            with patch('logging.info'):
+                submissions = build_jobs(
+                    Credentials('joe', 'pass'), params, args)
+            items = list(jenkins.items)
+        self.assertEqual([s.job for s in submissions], params)
+        self.assertEqual([s.error for s in submissions], [None] * 5)
+        # The first job on each controller is queued at once, and each
+        # later one once the job before it on its controllers is done.
+        order = [i['query']['test_plan'] for i in items]
+        self.assertItemsEqual(order[:2], ['test_plan_0', 'test_plan_2'])
+        self.assertEqual(order[2:], [
+            'test_plan_1', 'test_plan_3', 'test_plan_4'])
+        for controller in ('aws', 'gce'):
+            times = [i['submitted'] for i in items
+                     if controller in i['query']['controllers'].split()]
+            for previous, submitted in zip(times, times[1:]):
+                self.assertGreaterEqual(
+                    submitted, previous + jenkins.run_time)
+
+    def test_parse_args_max_per_controller(self):
+        with jenkins_env():
+            args = parse_args(['test_dir', 'aws', '--max-per-controller',
+                               '2'])
+            self.assertEqual(args.max_per_controller, 2)
+            with patch('sys.stderr'):
+                with self.assertRaises(SystemExit):
+                    parse_args(['test_dir', 'aws', '--max-per-controller',
+                                '0'])
+
+    def test_record_builds(self):
+        passed = TrackedBuild(1, {'test_plan': '/a/a.yaml',
+                                  'controllers': 'aws gce'}, 100)
+        passed.update({'number': 1, 'timestamp': 130000, 'duration': 600000,
+                       'result': 'SUCCESS'})
+        failed = TrackedBuild(2, {'test_plan': '/a/b.yaml',
+                                  'controllers': 'aws'}, 100)
+        failed.update({'number': 2, 'timestamp': 110000, 'duration': 60000,
+                       'result': 'FAILURE'})
+        queued = TrackedBuild(3, {'test_plan': '/a/c.yaml',
+                                  'controllers': 'aws'}, 100)
+        with temp_dir() as d:
+            args = Namespace(
+                duration_history=os.path.join(d, 'd.json'),
+                queue_history=os.path.join(d, 'q.json'),
+                results_manifest=os.path.join(d, 'm.json'))
+            plan = TestPlan('/a/a.yaml', 'abc', {'bundle': 'cs:a'})
+            record_builds(args, [passed, failed, queued],
+                          {'/a/a.yaml': plan})
+            self.assertEqual(DurationHistory(args.duration_history).load(), {
+                'a.yaml': {'aws': [600.0], 'gce': [600.0]}})
+            self.assertEqual(DurationHistory(args.queue_history).load(), {
+                'a.yaml': {'aws': [30.0], 'gce': [30.0]},
+                'b.yaml': {'aws': [10.0]}})
+            self.assertEqual(
+                ResultsManifest(args.results_manifest).recent(60),
+                set([job_fingerprint('abc', plan.data, ['aws', 'gce'])]))
+
+    def test_make_jobs_adds_queue_waits(self):
+        with temp_dir() as test_dir:
+            history = DurationHistory(os.path.join(test_dir, 'd.json'))
+            queue_history = DurationHistory(os.path.join(test_dir, 'q.json'))
+            args = Namespace(controllers=['aws'], test_plan_dir=test_dir,
+                             test_plans=None, plan_cache='', parse_workers=1,
+                             results_manifest=None,
+                             schedule='per-controller', max_per_controller=1,
+                             duration_history=history.path,
+                             queue_history=queue_history.path)
+            first = self.fake_parameters(test_dir, 1)
+            second = self.fake_parameters(test_dir, 2)
+            history.record(first, 'aws', 100)
+            history.record(second, 'aws', 60)
+            self.assertEqual([j['test_plan'] for j in make_jobs(args)],
+                             [first, second])
+            queue_history.record(second, 'aws', 120)
+            self.assertEqual([j['test_plan'] for j in make_jobs(args)],
+                             [second, first])
+
+    def test_format_results(self):
+        builds = [
+            TrackedBuild(1, {'test_plan': 'a.yaml', 'controllers': 'aws'},
+                         100),
+            TrackedBuild(2, {'test_plan': 'a.yaml', 'controllers': 'gce'},
+                         100),
+            TrackedBuild(3, {'test_plan': 'b.yaml', 'controllers': 'aws'},
+                         100)]
+        builds[0].update({'number': 4, 'timestamp': 160000,
+                          'duration': 600000, 'result': 'SUCCESS'})
+        builds[1].update({'number': 5, 'timestamp': 100000,
+                          'duration': 1200000, 'result': 'FAILURE'})
+        row = '{:<30} {:>6} {:>6} {:>6} {:>10} {:>10}'.format
+        self.assertEqual(format_results(builds), '\n'.join([
+            'a.yaml [aws] SUCCESS #4, queued 0:01:00, ran 0:10:00',
+            'a.yaml [gce] FAILURE #5, queued 0:00:00, ran 0:20:00',
+            'b.yaml [aws] QUEUED',
+            row('test plan', 'passed', 'failed', 'other', 'max queue',
+                'run time'),
+            row('a.yaml', 1, 1, 0, '0:01:00', '0:30:00'),
+            row('b.yaml', 0, 0, 1, '-', '0:00:00'),
+            row('controller', 'passed', 'failed', 'other', 'max queue',
+                'run time'),
+            row('aws', 1, 0, 1, '0:01:00', '0:10:00'),
+            row('gce', 0, 1, 0, '0:00:00', '0:20:00'),
+            'Passed 1 of 3 builds in 0:20:00.']))
 
 
 @contextmanager
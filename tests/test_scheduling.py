@@ -0,0 +1,86 @@
+import os
+from unittest import TestCase
+
+from buildcloud.scheduling import (
+    assign_jobs,
+    DEFAULT_DURATION,
+    DurationHistory,
+    format_assignments,
+    format_duration,
+    makespan,
+)
+from buildcloud.utility import temp_dir
+
+
+def fixed_estimate(durations):
+    def estimate(test_plan, controller):
+        return durations[test_plan]
+    return estimate
+
+
+class TestDurationHistory(TestCase):
+
+    def test_record(self):
+        with temp_dir() as d:
+            history = DurationHistory(os.path.join(d, 'h', 'd.json'),
+                                      samples=2)
+            for duration in (10, 20, 30):
+                history.record('/plans/mongodb.yaml', 'aws', duration)
+            self.assertEqual(history.load(),
+                             {'mongodb.yaml': {'aws': [20, 30]}})
+
+    def test_estimator(self):
+        with temp_dir() as d:
+            history = DurationHistory(os.path.join(d, 'd.json'))
+            history.record('mongodb.yaml', 'aws', 10)
+            history.record('mongodb.yaml', 'aws', 20)
+            history.record('mongodb.yaml', 'gce', 60)
+            estimate = history.estimator()
+            self.assertEqual(estimate('/a/mongodb.yaml', 'aws'), 15)
+            self.assertEqual(estimate('mongodb.yaml', 'azure'), 30)
+            self.assertEqual(estimate('other.yaml', 'aws'), DEFAULT_DURATION)
+
+
+class TestAssignJobs(TestCase):
+
+    def test_assign_jobs_lpt(self):
+        jobs = [('a', ['x', 'y']), ('b', ['x', 'y']), ('c', ['x', 'y']),
+                ('d', ['x', 'y'])]
+        estimate = fixed_estimate({'a': 30, 'b': 20, 'c': 20, 'd': 10})
+        assignments = assign_jobs(jobs, estimate)
+        self.assertEqual(makespan(assignments), 40)
+        by_plan = dict((a.job[0], a) for a in assignments)
+        self.assertEqual(by_plan['a'].start, 0)
+        self.assertEqual(by_plan['d'].controller, by_plan['a'].controller)
+        self.assertEqual(by_plan['d'].start, 30)
+        self.assertEqual([a.start for a in assignments], [0, 0, 20, 30])
+
+    def test_assign_jobs_fixed_controllers(self):
+        jobs = [('a', ['x']), ('b', ['x']), ('c', ['y'])]
+        estimate = fixed_estimate({'a': 10, 'b': 30, 'c': 5})
+        assignments = assign_jobs(jobs, estimate)
+        self.assertEqual(
+            [(a.job[0], a.controller, a.start) for a in assignments],
+            [('b', 'x', 0), ('c', 'y', 0), ('a', 'x', 30)])
+        self.assertEqual(makespan(assignments), 40)
+
+    def test_assign_jobs_slots_per_controller(self):
+        jobs = [('a', ['x']), ('b', ['x']), ('c', ['x'])]
+        estimate = fixed_estimate({'a': 10, 'b': 10, 'c': 10})
+        assignments = assign_jobs(jobs, estimate, slots_per_controller=2)
+        self.assertEqual([a.start for a in assignments], [0, 0, 10])
+        self.assertEqual(makespan(assignments), 20)
+
+    def test_makespan_empty(self):
+        self.assertEqual(makespan([]), 0)
+
+    def test_format_assignments(self):
+        assignments = assign_jobs(
+            [('mongodb.yaml', ['aws'])], fixed_estimate({'mongodb.yaml': 90}))
+        self.assertEqual(format_assignments(assignments).splitlines(), [
+            '     start   duration  controller           test plan',
+            '   0:00:00    0:01:30  aws                  mongodb.yaml',
+            'Estimated completion: 0:01:30'])
+
+    def test_format_duration(self):
+        self.assertEqual(format_duration(3725.4), '1:02:05')
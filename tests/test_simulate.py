@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.simulate import (
+    main,
+    parse_args,
+    simulate,
+)
+
+
+class TestSimulate(TestCase):
+
+    def test_parse_args(self):
+        args = parse_args(['--latency', 'bootstrap=2', '--latency',
+                           'run_container=0.5', '--failure', 'destroy=0.1'])
+        self.assertEqual(args.latency,
+                         {'bootstrap': 2, 'run_container': 0.5})
+        self.assertEqual(args.failure, {'destroy': 0.1})
+
+    def test_simulate(self):
+        args = parse_args(['--jobs', '6', '--workers', '3', '--plans', '2',
+                           '--bootstrap-workers', '2'])
+        backend, durations, errors = simulate(args)
+        self.assertEqual(sorted(durations), list(range(6)))
+        self.assertEqual(list(errors.values()), [None] * 6)
+        operations = [c[0] for c in backend.calls]
+        self.assertEqual(operations.count('bootstrap'), 12)
+        self.assertEqual(operations.count('destroy'), 12)
+        self.assertEqual(operations.count('run_container'), 12)
+        self.assertEqual(operations.count('reset'), 12)
+        self.assertEqual(backend.models, set())
+
+    def test_simulate_host_limits(self):
+        args = parse_args(['--jobs', '4', '--workers', '4',
+                           '--latency', 'bootstrap=0.02',
+                           '--latency', 'run_container=0.02',
+                           '--max-bootstraps', '1',
+                           '--max-controller-containers', '1'])
+        with patch('logging.info'):
+            backend, durations, errors = simulate(args)
+        self.assertEqual(list(errors.values()), [None] * 4)
+        self.assertEqual(backend.max_concurrent['bootstrap'], 1)
+        self.assertEqual(backend.max_concurrent['run_container'], 1)
+        # Every job bootstrapped models of its own.
+        self.assertEqual(len(set(backend.juju_homes)), 8)
+        self.assertEqual(len(set(backend.juju_homes.values())), 4)
+
+    def test_simulate_failures(self):
+        args = parse_args(['--jobs', '4', '--failure', 'bootstrap=1',
+                           '--snapshot-juju-home'])
+        with patch('logging.error'):
+            backend, durations, errors = simulate(args)
+        self.assertTrue(all(errors.values()))
+        operations = [c[0] for c in backend.calls]
+        self.assertNotIn('run_container', operations)
+        self.assertEqual(operations.count('destroy'), 4)
+
+    def test_main(self):
+        with patch('buildcloud.simulate.print', create=True) as print_mock:
+            self.assertEqual(main(['--jobs', '2', '--live-sync']), 0)
+        report = print_mock.call_args[0][0]
+        self.assertIn('Jobs: 2 (0 failed), 20 at a time', report)
+        self.assertIn('bootstrap', report)
@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+import threading
+import time
+from unittest import TestCase
+
+from mock import patch
+
+try:
+    from thread import interrupt_main
+except ImportError:
+    from _thread import interrupt_main
+
+from buildcloud.taskgraph import (
+    format_critical_path,
+    TaskGraph,
+)
+
+
+class TestTaskGraph(TestCase):
+
+    def test_run(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: 1)
+        graph.add('b', lambda: 2)
+        graph.add('sum', lambda a, b: a + b, ['a', 'b'])
+        self.assertEqual(graph.run(), {'a': 1, 'b': 2, 'sum': 3})
+
+    def test_add_validates(self):
+        graph = TaskGraph()
+        graph.add('a', lambda: 1)
+        with self.assertRaises(ValueError):
+            graph.add('a', lambda: 1)
+        with self.assertRaises(ValueError):
+            graph.add('b', lambda c: 1, ['c'])
+
+    def test_independent_tasks_overlap(self):
+        graph = TaskGraph()
+        barrier = threading.Event()
+
+        def first():
+            self.assertTrue(barrier.wait(5))
+            return 'first'
+
+        graph.add('first', first)
+        graph.add('second', barrier.set)
+        self.assertEqual(graph.run()['first'], 'first')
+
+    def test_workers(self):
+        graph = TaskGraph()
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        for name in 'abcd':
+            graph.add(name, task)
+        graph.run(workers=2)
+        self.assertEqual(max(peak), 2)
+
+    def test_contexts_exit_in_reverse_order(self):
+        events = []
+
+        @contextmanager
+        def context(name, value):
+            events.append(('enter', name))
+            try:
+                yield value
+            finally:
+                events.append(('exit', name))
+
+        graph = TaskGraph()
+        graph.add('env', lambda: context('env', 'root'), context=True)
+        graph.add('models', lambda root: context('models', root + '/m'),
+                  ['env'], context=True)
+        graph.add('run', lambda models: events.append(('run', models)),
+                  ['models'])
+        graph.run()
+        self.assertEqual(events, [
+            ('enter', 'env'), ('enter', 'models'), ('run', 'root/m'),
+            ('exit', 'models'), ('exit', 'env')])
+
+    def test_failure_cleans_up(self):
+        events = []
+
+        @contextmanager
+        def models():
+            try:
+                yield
+            except ValueError:
+                events.append('saw failure')
+                raise
+            finally:
+                events.append('destroyed')
+
+        def fail():
+            raise ValueError('pull failed')
+
+        graph = TaskGraph()
+        graph.add('models', models, context=True)
+        graph.add('pull', fail)
+        graph.add('run', lambda m, p: events.append('ran'),
+                  ['models', 'pull'])
+        with patch('logging.error'):
+            with self.assertRaisesRegexp(ValueError, 'pull failed'):
+                graph.run(workers=1)
+        self.assertEqual(events, ['saw failure', 'destroyed'])
+
+    def test_cleanup_error(self):
+        @contextmanager
+        def models():
+            yield
+            raise OSError('destroy failed')
+
+        graph = TaskGraph()
+        graph.add('models', models, context=True)
+        graph.add('run', lambda m: 'ok', ['models'])
+        with patch('logging.error'):
+            with self.assertRaisesRegexp(OSError, 'destroy failed'):
+                graph.run()
+        self.assertEqual(graph.results['run'], 'ok')
+
+    def test_interrupt_waits_for_running_tasks(self):
+        graph = TaskGraph()
+        graph.poll_interval = 0.01
+        deployed = threading.Event()
+        exited = []
+
+        @contextmanager
+        def model():
+            try:
+                yield 'model'
+            finally:
+                exited.append(deployed.is_set())
+
+        def deploy(model):
+            interrupt_main()
+            time.sleep(0.1)
+            deployed.set()
+
+        graph.add('model', model, context=True)
+        graph.add('deploy', deploy, ['model'])
+        graph.add('test', self.fail, ['deploy'])
+        with patch('logging.error') as le_mock:
+            with self.assertRaises(KeyboardInterrupt):
+                graph.run()
+        le_mock.assert_called_once_with('Interrupted; waiting for deploy.')
+        self.assertEqual(exited, [True])
+        self.assertNotIn('test', graph.results)
+
+    def test_critical_path(self):
+        clock = iter([0, 1, 0, 5, 5, 6])
+        graph = TaskGraph()
+        graph.add('pull', lambda: None)
+        graph.add('bootstrap', lambda: None)
+        graph.add('run', lambda a, b: None, ['pull', 'bootstrap'])
+        with patch('buildcloud.taskgraph.time.time',
+                   side_effect=lambda: next(clock)):
+            graph.run(workers=1)
+        path = graph.critical_path()
+        self.assertEqual([step.name for step in path], ['bootstrap', 'run'])
+        lines = format_critical_path(path).splitlines()
+        self.assertEqual(lines[0], 'Critical path:')
+        self.assertEqual(lines[-1].split(), ['total', '6.0s'])
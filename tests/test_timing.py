@@ -0,0 +1,92 @@
+import json
+import os
+import threading
+from unittest import TestCase
+
+from mock import patch
+
+from buildcloud.timing import PhaseTimer
+from buildcloud.utility import temp_dir
+
+
+def fake_clock(*times):
+    return patch('buildcloud.timing.time.time', side_effect=list(times))
+
+
+class TestPhaseTimer(TestCase):
+
+    def test_phase(self):
+        timer = PhaseTimer()
+        with fake_clock(10, 12.5):
+            with timer.phase('bootstrap', model='cwr-aws') as phase:
+                pass
+        self.assertEqual(phase.to_dict(), {
+            'phase': 'bootstrap', 'start': 10, 'duration': 2.5,
+            'thread': threading.current_thread().name,
+            'attrs': {'model': 'cwr-aws'}, 'error': None})
+
+    def test_phase_error(self):
+        timer = PhaseTimer()
+        with self.assertRaises(ValueError):
+            with timer.phase('cwr'):
+                raise ValueError('boom')
+        self.assertEqual(timer.phases[0].error, 'ValueError: boom')
+        self.assertIsNotNone(timer.phases[0].end)
+
+    def test_summary(self):
+        timer = PhaseTimer()
+        with fake_clock(0, 1, 3, 4, 8, 10):
+            with timer.phase('bootstrap'):
+                pass
+            with timer.phase('cwr'):
+                pass
+            with timer.phase('bootstrap'):
+                pass
+        self.assertEqual(timer.summary(), [
+            ('bootstrap', 2, 3.0, 2.0, 0),
+            ('cwr', 1, 1.0, 1.0, 0)])
+        lines = timer.format_summary().splitlines()
+        self.assertEqual(lines[0].split(),
+                         ['phase', 'count', 'total', 'longest', 'errors'])
+        self.assertEqual(lines[1].split(),
+                         ['bootstrap', '2', '3.0s', '2.0s', '0'])
+        self.assertEqual(lines[-1], 'Wall clock: 10.0s')
+
+    def test_write_jsonl(self):
+        timer = PhaseTimer()
+        with timer.phase('pull image', image='seman/cwrbox'):
+            pass
+        with timer.phase('cwr'):
+            pass
+        with temp_dir() as d:
+            path = os.path.join(d, 'timing.jsonl')
+            timer.write_jsonl(path)
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([r['phase'] for r in records], ['pull image', 'cwr'])
+        self.assertEqual(records[0]['attrs'], {'image': 'seman/cwrbox'})
+
+    def test_write_chrome_trace(self):
+        timer = PhaseTimer()
+
+        def bootstrap():
+            with timer.phase('bootstrap', model='cwr-gce'):
+                pass
+
+        with fake_clock(1, 1.5):
+            with timer.phase('bootstrap', model='cwr-aws'):
+                pass
+        thread = threading.Thread(target=bootstrap)
+        thread.start()
+        thread.join()
+        with temp_dir() as d:
+            path = os.path.join(d, 'trace.json')
+            timer.write_chrome_trace(path)
+            with open(path) as f:
+                trace = json.load(f)
+        events = trace['traceEvents']
+        self.assertEqual([e['ph'] for e in events], ['M', 'X', 'M', 'X'])
+        self.assertEqual(events[1]['ts'], 1000000)
+        self.assertEqual(events[1]['dur'], 500000)
+        self.assertEqual(events[1]['args'], {'model': 'cwr-aws'})
+        self.assertEqual([e['tid'] for e in events], [1, 1, 2, 2])
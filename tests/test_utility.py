@@ -1,15 +1,30 @@
+import logging
 import os
 import subprocess
+import time
 from unittest import TestCase
 
-from mock import patch
+from mock import (
+    call,
+    patch,
+)
 import yaml
 
 from buildcloud.utility import (
+    atomic_write,
+    CommandTimeoutError,
+    configure_command_output,
     copytree_force,
+    load_json,
+    log_level,
     rename_env,
+    rename_envs,
     run_command,
+    run_commands,
+    run_concurrently,
+    snapshot_tree,
     temp_dir,
+    write_json_atomic,
 )
 
 
@@ -20,6 +35,29 @@ class TestUtility(TestCase):
             self.assertTrue(os.path.isdir(d))
         self.assertFalse(os.path.exists(d))
 
+    def test_write_json_atomic(self):
+        with temp_dir() as d:
+            path = os.path.join(d, 'state.json')
+            self.assertEqual(load_json(path), {})
+            self.assertEqual(load_json(path, []), [])
+            write_json_atomic(path, {'b': 1, 'a': [2]})
+            self.assertEqual(load_json(path), {'a': [2], 'b': 1})
+            self.assertEqual(os.listdir(d), ['state.json'])
+            with open(path, 'w') as f:
+                f.write('{')
+            self.assertEqual(load_json(path), {})
+
+    def test_atomic_write_failure(self):
+        with temp_dir() as d:
+            path = os.path.join(d, 'state.json')
+            write_json_atomic(path, {'a': 1})
+            with self.assertRaises(ValueError):
+                with atomic_write(path) as f:
+                    f.write('{')
+                    raise ValueError()
+            self.assertEqual(load_json(path), {'a': 1})
+            self.assertEqual(os.listdir(d), ['state.json'])
+
     def test_temp_dir_contents(self):
         with temp_dir() as d:
             self.assertTrue(os.path.isdir(d))
@@ -35,31 +73,152 @@ class TestUtility(TestCase):
         self.assertFalse(os.path.exists(p))
 
     def test_run_command(self):
-        proc = FakeProc()
-        cmd = ['foo', 'bar']
-        with patch('subprocess.Popen', autospec=True,
-                   return_value=proc) as p_mock:
-                run_command(cmd)
-        p_mock.assert_called_once_with(cmd, stdout=subprocess.PIPE)
+        with patch('buildcloud.utility.print_now') as pr_mock:
+            run_command(['sh', '-c', 'echo out; echo err >&2'])
+        printed = [c[0][0] for c in pr_mock.call_args_list]
+        self.assertEqual(printed[0],
+                         "Executing: ['sh', '-c', 'echo out; echo err >&2']")
+        self.assertItemsEqual(printed[1:], ['out', 'err'])
 
     def test_run_command_str(self):
-        proc = FakeProc()
-        cmd = ['foo bar']
-        with patch('subprocess.Popen', autospec=True,
-                   return_value=proc) as p_mock:
-            with patch('buildcloud.utility.print_now'):
-                run_command(cmd, verbose=True)
-        p_mock.assert_called_once_with(cmd, stdout=subprocess.PIPE)
+        with patch('buildcloud.utility.print_now') as pr_mock:
+            run_command('echo foo bar', verbose=True)
+        self.assertEqual(pr_mock.call_args_list, [
+            call("Executing: ['echo', 'foo', 'bar']"), call('foo bar')])
 
     def test_run_command_verbose(self):
-        proc = FakeProc()
-        cmd = ['foo', 'bar']
-        with patch('subprocess.Popen', autospec=True,
-                   return_value=proc) as p_mock:
+        with patch('buildcloud.utility.print_now') as pr_mock:
+            run_command(['true'], verbose=True)
+        pr_mock.assert_called_once_with("Executing: ['true']")
+
+    def test_run_command_not_verbose(self):
+        with patch('buildcloud.utility.print_now') as pr_mock:
+            run_command(['true'], verbose=False)
+        self.assertEqual(pr_mock.call_count, 0)
+
+    def test_run_command_error(self):
+        cmd = ['sh', '-c', 'echo out; echo boom >&2; exit 3']
+        with patch('buildcloud.utility.print_now'):
+            with self.assertRaises(subprocess.CalledProcessError) as ctx:
+                run_command(cmd)
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.cmd, cmd)
+        self.assertIn('boom', ctx.exception.output)
+        self.assertEqual(ctx.exception.stderr, ctx.exception.output)
+
+    def test_run_commands_bounded_tail(self):
+        with patch('buildcloud.utility.print_now'):
+            errors = run_commands(
+                [['sh', '-c', 'seq 5; exit 1']], tail_lines=2)
+        self.assertEqual(errors[0].output, '4\n5')
+
+    def test_run_command_timeout(self):
+        start = time.time()
+        with patch('buildcloud.utility.print_now'):
+            with patch('logging.error'):
+                with self.assertRaises(CommandTimeoutError) as ctx:
+                    run_command(['sleep', '10'], timeout=0.2)
+        self.assertLess(time.time() - start, 5)
+        self.assertIn('timeout', str(ctx.exception))
+
+    def test_run_command_idle_timeout(self):
+        with patch('buildcloud.utility.print_now'):
+            with patch('logging.error'):
+                with self.assertRaises(CommandTimeoutError) as ctx:
+                    run_command(['sh', '-c', 'echo started; sleep 10'],
+                                idle_timeout=0.2)
+        self.assertEqual(ctx.exception.output, 'started')
+        self.assertIn('no output', str(ctx.exception))
+
+    def test_run_commands(self):
+        commands = [['sleep', '0.5']] * 4 + [['false']]
+        start = time.time()
+        with patch('buildcloud.utility.print_now'):
+            errors = run_commands(commands, max_running=5)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(errors[:4], [None] * 4)
+        self.assertIsInstance(errors[4], subprocess.CalledProcessError)
+
+    def test_run_commands_max_running(self):
+        with temp_dir() as d:
+            log = os.path.join(d, 'log')
+            script = 'echo start >> {0}; sleep 0.2; echo end >> {0}'.format(
+                log)
+            with patch('buildcloud.utility.print_now'):
+                run_commands([['sh', '-c', script]] * 3, max_running=1)
+            with open(log) as f:
+                self.assertEqual(f.read().split(), ['start', 'end'] * 3)
+
+    def test_log_level(self):
+        self.assertEqual(log_level(
+            '2016-04-07 02:34:12 DEBUG juju.provider started'), 10)
+        self.assertEqual(log_level('ERROR: no such bundle'), 40)
+        self.assertEqual(log_level('[WARNING] slow'), 30)
+        self.assertIsNone(log_level('debug output then more DEBUG'))
+        self.assertIsNone(log_level(''))
+
+    def test_run_command_log_dir(self):
+        self.addCleanup(configure_command_output)
+        script = ('echo INFO starting; echo DEBUG detail; echo traceback; '
+                  'echo WARNING careful; echo plain >&2')
+        with temp_dir() as d:
+            configure_command_output(d, logging.INFO, rate=0)
+            with patch('buildcloud.utility.print_now') as pr_mock:
+                run_command(['sh', '-c', script], verbose=False)
+            path = os.path.join(d, 'commands', '001-sh.log')
+            with open(path) as f:
+                logged = f.read().splitlines()
+        printed = '\n'.join(c[0][0] for c in pr_mock.call_args_list)
+        self.assertEqual(printed.splitlines(), [
+            'INFO starting', 'WARNING careful', 'plain',
+            '2 of 5 lines not shown, see {}'.format(path)])
+        self.assertEqual(logged[0], '$ sh -c {}'.format(script))
+        self.assertItemsEqual(logged[1:], [
+            'INFO starting', 'DEBUG detail', 'traceback', 'WARNING careful',
+            'plain'])
+
+    def test_run_command_rate_limit(self):
+        self.addCleanup(configure_command_output)
+        with temp_dir() as d:
+            configure_command_output(d, rate=3)
             with patch('buildcloud.utility.print_now') as pr_mock:
-                run_command(cmd, verbose=True)
-        p_mock.assert_called_once_with(cmd, stdout=subprocess.PIPE)
-        pr_mock.assert_called_once_with("Executing: ['foo', 'bar']")
+                with self.assertRaises(subprocess.CalledProcessError):
+                    run_command(['sh', '-c', 'seq 10; exit 1'],
+                                verbose=False)
+        printed = [c[0][0] for c in pr_mock.call_args_list]
+        self.assertEqual(printed[0], '1\n2\n3')
+        # The tail is printed on failure.
+        self.assertEqual(printed[1], 'ERROR: run_command failed: {}'.format(
+            '\n'.join(str(i) for i in range(1, 11))))
+        self.assertTrue(printed[2].startswith('7 of 10 lines not shown'))
+
+    def test_run_concurrently(self):
+        seen = []
+        results = run_concurrently(seen.append, [1, 2, 3], max_workers=3)
+        self.assertItemsEqual(seen, [1, 2, 3])
+        self.assertEqual(results.items(), [(1, None), (2, None), (3, None)])
+
+    def test_run_concurrently_errors(self):
+        error = ValueError('bad')
+
+        def func(item):
+            if item == 2:
+                raise error
+
+        with patch('logging.error'):
+            results = run_concurrently(func, [1, 2, 3], max_workers=2)
+        self.assertEqual(results, {1: None, 2: error, 3: None})
+
+    def test_run_concurrently_stop_on_error(self):
+        error = ValueError('bad')
+
+        def func(item):
+            if item == 2:
+                raise error
+
+        with patch('logging.error'):
+            results = run_concurrently(func, [1, 2, 3], stop_on_error=True)
+        self.assertEqual(results.items(), [(1, None), (2, error)])
 
     def test_copytree_force(self):
         with temp_dir() as src:
@@ -71,6 +230,23 @@ class TestUtility(TestCase):
                 copytree_force(src, dst)
                 self.assertTrue(os.path.exists(sub_dst_dir))
 
+    def test_copytree_force_keep(self):
+        with temp_dir() as d:
+            src = os.path.join(d, 'src')
+            dst = os.path.join(d, 'dst')
+            for path in (os.path.join(src, 'mongodb', 'result.json'),
+                         os.path.join(dst, 'old.json'),
+                         os.path.join(dst, 'commands', '001-juju.log')):
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                open(path, 'w').close()
+            copytree_force(src, dst, keep=('commands',))
+            self.assertItemsEqual(os.listdir(dst), ['mongodb', 'commands'])
+            self.assertEqual(os.listdir(os.path.join(dst, 'commands')),
+                             ['001-juju.log'])
+            self.assertEqual(os.listdir(os.path.join(dst, 'mongodb')),
+                             ['result.json'])
+
     def test_rename_env(self):
         with temp_dir() as tmp_dir:
             env = {'environments': {
@@ -85,10 +261,53 @@ class TestUtility(TestCase):
                 'access-key': 'my_access_key'}}}
             self.assertEqual(new_env, expected_env)
 
+    def test_rename_envs(self):
+        with temp_dir() as tmp_dir:
+            env = {'environments': {'aws': {'a': 1}, 'gce': {'b': 2}}}
+            file_path = os.path.join(tmp_dir, 't.yaml')
+            with open(file_path, 'w') as f:
+                yaml.dump(env, f)
+            with patch('yaml.dump', wraps=yaml.dump) as dump_mock:
+                new_names = rename_envs(['aws', 'gce'], 'cwr-', file_path)
+            self.assertEqual(dump_mock.call_count, 1)
+            self.assertEqual(new_names, ['cwr-aws', 'cwr-gce'])
+            with open(file_path) as f:
+                self.assertEqual(yaml.safe_load(f), {'environments': {
+                    'cwr-aws': {'a': 1}, 'cwr-gce': {'b': 2}}})
+            self.assertEqual(os.listdir(tmp_dir), ['t.yaml'])
 
-class FakeProc:
-
-    returncode = 0
+    def test_rename_envs_suffix(self):
+        with temp_dir() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 't.yaml')
+            with open(file_path, 'w') as f:
+                yaml.dump({'environments': {'aws': {'a': 1}}}, f)
+            new_names = rename_envs(['aws'], 'cwr-', file_path, '-job1')
+            self.assertEqual(new_names, ['cwr-aws-job1'])
+            with open(file_path) as f:
+                self.assertEqual(yaml.safe_load(f), {'environments': {
+                    'cwr-aws-job1': {'a': 1}}})
 
-    def poll(self):
-        return True
+    def test_snapshot_tree(self):
+        with temp_dir() as tmp_dir:
+            src = os.path.join(tmp_dir, 'src')
+            os.makedirs(os.path.join(src, 'sub'))
+            os.mkdir(os.path.join(src, 'skip'))
+            for path in ('linked', 'copied', os.path.join('sub', 'nested')):
+                with open(os.path.join(src, path), 'w') as f:
+                    f.write(path)
+            os.symlink('linked', os.path.join(src, 'symlink'))
+            dst = os.path.join(tmp_dir, 'dst')
+            snapshot_tree(src, dst, copy=['copied'],
+                          ignore=lambda d, names: [
+                              n for n in names if n == 'skip'])
+            self.assertItemsEqual(
+                os.listdir(dst), ['linked', 'copied', 'sub', 'symlink'])
+            self.assertTrue(os.path.samefile(
+                os.path.join(src, 'linked'), os.path.join(dst, 'linked')))
+            self.assertTrue(os.path.samefile(
+                os.path.join(src, 'sub', 'nested'),
+                os.path.join(dst, 'sub', 'nested')))
+            self.assertFalse(os.path.samefile(
+                os.path.join(src, 'copied'), os.path.join(dst, 'copied')))
+            self.assertEqual(os.readlink(os.path.join(dst, 'symlink')),
+                             'linked')